@@ -0,0 +1,90 @@
+"""Cost of decoding sensor value updates
+
+For every sensor class exported by :mod:`bricknil.sensor`, enables the first
+capability (a single mode 0x45 update) and, for combinable sensors, every
+combinable capability (a 0x46 update carrying all of them), then times
+`N` calls to :meth:`bricknil.sensor.peripheral.Peripheral.update_value`
+(best of `REPEAT` runs).  Nothing is connected to the `notify` signals, so
+this is decoding plus the cost of emitting with no listeners; the last
+column times the sensor's `decoder` on its own.  :func:`measure` returns the
+same numbers for ``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_decode.py
+
+"""
+import time, inspect
+from asyncio import run
+
+import bricknil.sensor
+from bricknil.sensor.peripheral import Peripheral
+
+N = 20000
+REPEAT = 5
+
+
+async def swallow(*args, **kwargs):
+    pass
+
+
+def payload(cls, capabilities):
+    """Zero readings for `capabilities`, with the combined mode bitmask if needed"""
+    size = sum(cls.datasets[cap][0] * cls.datasets[cap][1] for cap in capabilities)
+    if len(capabilities) > 1:
+        return bytes([0, (1<<len(capabilities))-1] + [0]*size)
+    return bytes(size)
+
+
+def best_of(call, msg, n=N):
+    runs = []
+    for r in range(REPEAT):
+        start = time.perf_counter()
+        for i in range(n):
+            call(msg)
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+async def time_updates(cls, capabilities, n=N):
+    sensor = cls('bench', capabilities=capabilities)
+    sensor.port = 1
+    sensor.message_handler = swallow
+    await sensor.activate_updates()
+    msg = memoryview(payload(cls, capabilities))
+    update = sensor.update_value
+    runs = []
+    for r in range(REPEAT):
+        start = time.perf_counter()
+        for i in range(n):
+            await update(msg)
+        runs.append(time.perf_counter() - start)
+    decode = sensor.decoder.decode
+    return min(runs), best_of(lambda msg: decode(msg, sensor.value), msg, n)
+
+
+async def measure(n=N):
+    """Return (sensor, mode, us/update, us/decode) for each sensor class and mode"""
+    results = []
+    for name, cls in vars(bricknil.sensor).items():
+        if not (inspect.isclass(cls) and issubclass(cls, Peripheral)) or not getattr(cls, 'datasets', None):
+            continue
+        caps = list(cls.datasets)
+        cases = [('single', caps[:1])]
+        combo = [cap for cap in caps if cap in cls.allowed_combo]
+        if len(combo) > 1:
+            cases.append(('combo', combo))
+        for mode, capabilities in cases:
+            elapsed, decoding = await time_updates(cls, capabilities, n)
+            results.append((name, mode, elapsed/n*1e6, decoding/n*1e6))
+    return results
+
+
+async def main():
+    print(f'{"sensor":>30} {"mode":>8} {"us/update":>10} {"us/decode":>10}')
+    for name, mode, update, decode in await measure():
+        print(f'{name:>30} {mode:>8} {update:>10.2f} {decode:>10.2f}')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,62 @@
+"""Startup time of discovering and connecting many hubs
+
+Runs :func:`bricknil.hub.Hub.connect` against the simulated transport (no
+radio needed) where each discovery scan takes `SCAN_TIME` seconds and each
+connection takes `CONNECT_TIME` seconds.  Hubs are connected either one after
+another (how `bricknil.main` used to do it) or concurrently through the shared
+discovery scan.  The last column reconnects with a warm
+:class:`bricknil.discovery_cache.DiscoveryCache`, which skips scanning.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_discovery.py
+
+"""
+import time, tempfile, os
+from asyncio import run, gather
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.hub import Hub, PoweredUpHub
+from bricknil.discovery_cache import DiscoveryCache
+from bricknil.simulated import SimulatedTransport, SimulatedHub
+
+SCAN_TIME = 0.05      # Real scans take 1s; scale everything down 20x
+CONNECT_TIME = 0.02
+HUB_COUNTS = [1, 2, 4, 8, 16, 32]
+
+
+async def connect_hubs(n_hubs, concurrent):
+    Hub.hubs = []
+    hubs = [PoweredUpHub(f'hub{i}') for i in range(n_hubs)]
+    transport = SimulatedTransport([SimulatedHub(address=f'00:00:00:00:00:{i:02X}') for i in range(n_hubs)],
+                                   scan_time=SCAN_TIME, connect_time=CONNECT_TIME)
+    BLEventQ.instance.transport = transport
+
+    start = time.perf_counter()
+    if concurrent:
+        await gather(*[hub.connect() for hub in hubs])
+    else:
+        for hub in hubs:
+            await hub.connect()
+    elapsed = time.perf_counter() - start
+
+    for hub in hubs:
+        await hub.disconnect()
+    return elapsed, transport.scans
+
+
+def main():
+    print(f'{"hubs":>5} {"sequential (s)":>15} {"scans":>6} {"concurrent (s)":>15} {"scans":>6} {"cached (s)":>11} {"scans":>6}')
+    for n in HUB_COUNTS:
+        seq, seq_scans = run(connect_hubs(n, concurrent=False))
+        con, con_scans = run(connect_hubs(n, concurrent=True))
+        with tempfile.TemporaryDirectory() as tmp:
+            BLEventQ.instance.discovery_cache = DiscoveryCache(os.path.join(tmp, 'cache.json'))
+            run(connect_hubs(n, concurrent=True))  # Warm up the cache
+            cached, cached_scans = run(connect_hubs(n, concurrent=True))
+            BLEventQ.instance.discovery_cache = None
+        print(f'{n:>5} {seq:>15.3f} {seq_scans:>6} {con:>15.3f} {con_scans:>6} {cached:>11.3f} {cached_scans:>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Cost of :meth:`bricknil.process.Process.emit` as receivers are added
+
+Connects 0, 1, 4 and 16 receivers (coroutines, and plain functions) to a
+signal of one process, while `OTHERS` other processes have a receiver on
+the same signal name (as every peripheral's `notify` does), and times `N`
+emits (best of `REPEAT` runs).  The same is timed with an
+:class:`bricknil.process.EmitPolicy` on the signal ('guarded'), which
+records each receiver's latency.  Then times emits to `SLOW_RECEIVERS`
+coroutine receivers that each take `SLOW_TIME` seconds, awaited one after
+the other and concurrently.  :func:`measure` returns the same numbers for
+``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_emit.py
+
+"""
+import time
+from asyncio import run, sleep
+
+from bricknil.process import Process, EmitPolicy
+
+N = 20000
+REPEAT = 5
+FANOUT = (0, 1, 4, 16)
+OTHERS = 8
+SLOW_RECEIVERS = 10
+SLOW_TIME = 0.001
+SLOW_EMITS = 50
+
+
+class Emitter(Process):
+    _signals_ = ['bench']
+
+
+async def coroutine_receiver(sender, value):
+    pass
+
+
+async def time_emits(receivers, kind, n=N):
+    emitter = Emitter('bench')
+    if kind == 'guarded':
+        emitter.set_emit_policy(EmitPolicy('serial'), 'bench')
+    connected = []
+    for i in range(receivers):
+        # Distinct callables, so blinker keeps each one
+        if kind != 'function':
+            async def receiver(sender, value):
+                pass
+        else:
+            def receiver(sender, value):
+                pass
+        emitter.connect('bench', receiver)
+        connected.append((receiver, emitter))
+    for i in range(OTHERS):
+        other = Emitter('other')
+        other.connect('bench', coroutine_receiver)
+        connected.append((coroutine_receiver, other))
+    emit = emitter.emit
+    runs = []
+    for r in range(REPEAT):
+        start = time.perf_counter()
+        for i in range(n):
+            await emit('bench', i)
+        runs.append(time.perf_counter() - start)
+    for receiver, sender in connected:
+        sender.disconnect('bench', receiver)
+    return min(runs)
+
+
+async def time_slow_emits(mode, n=SLOW_EMITS):
+    emitter = Emitter('bench')
+    emitter.set_emit_policy(EmitPolicy(mode), 'bench')
+    for i in range(SLOW_RECEIVERS):
+        async def receiver(sender, value):
+            await sleep(SLOW_TIME)
+        emitter.connect('bench', receiver)
+    start = time.perf_counter()
+    for i in range(n):
+        await emitter.emit('bench', i)
+    return time.perf_counter() - start
+
+
+async def measure(n=N):
+    """Return (receiver kind, receivers, us/emit) for each fan-out"""
+    results = []
+    for kind in ('coroutine', 'guarded', 'function'):
+        for receivers in FANOUT:
+            if kind != 'coroutine' and receivers == 0:
+                continue
+            results.append((kind, receivers, await time_emits(receivers, kind, n)/n*1e6))
+    slow_emits = max(1, SLOW_EMITS * n // N)
+    for mode in EmitPolicy.MODES:
+        results.append((f'{SLOW_TIME*1e3:g}ms {mode}', SLOW_RECEIVERS,
+                        await time_slow_emits(mode, slow_emits)/slow_emits*1e6))
+    return results
+
+
+async def main():
+    print(f'{"receivers":>10} {"kind":>16} {"us/emit":>8}')
+    for kind, receivers, elapsed in await measure():
+        print(f'{receivers:>10} {kind:>16} {elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,84 @@
+"""Latency of a fast peripheral's handler next to a slow one
+
+A simulated hub streams the position of two tacho motors at `RATE` updates
+per second.  The `slow` motor's handler takes `SLOW_TIME` seconds (like one
+that ramps another motor), the `fast` one's returns right away.  For each
+handler policy of the slow motor, prints the latency from notification to
+the fast handler (over `SAMPLES` readings), and what the slow motor's
+:class:`bricknil.handlers.HandlerRunner` reports.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_handlers.py
+
+"""
+import time
+from asyncio import run, sleep, Event
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.hub import Hub, PoweredUpHub
+from bricknil.sensor import ExternalMotor
+from bricknil.simulated import SimulatedTransport, SimulatedHub, SimulatedDevice
+from bricknil.handlers import HandlerPolicy
+from bricknil.process import latency_stats
+
+RATE = 200
+SAMPLES = 400
+SLOW_TIME = 0.02
+POLICIES = ('serial', 'latest', HandlerPolicy('concurrent', limit=8))
+
+
+class TwoMotorHub(PoweredUpHub):
+
+    def __init__(self, name, policy, sent):
+        super().__init__(name)
+        self.sent = sent
+        self.latencies = []
+        self.done = Event()
+        slow = ExternalMotor('slow', capabilities=['sense_pos'], port=0)
+        slow.handler_policy = policy
+        self.attach_sensor(slow)
+        self.attach_sensor(ExternalMotor('fast', capabilities=['sense_pos'], port=1))
+
+    async def slow_change(self):
+        await sleep(SLOW_TIME)
+
+    async def fast_change(self):
+        now = time.perf_counter()
+        self.latencies.append(now - self.sent[self.fast.value[self.fast.capability.sense_pos]])
+        if len(self.latencies) >= SAMPLES:
+            self.done.set()
+
+
+async def stream(policy):
+    sent = {}
+    def values(mode, tick):
+        sent[tick] = time.perf_counter()
+        return [tick]
+    transport = SimulatedTransport()
+    transport.add_hub(SimulatedHub(ports={i: SimulatedDevice(0x26, values=values) for i in range(2)}, rate=RATE))
+    saved_transport = BLEventQ.instance.transport
+    BLEventQ.instance.transport = transport
+    Hub.hubs = []
+    try:
+        hub = TwoMotorHub('bench', policy, sent)
+        await hub.connect()
+        await hub.done.wait()
+        stats = hub.handler_stats()['slow']
+        await hub.disconnect()
+    finally:
+        BLEventQ.instance.transport = saved_transport
+    return hub.latencies, stats
+
+
+async def main():
+    print(f'{"slow policy":>12} {"fast p50 ms":>12} {"fast p99 ms":>12} {"slow runs":>10} {"skipped":>8}')
+    for policy in POLICIES:
+        latencies, stats = await stream(policy)
+        fast = latency_stats(latencies)
+        print(f'{HandlerPolicy.of(policy).mode:>12} {fast["p50"]*1e3:>12.3f} '
+              f'{fast["p99"]*1e3:>12.3f} {stats["runs"]:>10} {stats["skipped"]:>8}')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,56 @@
+"""Cost of handing notifications from a BLE backend thread to the event loop
+
+A thread pushes `N` notifications as fast as it can, like a backend that
+calls back off-loop.  Compares one `call_soon_threadsafe` per notification
+(one loop wakeup per packet) with :class:`bricknil.ingress.NotificationIngress`.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_ingress.py
+
+"""
+import time, threading
+from asyncio import run, sleep, get_event_loop
+
+from bricknil.ingress import NotificationIngress
+
+N = 200000
+PACKET = bytearray([0x08, 0x00, 0x45, 0x00, 0x10, 0x00, 0x00, 0x00])
+
+
+async def handoff(batched):
+    handled = [0]
+    def handler(data, timestamp):
+        handled[0] += 1
+    loop = get_event_loop()
+    if batched:
+        ingress = NotificationIngress('bench', handler)
+        callback = ingress.received
+    else:
+        def callback(sender, data):
+            loop.call_soon_threadsafe(handler, bytes(data), time.monotonic())
+
+    def backend():
+        for i in range(N):
+            callback(None, PACKET)
+    start = time.perf_counter()
+    thread = threading.Thread(target=backend)
+    thread.start()
+    while handled[0] < N:
+        await sleep(0.001)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    batches = ingress.batches if batched else N
+    return elapsed, batches
+
+
+def main():
+    print(f'{"handoff":>12} {"total (s)":>10} {"us/packet":>10} {"loop wakeups":>13}')
+    for batched in (False, True):
+        elapsed, batches = run(handoff(batched))
+        name = 'batched' if batched else 'per-packet'
+        print(f'{name:>12} {elapsed:>10.3f} {elapsed/N*1e6:>10.2f} {batches:>13}')
+
+
+if __name__ == '__main__':
+    main()
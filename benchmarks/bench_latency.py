@@ -0,0 +1,95 @@
+"""Latency from a notification to the hub's `*_change` handler
+
+A simulated hub streams the position of `SENSORS` tacho motors at each of
+the `RATES` (updates per second, per motor), with each reading carrying the
+simulated hub's tick.  The time the reading was sent is kept per tick, and
+each motor's `*_change` handler looks it up, so the latency covers the
+transport callback, :class:`bricknil.ingress.NotificationIngress`, parsing, the mailbox,
+decoding and dispatch.  Prints percentiles over `SAMPLES` readings (after
+`WARMUP` are discarded).  :func:`measure` returns the same numbers for
+``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_latency.py
+
+"""
+import time
+from asyncio import run, Event
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.hub import Hub, PoweredUpHub
+from bricknil.sensor import ExternalMotor
+from bricknil.simulated import SimulatedTransport, SimulatedHub, SimulatedDevice
+from bricknil.process import latency_stats
+
+SAMPLES = 1000
+WARMUP = 50
+RATES = (200, 1000)
+SENSORS = (1, 4)
+PERCENTILES = (50, 90, 99)
+
+
+class LatencyHub(PoweredUpHub):
+    """Hub with `sensors` motors whose handlers record the latency of each reading"""
+
+    def __init__(self, name, sensors, sent, samples):
+        super().__init__(name)
+        self.sent = sent
+        self.samples = samples
+        self.latencies = []
+        self.done = Event()
+        for i in range(sensors):
+            motor = ExternalMotor(f'motor{i}', capabilities=['sense_pos'], port=i)
+            self.attach_sensor(motor)
+            setattr(self, f'motor{i}_change', self._handler(motor))
+
+    def _handler(self, motor):
+        async def changed():
+            now = time.perf_counter()
+            self.latencies.append(now - self.sent[motor.value[motor.capability.sense_pos]])
+            if len(self.latencies) >= self.samples:
+                self.done.set()
+        return changed
+
+
+async def stream(rate, sensors, samples=SAMPLES):
+    """Return the notification to handler latencies (seconds) of `samples` readings"""
+    sent = {}
+    def values(mode, tick):
+        sent[tick] = time.perf_counter()
+        return [tick]
+    transport = SimulatedTransport()
+    ports = {i: SimulatedDevice(0x26, values=values) for i in range(sensors)}
+    transport.add_hub(SimulatedHub(ports=ports, rate=rate))
+    saved_transport = BLEventQ.instance.transport
+    BLEventQ.instance.transport = transport
+    Hub.hubs = []
+    try:
+        hub = LatencyHub('bench', sensors, sent, samples + WARMUP*sensors)
+        await hub.connect()
+        await hub.done.wait()
+        await hub.disconnect()
+    finally:
+        BLEventQ.instance.transport = saved_transport
+    return hub.latencies[WARMUP*sensors:]
+
+
+async def measure(samples=SAMPLES):
+    """Return (rate, sensors, {percentile: latency in ms}) for each case"""
+    results = []
+    for rate in RATES:
+        for sensors in SENSORS:
+            stats = latency_stats(await stream(rate, sensors, samples))
+            results.append((rate, sensors, {p: stats[f'p{p}']*1e3 for p in PERCENTILES}))
+    return results
+
+
+async def main():
+    print(f'{"updates/s":>10} {"sensors":>8} ' + ' '.join(f'{"p"+str(p)+" ms":>8}' for p in PERCENTILES))
+    for rate, sensors, latency in await measure():
+        print(f'{rate:>10} {sensors:>8} ' + ' '.join(f'{latency[p]:>8.3f}' for p in PERCENTILES))
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,87 @@
+"""Throughput of :meth:`bricknil.hub.Hub.peripheral_message_loop`
+
+Puts `N` readings for a tacho motor (single mode, and combined speed and
+position) into a hub's :attr:`bricknil.hub.Hub.peripheral_queue`, with
+conflation off so every one is handled, then times the hub's message loop
+taking them out, updating the motor and calling an empty `motor_change`
+handler (best of `REPEAT` runs).  :func:`measure` returns the same numbers
+for ``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_loop.py
+
+"""
+import time, struct
+from asyncio import run, Event, create_task as spawn
+
+from bricknil.hub import PoweredUpHub
+from bricknil.sensor import ExternalMotor
+from bricknil.mailbox import PeripheralEvent
+
+N = 20000
+REPEAT = 5
+
+CASES = {
+    'single': (['sense_speed'], bytes([10])),
+    'combo': (['sense_speed', 'sense_pos'], bytes([0x00, 0x03, 10]) + struct.pack('<i', 1000)),
+}
+
+
+async def swallow(*args, **kwargs):
+    pass
+
+
+class BenchHub(PoweredUpHub):
+
+    def __init__(self, name, capabilities, n):
+        super().__init__(name)
+        self.attach_sensor(ExternalMotor('motor', capabilities=capabilities))
+        self.remaining = n
+        self.done = Event()
+
+    async def motor_change(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+
+async def time_loop(capabilities, reading, n=N):
+    hub = BenchHub('bench', capabilities, n)
+    hub.motor.port = 0
+    hub.motor.mailbox_depth = None
+    hub._bind_port(0, hub.motor)
+    hub.motor.message_handler = swallow
+    await hub.motor.activate_updates()
+    queue = hub.peripheral_queue
+    for i in range(n):
+        queue.put_nowait(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 0, reading))
+    start = time.perf_counter()
+    task = spawn(hub.peripheral_message_loop())
+    await hub.done.wait()
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    await task
+    hub.handlers['motor'].stop()
+    return elapsed
+
+
+async def measure(n=N):
+    """Return (mode, us/event) for each case"""
+    results = []
+    for mode, (capabilities, reading) in CASES.items():
+        runs = []
+        for r in range(REPEAT):
+            runs.append(await time_loop(capabilities, reading, n))
+        results.append((mode, min(runs)/n*1e6))
+    return results
+
+
+async def main():
+    print(f'{"mode":>8} {"events/s":>10} {"us/event":>9}')
+    for mode, elapsed in await measure():
+        print(f'{mode:>8} {1e6/elapsed:>10.0f} {elapsed:>9.2f}')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,53 @@
+"""Latency of sensor readings when they arrive faster than they're handled
+
+A sensor streams readings on one port every `PERIOD` seconds while the
+handler takes `HANDLER_TIME` per reading (twice as long), for `DURATION`
+seconds.  Compares an unbounded `asyncio.Queue` (every reading is handled,
+but each waits behind an ever-growing backlog) with
+:class:`bricknil.mailbox.PeripheralMailbox` keeping only the newest reading.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_mailbox.py
+
+"""
+import time
+from asyncio import run, sleep, Queue, create_task as spawn
+
+from bricknil.mailbox import PeripheralMailbox, PeripheralEvent
+
+PERIOD = 0.002
+HANDLER_TIME = 0.004
+DURATION = 2.0
+
+
+async def stream(queue):
+    latencies = []
+    async def producer():
+        end = time.monotonic() + DURATION
+        while time.monotonic() < end:
+            queue.put_nowait(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 1, time.monotonic()))
+            await sleep(PERIOD)
+    async def consumer():
+        while True:
+            event = await queue.get()
+            latencies.append(time.monotonic() - event.data)
+            await sleep(HANDLER_TIME)
+    task = spawn(consumer())
+    await producer()
+    backlog = queue.qsize()
+    task.cancel()
+    return latencies, backlog
+
+
+async def main():
+    print(f'{"queue":>10} {"handled":>8} {"backlog":>8} {"p50 ms":>8} {"max ms":>8}')
+    for name, queue in [('Queue', Queue()), ('mailbox', PeripheralMailbox('bench'))]:
+        latencies, backlog = await stream(queue)
+        latencies.sort()
+        p50 = latencies[len(latencies)//2]
+        print(f'{name:>10} {len(latencies):>8} {backlog:>8} {p50*1e3:>8.1f} {latencies[-1]*1e3:>8.1f}')
+
+
+if __name__ == '__main__':
+    run(main())
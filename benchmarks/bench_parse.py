@@ -0,0 +1,78 @@
+"""Parse throughput of :meth:`bricknil.message_dispatch.MessageDispatch.parse`
+
+Parses a representative notification of each message type `N` times
+against a hub stub that just swallows the dispatched messages, and prints
+the parse rate per message type (best of `REPEAT` runs), with and without
+building the log description.  :func:`measure` returns the same numbers for
+``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_parse.py
+
+"""
+import time, struct, functools
+
+from bricknil.message_dispatch import MessageDispatch
+
+N = 20000
+REPEAT = 7
+
+
+class HubStub:
+    """Just enough of a hub to receive what the parsers dispatch"""
+    class Queue:
+        def put_nowait(self, item):
+            pass
+    def __init__(self):
+        self.peripheral_queue = HubStub.Queue()
+    def port_output_feedback(self, port, feedback):
+        pass
+
+
+def with_header(body):
+    return bytes([len(body)+2, 0x00] + body)
+
+
+MESSAGES = {
+    'port value (0x45)':       with_header([0x45, 0x00, 0x10]),
+    'port value 32b (0x45)':   with_header([0x45, 0x00, 0x10, 0x20, 0x30, 0x40]),
+    'combo value (0x46)':      with_header([0x46, 0x00, 0x00, 0x03, 0x10, 0x10, 0x20, 0x30, 0x40]),
+    'hub property (0x01)':     with_header([0x01, 0x06, 0x06, 0x64]),
+    'button (0x01)':           with_header([0x01, 0x02, 0x06, 0x01]),
+    'output feedback (0x82)':  with_header([0x82, 0x00, 0x0a]),
+    'attached io (0x04)':      with_header([0x04, 0x00, 0x01, 0x26, 0x00, 0,0,0,0x10, 0,0,0,0x10]),
+    'port info (0x43)':        with_header([0x43, 0x00, 0x01, 0x0f, 0x04, 0x0e, 0x00, 0x01, 0x00]),
+    'combinations (0x43)':     with_header([0x43, 0x00, 0x02, 0x0e, 0x00, 0x06, 0x00]),
+    'mode name (0x44)':        with_header([0x44, 0x00, 0x01, 0x00] + list(b'SPEED')),
+    'mode range (0x44)':       with_header([0x44, 0x00, 0x01, 0x01] + list(struct.pack('<ff', -100, 100))),
+    'mode format (0x44)':      with_header([0x44, 0x00, 0x01, 0x80, 0x01, 0x00, 0x04, 0x00]),
+}
+
+
+def best_of(parse, msg, n=N):
+    runs = []
+    for r in range(REPEAT):
+        start = time.perf_counter()
+        for i in range(n):
+            parse(msg)
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+def measure(n=N):
+    """Return (message, us/msg with description, us/msg without) for each message type"""
+    dispatch = MessageDispatch(HubStub())
+    described = dispatch.parse
+    silent = functools.partial(dispatch.parse, describe=False)
+    return [(name, best_of(described, msg, n)/n*1e6, best_of(silent, msg, n)/n*1e6)
+            for name, msg in MESSAGES.items()]
+
+
+def main():
+    print(f'{"message":>24} {"msgs/s":>10} {"us/msg":>8} {"no desc":>8}')
+    for name, described, silent in measure():
+        print(f'{name:>24} {1e6/described:>10.0f} {described:>8.2f} {silent:>8.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""End-to-end handling cost, replaying a capture as fast as possible
+
+Writes a synthetic capture of a hub with a tacho motor streaming combined
+speed/position updates (plus the attach messages that set it up), then
+replays it with :class:`bricknil.capture.Replayer` through the parser, the
+hub's event dispatch, the motor's decoder and a `motor_change` handler
+(best of `REPEAT` runs).  :func:`measure` returns the same number for
+``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_replay.py
+
+"""
+import os, struct, tempfile
+from asyncio import run
+
+from bricknil.hub import PoweredUpHub
+from bricknil.sensor import ExternalMotor, Button
+from bricknil.capture import CaptureWriter, Replayer
+
+N = 20000
+REPEAT = 5
+
+
+class BenchHub(PoweredUpHub):
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.attach_sensor(ExternalMotor('motor', capabilities=['sense_speed', 'sense_pos']))
+
+    async def motor_change(self):
+        pass
+
+
+def write_capture(path, n=N):
+    with CaptureWriter(path) as capture:
+        capture.record(1, bytes([15, 0, 0x04, 255, 1, Button._sensor_id, 0, 0,0,0,0, 0,0,0,0]), 0)
+        capture.record(1, bytes([15, 0, 0x04, 0, 1, 0x26, 0, 0,0,0,0x10, 0,0,0,0x10]), 0)
+        for i in range(n):
+            body = [0x46, 0x00, 0x00, 0x03] + list(struct.pack('<bi', i % 100, i))
+            capture.record(1, bytes([len(body) + 2, 0] + body), i * 0.01)
+
+
+async def measure(n=N):
+    """Return us/notification of the best replay of `n` notifications"""
+    path = os.path.join(tempfile.mkdtemp(), 'bench.cap')
+    write_capture(path, n)
+    best = None
+    for r in range(REPEAT):
+        replayer = Replayer(path, [BenchHub('bench')])
+        await replayer.run()
+        best = replayer.elapsed if best is None else min(best, replayer.elapsed)
+    os.remove(path)
+    return best/n*1e6
+
+
+async def main():
+    elapsed = await measure()
+    print(f'{N} notifications in {elapsed*N/1e3:.0f} ms: {elapsed:.2f} us/notification')
+
+
+if __name__ == '__main__':
+    run(main())
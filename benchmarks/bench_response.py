@@ -0,0 +1,77 @@
+"""Acknowledged writes vs. write-without-response for streamed setpoints
+
+Streams `N` brightness setpoints to a light on a simulated hub, one every
+`PERIOD` seconds, over a link with `LATENCY` seconds of one-way latency.  An
+acknowledged write holds the hub's writer for a full round trip, so setpoints
+pile up and get superseded in the outbound queue; writes without response
+go out as fast as they're made.
+
+Reports how many setpoints reached the hub, the setpoint rate achieved, and
+the latency from `set_brightness` to the hub receiving the value.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_response.py
+
+"""
+import time
+from asyncio import run, sleep
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.hub import Hub, PoweredUpHub
+from bricknil.sensor import Light
+from bricknil.simulated import SimulatedTransport, SimulatedHub
+from bricknil.process import latency_stats
+
+N = 500
+PERIOD = 0.002
+LATENCY = 0.0075     # Typical 15ms BLE connection interval
+
+
+async def stream(response):
+    transport = SimulatedTransport(latency=LATENCY)
+    sim = transport.add_hub(SimulatedHub(ports={0: 0x08}))
+    BLEventQ.instance.transport = transport
+    Hub.hubs = []
+    hub = PoweredUpHub('hub')
+    light = Light('light')
+    light.response = response
+    hub.attach_sensor(light)
+    await hub.connect()
+
+    issued = {}
+    arrivals = []
+    latencies = []
+    receive = sim.receive
+    def timestamped(data):
+        if data[2] == 0x81:
+            now = time.perf_counter()
+            arrivals.append(now)
+            latencies.append(now - issued[data[-1]])
+        receive(data)
+    sim.receive = timestamped
+
+    start = time.perf_counter()
+    for i in range(N):
+        value = i % 100
+        issued[value] = time.perf_counter()
+        await light.set_brightness(value)
+        await sleep(PERIOD)
+    await sleep(LATENCY*4)
+    elapsed = arrivals[-1] - start
+    await hub.disconnect()
+    return len(arrivals), elapsed, latencies, hub.outbound.coalesced
+
+
+def main():
+    print(f'{"mode":>14} {"delivered":>10} {"superseded":>11} {"setpoints/s":>12} {"p50 (ms)":>9} {"p99 (ms)":>9}')
+    for response in (True, False):
+        delivered, elapsed, latencies, coalesced = run(stream(response))
+        name = 'acknowledged' if response else 'no response'
+        stats = latency_stats(latencies)
+        print(f'{name:>14} {delivered:>10} {coalesced:>11} {delivered/elapsed:>12.0f} '
+              f'{stats["p50"]*1000:>9.1f} {stats["p99"]*1000:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
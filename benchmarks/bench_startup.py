@@ -0,0 +1,87 @@
+"""Time to first command, at startup and after a reconnect
+
+Issues a motor `set_speed` at the same time as :meth:`bricknil.hub.Hub.connect`
+(so the command has to wait for the link and for the motor to attach), and
+times how long it takes until the call has returned and the command has
+reached a simulated hub with `CONNECT_TIME` seconds of connection setup.
+Then drops the link of the (`auto_reconnect`) hub, issues another
+`set_speed` while it's down, and times the same thing from the moment the
+link dropped.  Reports the best and worst of `REPEAT` runs.
+:func:`measure` returns the same numbers for ``benchmarks/suite.py``.
+
+Run with::
+
+    PYTHONPATH=. python benchmarks/bench_startup.py
+
+"""
+import time
+from asyncio import run, Event, create_task as spawn
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.hub import Hub, PoweredUpHub
+from bricknil.sensor import ExternalMotor
+from bricknil.simulated import SimulatedTransport, SimulatedHub
+
+REPEAT = 5
+CONNECT_TIME = 0.02
+
+
+def watch(sim):
+    """Return an Event set when the simulated hub receives a port output command"""
+    arrived = Event()
+    receive = sim.receive
+    def received(data):
+        if data[2] == 0x81:
+            arrived.set()
+        receive(data)
+    sim.receive = received
+    return arrived
+
+
+async def first_command():
+    """Return (seconds to the first command at startup, seconds to the first command after the link dropped)"""
+    transport = SimulatedTransport(connect_time=CONNECT_TIME)
+    sim = transport.add_hub(SimulatedHub(ports={0: 0x26}))
+    saved_transport = BLEventQ.instance.transport
+    BLEventQ.instance.transport = transport
+    Hub.hubs = []
+    try:
+        hub = PoweredUpHub('bench', auto_reconnect=True)
+        hub.attach_sensor(ExternalMotor('motor'))
+        arrived = watch(sim)
+
+        start = time.perf_counter()
+        command = spawn(hub.motor.set_speed(50))
+        await hub.connect()
+        await command
+        await arrived.wait()
+        startup = time.perf_counter() - start
+
+        arrived.clear()
+        start = time.perf_counter()
+        sim.drop_link()
+        await hub.motor.set_speed(20)
+        await arrived.wait()
+        reconnect = time.perf_counter() - start
+        await hub.disconnect()
+    finally:
+        BLEventQ.instance.transport = saved_transport
+    return startup, reconnect
+
+
+async def measure():
+    """Return {'startup': (best, worst), 'reconnect': (best, worst)} in ms"""
+    runs = [await first_command() for r in range(REPEAT)]
+    startup = [r[0]*1e3 for r in runs]
+    reconnect = [r[1]*1e3 for r in runs]
+    return {'startup': (min(startup), max(startup)), 'reconnect': (min(reconnect), max(reconnect))}
+
+
+async def main():
+    print(f'{"":>10} {"best ms":>8} {"worst ms":>8}')
+    for name, (best, worst) in (await measure()).items():
+        print(f'{name:>10} {best:>8.1f} {worst:>8.1f}')
+
+
+if __name__ == '__main__':
+    run(main())
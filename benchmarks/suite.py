@@ -0,0 +1,124 @@
+"""Run the pipeline benchmarks and write machine-readable results
+
+Runs, in order:
+
+    * ``parse``: :meth:`bricknil.message_dispatch.MessageDispatch.parse` per message type (bench_parse)
+    * ``decode``: :meth:`bricknil.sensor.peripheral.Peripheral.update_value` per sensor class and mode (bench_decode)
+    * ``emit``: :meth:`bricknil.process.Process.emit` fan-out (bench_emit)
+    * ``loop``: :meth:`bricknil.hub.Hub.peripheral_message_loop` throughput (bench_loop)
+    * ``replay``: a capture replayed through parsing, dispatch and handling (bench_replay)
+    * ``latency``: notification to handler latency through the simulated transport (bench_latency)
+    * ``startup``: time to the first command at startup and after a reconnect (bench_startup)
+
+Every result is a time, so lower is better.  With `--json`, they're
+written out with the bricknil and Python versions, keyed by name (like
+``parse/port value (0x45)/no desc``)::
+
+    {"bricknil": "0.9.3", "python": "3.7.3", "platform": "...", "time": "...", "quick": false,
+     "results": {"parse/port value (0x45)/no desc": {"value": 1.27, "unit": "us"}, ...}}
+
+`--compare` checks the results against an earlier JSON file and exits
+with status 1 if anything got more than `--threshold` slower, so a
+release can be checked against the previous one::
+
+    PYTHONPATH=. python benchmarks/suite.py --json 0.9.3.json
+    PYTHONPATH=. python benchmarks/suite.py --compare 0.9.3.json
+
+`--quick` runs a tenth of the iterations (for smoke testing; the numbers
+are noisier).
+"""
+import sys, json, time, platform, argparse
+from asyncio import run
+
+import bench_parse, bench_decode, bench_emit, bench_loop, bench_replay, bench_latency, bench_startup
+from bricknil.version import __version__
+
+BENCHMARKS = ('parse', 'decode', 'emit', 'loop', 'replay', 'latency', 'startup')
+
+
+async def collect(only=BENCHMARKS, quick=False):
+    """Run the benchmarks in `only` and return name -> {'value', 'unit'}"""
+    scale = 10 if quick else 1
+    results = {}
+    def add(name, value, unit='us'):
+        results[name] = {'value': round(value, 4), 'unit': unit}
+        print(f'{name:>60} {value:>10.3f} {unit}')
+    if 'parse' in only:
+        for name, described, silent in bench_parse.measure(bench_parse.N // scale):
+            add(f'parse/{name}', described)
+            add(f'parse/{name}/no desc', silent)
+    if 'decode' in only:
+        for name, mode, update, decode in await bench_decode.measure(bench_decode.N // scale):
+            add(f'decode/{name}/{mode}/update', update)
+            add(f'decode/{name}/{mode}/decode', decode)
+    if 'emit' in only:
+        for kind, receivers, elapsed in await bench_emit.measure(bench_emit.N // scale):
+            add(f'emit/{kind}/{receivers}', elapsed)
+    if 'loop' in only:
+        for mode, elapsed in await bench_loop.measure(bench_loop.N // scale):
+            add(f'loop/{mode}', elapsed)
+    if 'replay' in only:
+        add('replay/combo', await bench_replay.measure(bench_replay.N // scale))
+    if 'latency' in only:
+        for rate, sensors, latency in await bench_latency.measure(bench_latency.SAMPLES // scale):
+            for p, value in latency.items():
+                add(f'latency/{rate}Hz/{sensors} sensors/p{p}', value, 'ms')
+    if 'startup' in only:
+        for name, (best, worst) in (await bench_startup.measure()).items():
+            add(f'startup/{name}/best', best, 'ms')
+            add(f'startup/{name}/worst', worst, 'ms')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print what changed from `baseline`, and return the names of results more than `threshold` slower"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['value'], result['value']
+        if before <= 0:
+            continue
+        change = after/before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:>60} {before:>10.3f} -> {after:>10.3f} {result["unit"]:>3} {change:>+7.1%}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the bricknil pipeline benchmarks')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fraction slower than the earlier run that counts as a regression (default 0.2)')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('--quick', action='store_true', help='Run a tenth of the iterations')
+    args = parser.parse_args(argv)
+
+    results = run(collect(args.only, args.quick))
+    if args.json:
+        report = {'bricknil': __version__,
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                  'quick': args.quick,
+                  'results': results,
+                  }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'\nCompared with bricknil {baseline.get("bricknil")} (python {baseline.get("python")}):')
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) over {args.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,13 +25,25 @@ Submodules
     process
     hub
     ble_queue
+    adapter
+    transport
+    simulated
+    discovery_cache
+    port_info_cache
+    ingress
+    framing
+    capture
+    mailbox
+    handlers
     message_dispatch
+    outbound
     messages
     sensor.peripheral
     sensor.motor
     sensor.sensor
     sensor.light
     sensor.sound
+    sensor.codegen
     sockets
 
 """
@@ -0,0 +1,60 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""BLE adapters (controllers) in the :class:`bricknil.ble_queue.BLEventQ` pool
+
+Each controller can only hold so many connections, so hubs are spread over
+every adapter in the pool.  For example, on a host with two controllers::
+
+    BLEventQ.instance.add_adapter('hci0', max_connections=7)
+    BLEventQ.instance.add_adapter('hci1', max_connections=7)
+
+"""
+
+class Adapter:
+    """One BLE controller and the hubs connected through it
+
+       Args:
+          name (str) : Adapter name (e.g. 'hci0'), None for the default adapter
+          transport (:class:`bricknil.transport.Transport`) : Transport using this adapter
+          max_connections (int) : Most hubs to connect through this adapter (None for no limit)
+
+       Attributes:
+          addresses (set [str]) : Addresses of the hubs connected, connecting or reconnecting through this adapter
+          scans (int) : Number of discovery scans run on this adapter
+          connects (int) : Number of connection attempts
+          failures (int) : Number of failed connection attempts
+          peak_load (int) : Highest `load` so far
+    """
+    def __init__(self, name, transport, max_connections=None):
+        self.name = name
+        self.transport = transport
+        self.max_connections = max_connections
+        self.addresses = set()
+        self.scans = 0
+        self.connects = 0
+        self.failures = 0
+        self.peak_load = 0
+
+    @property
+    def load(self):
+        """Number of hubs using this adapter"""
+        return len(self.addresses)
+
+    @property
+    def full(self):
+        return self.max_connections is not None and self.load >= self.max_connections
+
+    def __repr__(self):
+        return f'Adapter({self.name}, load={self.load}/{self.max_connections})'
@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from asyncio import Queue, sleep, CancelledError
-import sys, functools, uuid, bleak
+from asyncio import sleep, CancelledError, get_event_loop, wait_for, gather, create_task as spawn
+import uuid, time, logging
 
 from .sensor import Button # Hack! only to get the button sensor_id for the fake attach message
 from .process import Process
 from .message_dispatch import MessageDispatch
+from .transport import BleakTransport
+from .adapter import Adapter
+from .ingress import NotificationIngress
+from .framing import frame
 
 # Need a class to represent the bluetooth adapter provided
 class BLEventQ(Process):
@@ -29,57 +33,159 @@ class BLEventQ(Process):
        All requests to send messages to the BLE device must be inserted into
        the :class:`bricknil.BLEventQ.q` Queue object.
 
+       Hubs are spread over a pool of adapters (BLE controllers): each hub
+       goes to the least-loaded adapter that saw it advertise, unless the hub
+       is pinned to an adapter (see :meth:`add_adapter`).
+
+       Attributes:
+          adapters (list [:class:`bricknil.adapter.Adapter`]) : Adapter pool.  Starts with one
+              adapter using the default controller
+          transport (:class:`bricknil.transport.Transport`) : Transport of the first adapter.  Setting it
+              replaces the pool with a single adapter using that transport
+          claimed_addresses (dict) : BLE address -> :class:`bricknil.adapter.Adapter` for every hub
+              connected, connecting, or reconnecting
+          discovery_cache (:class:`bricknil.discovery_cache.DiscoveryCache`) : Set this to
+              connect directly to previously seen hubs instead of scanning (None to always scan)
+          capture (:class:`bricknil.capture.CaptureWriter`) : Set this to record every notification
+              from the hubs (None to not record).  It's flushed when a hub disconnects and
+              closed by :meth:`disconnect_all`
+
     """
     instance = None
 
     def __init__(self):
         assert BLEventQ.instance == None
         super().__init__('BLE Event Q')
-        self.adapter = None
         # User needs to make sure adapter is powered up and on
         #    sudo hciconfig hci0 up
+        self.adapters = [Adapter(None, BleakTransport())]
         self.hubs = {}
         self.devices = []
 
+        # Hubs waiting on the shared discovery scan (see :meth:`_ble_connect`)
+        self.pending_discovery = []
+        self.scan_task = None
+        # BLE addresses already matched to a hub, so two hubs never claim the same device
+        self.claimed_addresses = {}
+        self.discovery_cache = None
+        self.capture = None
+        # Hub -> task trying to bring back a dropped link (see :meth:`_reconnect`)
+        self.reconnect_tasks = {}
+
+    @property
+    def transport(self):
+        return self.adapters[0].transport
+
+    @transport.setter
+    def transport(self, transport):
+        self.adapters = [Adapter(None, transport)]
+
+    def add_adapter(self, name, transport=None, max_connections=None):
+        """Add a BLE controller to the adapter pool
+
+           The first call replaces the default adapter.  Set `adapter=name`
+           on a :class:`bricknil.hub.Hub` to pin it to this adapter.
+
+           Args:
+              name (str) : Adapter name (e.g. 'hci1')
+              transport (:class:`bricknil.transport.Transport`) : Defaults to a
+                  :class:`bricknil.transport.BleakTransport` on this adapter
+              max_connections (int) : Most hubs to connect through this adapter (defaults to the
+                  transport's `max_connections`, None for no limit)
+
+           Returns:
+              :class:`bricknil.adapter.Adapter`
+        """
+        if transport is None:
+            transport = BleakTransport(adapter=name)
+        if max_connections is None:
+            max_connections = transport.max_connections
+        adapter = Adapter(name, transport, max_connections)
+        if len(self.adapters) == 1 and self.adapters[0].name is None and self.adapters[0].load == 0:
+            self.adapters = [adapter]
+        else:
+            assert name not in [a.name for a in self.adapters], f'Duplicate adapter {name}'
+            self.adapters.append(adapter)
+        return adapter
+
+    def _usable_adapters(self, pinned=None):
+        """Adapters with a free connection (restricted to `pinned` if given), least loaded first"""
+        usable = [a for a in self.adapters if not a.full and (pinned is None or a.name == pinned)]
+        return sorted(usable, key=lambda a: a.load)
+
+    def _claim(self, address, adapter):
+        self.claimed_addresses[address] = adapter
+        adapter.addresses.add(address)
+        adapter.peak_load = max(adapter.peak_load, adapter.load)
+
+    def _release(self, address):
+        adapter = self.claimed_addresses.pop(address, None)
+        if adapter is not None:
+            adapter.addresses.discard(address)
+
     async def disconnect_all(self):
+        # Stop reconnecting first, so no hub comes back after its link is closed
+        reconnects = list(self.reconnect_tasks.items())
+        for hub, task in reconnects:
+            task.cancel()
+            self._release(hub.ble_id)
+        await gather(*(task for hub, task in reconnects), return_exceptions=True)
         if len(self.devices) > 0:
             self.message(f'Terminating and disconnecting')
             for device in self.devices:
                 await device.disconnect()
             self.devices = []
+        if self.capture is not None:
+            # Write out whatever notifications are still buffered
+            self.capture.close()
+            self.capture = None
 
-    async def send_message(self, characteristic, msg):
-        """Prepends a byte with the length of the msg and writes it to
+    async def send_message(self, characteristic, msg, response=True):
+        """Prepends the length of the msg and writes it to
            the characteristic
 
            Arguments:
               characteristic : A tuple (device, uuid : str)
               msg (bytearray) : Message with header
+              response (bool) : Use an acknowledged write (False for write-without-response)
         """
-        # Message needs to have length prepended
-        length = len(msg)+1
-        values = bytearray([length]+msg)
+        # Message needs to have length prepended (two bytes if it's over 127)
+        values = frame(msg)
         device, char_uuid = characteristic
-        await device.write_gatt_char(char_uuid, values)
+        await device.write(char_uuid, values, response)
 
     async def get_messages(self, hub):
         """Instance a Message object to parse incoming messages and setup
            the callback from the characteristic to call Message.parse on the
            incoming data bytes
+
+           Notifications go through a :class:`bricknil.ingress.NotificationIngress`
+           so they're always parsed on the event loop, in batches.
         """
         # Message instance to parse and handle messages from this hub
         msg_parser = MessageDispatch(hub)
 
         # Create a fake attach message on port 255, so that we can attach any instantiated Button listeners if present
-        msg_parser.parse(bytearray([15, 0x00, 0x04,255, 1, Button._sensor_id, 0x00, 0,0,0,0, 0,0,0,0]))
-
-        def bleak_received(sender, data):
-            self.message_debug(f'Bleak Raw data received: {data}')
-            msg = msg_parser.parse(data)
-            self.message_debug('{0} Received: {1}'.format(hub.name, msg))
+        button_attach = bytes([15, 0x00, 0x04,255, 1, Button._sensor_id, 0x00, 0,0,0,0, 0,0,0,0])
+        msg_parser.parse(button_attach)
+        if self.capture is not None:
+            self.capture.record(hub.id, button_attach)
+
+        def bleak_received(data, timestamp):
+            if self.capture is not None:
+                self.capture.record(hub.id, data, timestamp)
+            # Only describe the message if the hub's logger will show it,
+            # since formatting the description costs more than parsing it
+            if hub.logger.isEnabledFor(logging.DEBUG):
+                hub.message_debug(f'Bleak Raw data received: {data}')
+                for msg in msg_parser.feed(data):
+                    hub.message_debug('{0} Received: {1}'.format(hub.name, msg))
+            else:
+                msg_parser.feed(data, describe=False)
 
+        hub.ingress = NotificationIngress(hub.name, bleak_received)
         device, char_uuid = hub.tx
-        await device.start_notify(char_uuid, bleak_received)
+        await device.start_notify(char_uuid, hub.ingress.received)
 
 
     def _check_devices_for(self, devices, name, manufacturer_id, address):
@@ -113,8 +219,86 @@ class BLEventQ(Process):
 
         return None
 
-    async def _ble_connect(self, uart_uuid, ble_name, ble_manufacturer_id, ble_id=None, timeout=60):
-        """Connect to the underlying BLE device with the needed UART UUID
+    async def _discover(self, adapter):
+        """Run a single BLE discovery scan on one adapter
+
+           Returns:
+              devices (list) : Advertised devices seen during the scan, with their `adapter` set
+        """
+        self.message_debug(f'Awaiting on discover ({adapter.name or "default adapter"})')
+        adapter.scans += 1
+        devices = await adapter.transport.discover(timeout=1)
+        for device in devices:
+            device.adapter = adapter
+        self.message_debug('Done Awaiting on discover')
+        return devices
+
+    async def _scan_loop(self):
+        """Keep scanning while any hub is waiting to be discovered
+
+           One scan serves every pending hub, so the startup time no longer
+           grows with the number of hubs being connected.  Every adapter that
+           a pending hub could use scans at the same time.
+        """
+        try:
+            while len(self.pending_discovery) > 0:
+                pins = set(r.adapter for r in self.pending_discovery)
+                adapters = self._usable_adapters() if None in pins else \
+                           [a for a in self._usable_adapters() if a.name in pins]
+                scans = await gather(*[self._discover(a) for a in adapters])
+                self._match_pending([d for devices in scans for d in devices])
+        finally:
+            self.scan_task = None
+
+    def _match_pending(self, devices):
+        """Match the devices from one scan against all the hubs waiting for discovery
+
+           Requests for a specific hub id get first pick, so that a hub that
+           connects to the first matching device can't steal it.  Likewise, hubs
+           pinned to an adapter go before hubs that can use any.  Every matched
+           device is claimed so that no other hub will try to connect to it.
+
+           A device seen by several adapters is connected through the least
+           loaded one (or the one its hub is pinned to).
+        """
+        for request in sorted(self.pending_discovery, key=lambda r: (r.ble_id is None, r.adapter is None)):
+            if request.future.done():
+                # Caller gave up (cancelled) on this request
+                self.pending_discovery.remove(request)
+                continue
+            # Filter out no-matching uuid, devices already taken by another hub,
+            # and adapters that are full (or that the hub isn't pinned to)
+            usable = self._usable_adapters(request.adapter)
+            candidates = [d for d in devices if str(request.uart_uuid) in d.uuids
+                                                and d.address not in self.claimed_addresses
+                                                and d.adapter in usable]
+            candidates.sort(key=lambda d: d.adapter.load)
+            device = self._check_devices_for(candidates, request.ble_name, request.manufacturer_id, request.ble_id)
+            if device:
+                self._claim(device.address, device.adapter)
+                self.pending_discovery.remove(request)
+                request.future.set_result(device)
+            else:
+                request.tries -= 1
+                self.message(f'Rescanning for {request.uart_uuid} ({request.tries} tries left)')
+                if len(usable) == 0:
+                    self.pending_discovery.remove(request)
+                    request.future.set_exception(RuntimeError(f'No BLE adapter with a free connection for {request.ble_name}'))
+                elif request.tries <= 0:
+                    self.pending_discovery.remove(request)
+                    request.future.set_exception(RuntimeError('Failed to find UART device!'))
+
+    async def _ble_connect(self, uart_uuid, ble_name, ble_manufacturer_id, ble_id=None, timeout=60, adapter=None):
+        """Find the underlying BLE device with the needed UART UUID
+
+           The request is added to the shared discovery scan, which is started
+           if it is not already running.
+
+           Args:
+              adapter (str) : Only look through this adapter (None for any)
+
+           Returns:
+              device : The matching advertised device (claimed for this caller, on `device.adapter`)
         """
         # Set hub.ble_id to a specific hub id if you want it to connect to a
         # particular hardware hub instance
@@ -123,37 +307,64 @@ class BLEventQ(Process):
         else:
             self.message_info(f'Looking for first matching hub')
 
+        request = DiscoveryRequest(uart_uuid, ble_name, ble_manufacturer_id, ble_id, timeout, adapter)
+        self.pending_discovery.append(request)
+
         # Start discovery
+        if self.scan_task is None:
+            self.scan_task = spawn(self._scan_loop())
+        try:
+            return await request.future
+        finally:
+            if request in self.pending_discovery:
+                self.pending_discovery.remove(request)
 
-        found = False
-        while not found and timeout > 0:
-            print('Awaiting on bleak discover')
-            devices = await bleak.discover(timeout=1)
-            print('Done Awaiting on bleak discover')
-            # Filter out no-matching uuid
-            devices = [d for d in devices if str(uart_uuid) in d.metadata['uuids']]
-            # Now, extract the manufacturer_id
-            for device in devices:
-                assert len(device.metadata['manufacturer_data']) == 1
-                data = next(iter(device.metadata['manufacturer_data'].values())) # Get the one and only key
-                device.manufacturer_id = data[1]
-
-            device = self._check_devices_for(devices, ble_name, ble_manufacturer_id,  ble_id)
-            if device:
-                self.device = device
-                found = True
-            else:
-                self.message(f'Rescanning for {uart_uuid} ({timeout} tries left)')
-                timeout -= 1
-                self.device = None
-                await sleep(1)
-        if self.device is None:
-            raise RuntimeError('Failed to find UART device!')
 
+    async def _connect_client(self, address):
+        """Create and connect a transport client to an already claimed address
 
-    async def connect(self, hub):
-        self.message(f'Starting scan for UART {hub.uart_uuid}')
+           The client is created by the adapter the address was claimed on.
+        """
+        adapter = self.claimed_addresses[address]
+        adapter.connects += 1
+        device = adapter.transport.client(address)
+        try:
+            await device.connect()
+        except BaseException:
+            adapter.failures += 1
+            self._release(address)
+            raise
+        return device
 
+    async def _connect_cached(self, hub, ble_id):
+        """Try connecting directly to the address cached for this hub
+
+           Returns:
+              (device, address, name) or None if there's no usable cache entry
+        """
+        cache = self.discovery_cache
+        usable = self._usable_adapters(hub.adapter)
+        if len(usable) == 0:
+            return None
+        cached = cache.lookup(hub.ble_name, hub.manufacturer_id, ble_id, exclude=self.claimed_addresses)
+        if cached is None:
+            return None
+        address, name = cached
+        self.message_info(f'Connecting to cached address {address} for {hub.name}')
+        self._claim(address, usable[0])
+        try:
+            device = await wait_for(self._connect_client(address), cache.connect_timeout)
+        except CancelledError:
+            raise
+        except Exception as e:
+            self._release(address)
+            self.message_info(f'Cached address {address} is stale ({e!r}), falling back to a scan')
+            cache.invalidate(hub.ble_name, hub.manufacturer_id, ble_id, address)
+            return None
+        cache.store(hub.ble_name, hub.manufacturer_id, ble_id, address, name)
+        return device, address, name
+
+    async def connect(self, hub):
         # HACK
         try:
             ble_id = uuid.UUID(hub.ble_id) if hub.ble_id else None
@@ -162,36 +373,129 @@ class BLEventQ(Process):
             self.message_info(f"ble_id {hub.ble_id} is not a parseable UUID, so assuming it's a BLE network addresss")
             ble_id = hub.ble_id
 
-        await self._ble_connect(hub.uart_uuid, hub.ble_name, hub.manufacturer_id, ble_id)
+        connected = None
+        if self.discovery_cache is not None:
+            connected = await self._connect_cached(hub, ble_id)
 
-        self.message(f"found device {self.device.name}")
-
-
-        device = bleak.BleakClient(address_or_ble_device=self.device.address)
+        if connected:
+            device, address, name = connected
+        else:
+            self.message(f'Starting scan for UART {hub.uart_uuid}')
+            ble_device = await self._ble_connect(hub.uart_uuid, hub.ble_name, hub.manufacturer_id, ble_id,
+                                                 adapter=hub.adapter)
+            self.message(f"found device {ble_device.name}")
+            address, name = ble_device.address, ble_device.name
+            device = await self._connect_client(address)
+            if self.discovery_cache is not None:
+                self.discovery_cache.store(hub.ble_name, hub.manufacturer_id, ble_id, address, name)
+
+        await self._attach_client(hub, device, address, name)
+
+    async def _attach_client(self, hub, device, address, name):
+        """Make a freshly connected client the link to `hub` and start receiving its messages"""
         self.devices.append(device)
-        await device.connect()
 
-        hub.ble_id = self.device.address
-        self.message_info(f'Device advertised: {device.services.characteristics}')
+        hub.ble_id = address
+        hub.ble_adapter = self.claimed_addresses[address]
+        self.message_info(f'Device advertised: {device.describe()}')
         hub.tx = (device, hub.char_uuid)
-        # Hack to fix device name on Windows
-        if self.device.name == "Unknown" and hasattr(device._requester, 'Name'):
-            self.device.name = device._requester.Name
+        if name == "Unknown" and device.name:
+            name = device.name
+        hub.ble_device_name = name
 
-        self.message_info(f"Connected to device {self.device.name}:{hub.ble_id}")
+        device.set_disconnected_callback(lambda client: self._link_lost(hub, client))
+
+        self.message_info(f"Connected to device {name}:{hub.ble_id}")
         self.hubs[hub.ble_id] = hub
 
         await self.get_messages(hub)
 
+    def _link_lost(self, hub, device):
+        """Called by the transport when a link drops
+
+           Nothing to do if we disconnected on purpose (:meth:`disconnect` clears `hub.tx` first).
+           Otherwise, drop the dead link and start reconnecting if the hub asked for it.
+        """
+        if hub.tx is None or hub.tx[0] is not device:
+            return
+        self.message_error(f'Lost connection to {hub.name} ({hub.ble_id})')
+        hub.tx = None
+        hub.disconnects += 1
+        self.hubs.pop(hub.ble_id, None)
+        if device in self.devices:
+            self.devices.remove(device)
+        hub.link_lost()
+        if hub.auto_reconnect:
+            if hub not in self.reconnect_tasks:
+                self.reconnect_tasks[hub] = spawn(self._reconnect(hub, time.monotonic()))
+        else:
+            self._release(hub.ble_id)
+
+    async def _reconnect(self, hub, lost_at, timeout=10, max_backoff=8):
+        """Keep trying to reconnect to the hub's last address
+
+           The hub re-sends its Attached I/O messages once connected, which
+           makes it re-activate updates on every peripheral and restore their
+           last commanded outputs (see :meth:`bricknil.hub.Hub.recv_message`).
+           The address stays claimed on the same adapter the whole time.
+        """
+        address = hub.ble_id
+        adapter = hub.ble_adapter
+        backoff = 0.5
+        try:
+            while True:
+                self.message_info(f'Reconnecting to {hub.name} at {address}')
+                try:
+                    device = await wait_for(self._connect_client(address), timeout)
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    self._claim(address, adapter)
+                    self.message_info(f'Reconnect to {hub.name} failed ({e!r}), retrying in {backoff}s')
+                    await sleep(backoff)
+                    backoff = min(backoff*2, max_backoff)
+                    continue
+                await self._attach_client(hub, device, address, hub.ble_device_name)
+                latency = time.monotonic() - lost_at
+                hub.reconnect_latencies.append(latency)
+                self.message_info(f'Reconnected to {hub.name} after {latency:.2f}s')
+                return
+        finally:
+            del self.reconnect_tasks[hub]
+
     async def disconnect(self, hub):
+        reconnect = self.reconnect_tasks.get(hub)
+        if reconnect is not None:
+            reconnect.cancel()
+            self._release(hub.ble_id)
         if hub.tx == None:
             return
         device = hub.tx[0]
         hub.tx = None
         await device.disconnect()
+        if self.capture is not None:
+            self.capture.flush()
         del self.hubs[hub.ble_id]
+        self._release(hub.ble_id)
         self.devices.remove(device)
 
+class DiscoveryRequest:
+    """A hub waiting on the shared discovery scan
+
+       Attributes:
+          tries (int) : Number of scans left before giving up on this hub
+          adapter (str) : Name of the adapter the hub is pinned to (None for any)
+          future (`asyncio.Future`) : Resolves to the matched device
+    """
+    def __init__(self, uart_uuid, ble_name, manufacturer_id, ble_id, tries, adapter=None):
+        self.uart_uuid = uart_uuid
+        self.ble_name = ble_name
+        self.manufacturer_id = manufacturer_id
+        self.ble_id = ble_id
+        self.tries = tries
+        self.adapter = adapter
+        self.future = get_event_loop().create_future()
+
 if BLEventQ.instance == None:
     BLEventQ.instance = BLEventQ()
 
@@ -22,7 +22,7 @@
 
 import logging
 import pprint
-from asyncio import run, sleep, Queue, get_event_loop, all_tasks
+from asyncio import run, sleep, Queue, get_event_loop, all_tasks, gather
 from asyncio import create_task as spawn
 from functools import partial, wraps
 import uuid
@@ -54,17 +54,21 @@ class attach:
                     port='port',
                     capabilities=[])
 
+        `handler_policy` sets how the hub runs the peripheral's change handler
+        (see :class:`bricknil.handlers.HandlerPolicy`).
+
         Warnings:
             - No support for checking to make sure user put in correct parameters
             - Identifies capabilities that need a callback update handler based purely on
               checking if the capability name starts with the string "sense*"
 
     """
-    def __init__(self, peripheral_type, **kwargs):
+    def __init__(self, peripheral_type, handler_policy=None, **kwargs):
         # TODO: check here to make sure parameters were entered
         if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
             print(f'decorating with {peripheral_type}')
         self.peripheral_type = peripheral_type
+        self.handler_policy = handler_policy
         self.kwargs = kwargs
 
     def __call__ (self, cls):
@@ -88,6 +92,8 @@ class attach:
         def wrapper_f(*args, **kwargs):
             #print(f'type of cls is {type(cls)}')
             peripheral = self.peripheral_type(**self.kwargs)
+            if self.handler_policy is not None:
+                peripheral.handler_policy = self.handler_policy
             o = cls(*args, **kwargs)
             o.message_debug(f"Decorating class {cls.__name__} with {self.peripheral_type.__name__}")
             o.attach_sensor(peripheral)
@@ -110,9 +116,9 @@ async def main(system):
 
         hub_tasks = []
 
-        # Connect all the hubs first before enabling any of them
-        for hub in Hub.hubs:
-            await hub.connect()
+        # Connect all the hubs first before enabling any of them.  The hubs
+        # share one discovery scan and connect concurrently
+        await gather(*[hub.connect() for hub in Hub.hubs])
 
         # Start each hub
         for hub in Hub.hubs:
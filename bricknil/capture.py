@@ -0,0 +1,232 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Record the notifications hubs send, and replay them later
+
+To record, set a :class:`CaptureWriter` before calling :func:`bricknil.start`::
+
+    from bricknil.ble_queue import BLEventQ
+    from bricknil.capture import CaptureWriter
+
+    BLEventQ.instance.capture = CaptureWriter('session.cap')
+
+A :class:`Replayer` feeds a capture back through the hubs' parser,
+peripherals and `*_change` handlers, without any BLE link, either with the
+original timing or as fast as possible.  To print what's in a capture::
+
+    python -m bricknil.capture session.cap
+
+File format (little-endian), append-only:
+
+    * Header: the 8 bytes `MAGIC`
+    * One record per notification: timestamp (double, seconds), hub id
+      (uint16, :attr:`bricknil.process.Process.id` of the hub), length (uint16),
+      followed by the raw notification bytes
+"""
+import os, sys, time, struct
+from asyncio import sleep
+
+from .process import Process
+from .message_dispatch import MessageDispatch
+
+MAGIC = b'BNILCAP1'
+RECORD = struct.Struct('<dHH')
+
+class CaptureFormatError(Exception):
+    """The file isn't a capture, or is truncated mid-record"""
+    pass
+
+class CaptureWriter:
+    """Appends notifications to a capture file
+
+       Args:
+          path (str) : Capture file (appended to if it already exists)
+
+       Attributes:
+          records (int) : Notifications written by this writer
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise CaptureFormatError(f'{path} is not a capture file')
+        self.file = open(path, 'ab')
+        if not exists:
+            self.file.write(MAGIC)
+
+    def record(self, hub_id, data, timestamp=None):
+        """Append one notification (`timestamp` defaults to now, from `time.monotonic()`)"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.file.write(RECORD.pack(timestamp, hub_id, len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_capture(path):
+    """Yield (timestamp, hub id, data) for each notification in a capture file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureFormatError(f'{path} is not a capture file')
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise CaptureFormatError(f'{path} ends in the middle of a record')
+            timestamp, hub_id, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise CaptureFormatError(f'{path} ends in the middle of a record')
+            yield timestamp, hub_id, data
+
+
+class ReplayLink:
+    """Stands in for the BLE characteristic of replayed hubs, and keeps what they send
+
+       Attributes:
+          written (list [bytes]) : Commands the hub sent during the replay
+    """
+    def __init__(self, hub):
+        self.hub = hub
+        self.written = []
+
+    async def write(self, char_uuid, data, response=True):
+        self.written.append(bytes(data))
+
+
+class Replayer(Process):
+    """Drives a capture through hubs' message parsing and handling
+
+       Each notification is parsed, and the events it produces are taken off the
+       hub's :attr:`bricknil.hub.Hub.peripheral_queue` and handled (updating
+       peripherals and calling the hub's `*_change` methods, waiting for the
+       handler tasks to finish) before the next notification goes in, so a
+       replay always does the same work.
+
+       Args:
+          path (str) : Capture file
+          hubs (dict or list) : Hub id in the capture -> :class:`bricknil.hub.Hub`, or a list of hubs
+              to match up with the capture's hub ids in the order they first appear
+          realtime (bool) : Keep the original spacing between notifications (otherwise go as fast as possible)
+          speed (float) : With `realtime`, play back this many times faster than recorded
+
+       Attributes:
+          links (dict) : Hub -> :class:`ReplayLink` with the commands it sent
+          replayed (int) : Notifications replayed
+          skipped (int) : Notifications from hubs that weren't given
+          elapsed (float) : Seconds the last :meth:`run` took
+    """
+    def __init__(self, path, hubs, realtime=False, speed=1.0):
+        super().__init__('Replayer')
+        self.path = path
+        self.hubs = hubs
+        self.realtime = realtime
+        self.speed = speed
+        self.links = {}
+        self.replayed = 0
+        self.skipped = 0
+        self.elapsed = 0
+
+    def _hub_for(self, hub_id, parsers):
+        if hub_id not in parsers:
+            if isinstance(self.hubs, dict):
+                hub = self.hubs.get(hub_id)
+            else:
+                hub = self.hubs[len(parsers)] if len(parsers) < len(self.hubs) else None
+            parsers[hub_id] = self._attach(hub) if hub is not None else None
+        return parsers[hub_id]
+
+    def _attach(self, hub):
+        """Give the hub a fake link for whatever it sends while handling the replay"""
+        link = self.links[hub] = ReplayLink(hub)
+        hub.tx = (link, hub.char_uuid)
+        hub.outbound.start()
+        return MessageDispatch(hub)
+
+    async def run(self):
+        """Replay the whole capture"""
+        parsers = {}
+        start = time.monotonic()
+        first = None
+        for timestamp, hub_id, data in read_capture(self.path):
+            parser = self._hub_for(hub_id, parsers)
+            if parser is None:
+                self.skipped += 1
+                continue
+            if self.realtime:
+                if first is None:
+                    first = timestamp
+                delay = start + (timestamp - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    await sleep(delay)
+            parser.feed(data, describe=False)
+            self.replayed += 1
+            queue = parser.hub.peripheral_queue
+            while not queue.empty():
+                await parser.hub.recv_message(queue.get_nowait())
+            await parser.hub.join_handlers()
+        for hub in self.links:
+            # Let the writer hand over what's left, then stop it and the handlers
+            await hub.outbound.drain()
+            hub.outbound.stop()
+            for runner in hub.handlers.values():
+                runner.stop()
+        self.elapsed = time.monotonic() - start
+        self.message_info(f'Replayed {self.replayed} notifications in {self.elapsed:.3f}s')
+
+
+class _DescribeOnly:
+    """Stand-in hub for describing notifications without handling them"""
+    class _Queue:
+        def put_nowait(self, event):
+            pass
+    peripheral_queue = _Queue()
+    def port_output_feedback(self, port, feedback):
+        pass
+
+
+def main(argv=None):
+    """Print every notification in a capture, with its parsed description"""
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print('Usage: python -m bricknil.capture <capture file>')
+        return 1
+    parsers = {}
+    first = None
+    for timestamp, hub_id, data in read_capture(argv[0]):
+        if first is None:
+            first = timestamp
+        parser = parsers.setdefault(hub_id, MessageDispatch(_DescribeOnly()))
+        for description in parser.feed(data):
+            print(f'{timestamp-first:10.4f} hub {hub_id}: {description}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
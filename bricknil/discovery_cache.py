@@ -0,0 +1,120 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of resolved hub addresses
+
+Lets :class:`bricknil.ble_queue.BLEventQ` connect straight to a hub it has
+seen before, instead of waiting on a discovery scan.  Enable it before
+calling :func:`bricknil.start`::
+
+    from bricknil.ble_queue import BLEventQ
+    from bricknil.discovery_cache import DiscoveryCache
+
+    BLEventQ.instance.discovery_cache = DiscoveryCache()
+
+Entries are keyed by the hub's `ble_name`, `manufacturer_id` and `ble_id`.
+An entry is dropped when:
+
+    * it is older than `max_age` seconds, or
+    * connecting directly to the cached address fails (the hub was
+      probably swapped for another one, or is powered off), in which case
+      the caller falls back to a normal scan.
+"""
+import os, json, time, logging
+
+logger = logging.getLogger(__name__)
+
+class DiscoveryCache:
+    """Map of hub identity -> BLE addresses resolved by previous runs
+
+       Args:
+          path (str) : JSON file to keep the cache in (default `~/.bricknil/discovery_cache.json`)
+          max_age (float) : Seconds after which an entry is considered stale
+          connect_timeout (float) : Seconds to wait on a direct connect before falling back to a scan
+
+       Attributes:
+          hits (int) : Lookups that returned a cached address
+          misses (int) : Lookups with no usable entry
+          stale (int) : Cached addresses that failed to connect and were invalidated
+    """
+    def __init__(self, path=None, max_age=7*24*3600, connect_timeout=5):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bricknil', 'discovery_cache.json')
+        self.path = path
+        self.max_age = max_age
+        self.connect_timeout = connect_timeout
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f'Could not write discovery cache {self.path}: {e}')
+
+    def _key(self, ble_name, manufacturer_id, ble_id):
+        return f'{ble_name}|{manufacturer_id}|{ble_id if ble_id else ""}'
+
+    def lookup(self, ble_name, manufacturer_id, ble_id=None, exclude=()):
+        """Return the most recently used (address, name) for this hub identity
+
+           Args:
+              exclude (set) : Addresses that can't be returned (already in use by another hub)
+
+           Returns:
+              (address, name) or None on a miss
+        """
+        now = time.time()
+        devices = self.entries.get(self._key(ble_name, manufacturer_id, ble_id), [])
+        fresh = [d for d in devices if now - d['last_seen'] <= self.max_age]
+        if len(fresh) != len(devices):
+            self.entries[self._key(ble_name, manufacturer_id, ble_id)] = fresh
+            self._save()
+        for device in fresh:
+            if device['address'] not in exclude:
+                self.hits += 1
+                return device['address'], device['name']
+        self.misses += 1
+        return None
+
+    def store(self, ble_name, manufacturer_id, ble_id, address, name):
+        """Record (or refresh) the address a hub identity resolved to"""
+        key = self._key(ble_name, manufacturer_id, ble_id)
+        devices = [d for d in self.entries.get(key, []) if d['address'] != address]
+        devices.insert(0, {'address': address, 'name': name, 'last_seen': time.time()})
+        self.entries[key] = devices
+        self._save()
+
+    def invalidate(self, ble_name, manufacturer_id, ble_id, address):
+        """Drop a cached address that could not be connected to"""
+        key = self._key(ble_name, manufacturer_id, ble_id)
+        self.entries[key] = [d for d in self.entries.get(key, []) if d['address'] != address]
+        self.stale += 1
+        self._save()
@@ -0,0 +1,146 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Message framing of the LEGO wireless protocol
+
+Every message starts with its total length (header included), then the hub
+id (always 0) and the message type.  Lengths up to 127 take one byte;
+longer messages set bit 7 of the first byte and put the rest of the length
+in a second byte (`length = (b0 & 0x7F) | (b1 << 7)`).
+
+A notification doesn't have to hold exactly one message: a hub can pack
+several messages into one notification, and a message longer than the
+link's MTU arrives split over several.  :class:`FrameAssembler` turns
+notifications back into messages.  Every message comes out as a
+`memoryview`, so the parsers' payload slices don't copy.  A message that's
+wholly inside one notification is a view of it, and only the bytes of a
+message split across notifications are copied, to put it back together.
+Each link to a hub gets its own assembler (see
+:meth:`bricknil.ble_queue.BLEventQ.get_messages`), so a message cut short
+by a dropped link never runs into the first message of the next one.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_SHORT_LENGTH = 0x7F
+MAX_LENGTH = 0x7FFF
+
+def frame(body):
+    """Prepend the length header to `body` (hub id, message type and payload)
+
+       Returns:
+          bytearray : The message, ready to write
+    """
+    length = len(body) + 1
+    if length <= MAX_SHORT_LENGTH:
+        return bytearray([length]) + bytearray(body)
+    length += 1
+    if length > MAX_LENGTH:
+        raise ValueError(f'Message of {length} bytes is too long to frame')
+    return bytearray([0x80 | (length & 0x7F), length >> 7]) + bytearray(body)
+
+def read_length(msg, offset=0):
+    """Return (message length, length bytes) of the message starting at `offset`
+
+       Returns None if the second length byte hasn't arrived yet.
+    """
+    b0 = msg[offset]
+    if not b0 & 0x80:
+        return b0, 1
+    if offset + 1 >= len(msg):
+        return None
+    return (b0 & 0x7F) | (msg[offset+1] << 7), 2
+
+
+class FrameAssembler:
+    """Splits notifications into messages, and reassembles messages split across notifications
+
+       Attributes:
+          messages (int) : Messages produced
+          reassembled (int) : Messages that were put back together from several notifications
+          malformed (int) : Notifications (or the rest of one) dropped because of an impossible length
+    """
+    def __init__(self):
+        self.partial = None         # bytearray of a message still missing bytes
+        self.messages = 0
+        self.reassembled = 0
+        self.malformed = 0
+
+    def feed(self, data):
+        """Return the list of complete messages in notification `data`
+
+           Messages are `memoryview` slices of `data`, except for ones
+           completed by this notification, which are views of a new `bytearray`.
+        """
+        if self.partial is None and data and len(data) == data[0] <= MAX_SHORT_LENGTH:
+            # Usual case: the notification is exactly one message
+            self.messages += 1
+            return [memoryview(data)]
+        messages = []
+        view = memoryview(data)
+        offset = 0
+        end = len(view)
+        if self.partial is not None:
+            offset = self._complete(view)
+            if offset is None:
+                return messages
+            messages.append(memoryview(self.partial))
+            self.partial = None
+            self.reassembled += 1
+        while offset < end:
+            header = read_length(view, offset)
+            if header is None or offset + header[0] > end:
+                # The rest of this message comes in later notifications
+                self.partial = bytearray(view[offset:])
+                break
+            length, size = header
+            if length < size + 2:
+                self._malformed(view, offset)
+                break
+            messages.append(view[offset:offset+length])
+            offset += length
+        self.messages += len(messages)
+        return messages
+
+    def _complete(self, view):
+        """Add the start of `view` to the partial message
+
+           Returns:
+              int : Offset in `view` just past the completed message (None if it's still incomplete)
+        """
+        partial = self.partial
+        taken = 0
+        header = read_length(partial)
+        if header is None:
+            # Need the second length byte before knowing how much to take
+            if len(view) == 0:
+                return None
+            partial.append(view[0])
+            taken = 1
+            header = read_length(partial)
+        length, size = header
+        if length < size + 2:
+            self._malformed(view, 0)
+            return None
+        needed = length - len(partial)
+        partial.extend(view[taken:taken+needed])
+        if len(partial) < length:
+            return None
+        return taken + needed
+
+    def _malformed(self, view, offset):
+        logger.error(f'Dropping {len(view) - offset} bytes with an impossible message length: {bytes(view[offset:]).hex()}')
+        self.partial = None
+        self.malformed += 1
@@ -0,0 +1,204 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""How a hub runs the `<name>_change` handlers of its peripherals
+
+Each peripheral's handler runs on a task of its own, so a slow handler
+(like one that ramps a motor) only holds up readings of that peripheral,
+not of every other peripheral on the hub.  The peripheral's
+:attr:`bricknil.sensor.peripheral.Peripheral.handler_policy` says what
+happens to readings that arrive while its handler is still running:
+
+    * ``'serial'`` (the default): readings wait their turn and are handled
+      in order, like the hub used to do inline.  Like the hub's mailbox, at
+      most `mailbox_depth` readings wait and the oldest is skipped to make
+      room, so with the default depth of 1 a slow handler skips readings.
+      Peripherals with a depth of None, like buttons, have every reading
+      handled.
+    * ``'latest'``: only the newest reading waits; older ones are skipped.
+      With `cancel=True`, a newer reading also cancels the handler that's
+      running for a stale one.
+    * ``'concurrent'``: each reading starts its own handler right away,
+      with at most `limit` running at once (further readings are skipped
+      until one finishes).
+
+Set it in :class:`bricknil.attach`::
+
+    @attach(ExternalMotor, name='motor', capabilities=['sense_pos'],
+            handler_policy=HandlerPolicy('latest', cancel=True))
+
+For serial and latest, a reading updates the peripheral's value right
+before its handler runs, so the handler sees the reading it was called for.
+Concurrent handlers share the peripheral, so readings update it as they
+arrive.
+"""
+import time
+from collections import deque
+from asyncio import CancelledError, create_task as spawn
+
+from .process import Process, LoopEvent, latency_stats
+
+class HandlerPolicy:
+    """How to run a peripheral's handler when readings arrive faster than it finishes
+
+       Args:
+          mode (str) : 'serial', 'latest' or 'concurrent'
+          limit (int) : With 'concurrent', most handlers running at once
+          cancel (bool) : With 'latest', cancel a running handler when a newer reading arrives
+    """
+    MODES = ('serial', 'latest', 'concurrent')
+
+    def __init__(self, mode='serial', limit=4, cancel=False):
+        assert mode in self.MODES, f'Unknown handler policy {mode} (must be one of {self.MODES})'
+        assert limit >= 1, 'Concurrent handler limit must be at least 1'
+        self.mode = mode
+        self.limit = limit
+        self.cancel = cancel
+
+    @classmethod
+    def of(cls, policy):
+        """Return `policy` as a :class:`HandlerPolicy` (it can be given as just the mode)"""
+        return policy if isinstance(policy, HandlerPolicy) else cls(policy)
+
+    def __repr__(self):
+        return f'HandlerPolicy({self.mode!r}, limit={self.limit}, cancel={self.cancel})'
+
+
+class HandlerRunner(Process):
+    """Runs one peripheral's handler on its own task(s), following its :class:`HandlerPolicy`
+
+       Args:
+          peripheral (:class:`bricknil.sensor.peripheral.Peripheral`) : Peripheral whose readings are handled
+          handler (coroutine function) : The hub's `<name>_change` method
+
+       Attributes:
+          policy (:class:`HandlerPolicy`) : How the handler is run
+          runs (int) : Handler invocations that finished
+          skipped (int) : Readings whose handler never ran (superseded, or no slot free)
+          cancelled (int) : Handler invocations cancelled by a newer reading
+          errors (int) : Handler invocations that raised an exception
+          latencies (`collections.deque` [float]) : Seconds from each reading's arrival to its handler finishing,
+              for the most recent invocations
+    """
+    def __init__(self, peripheral, handler):
+        super().__init__(f'{peripheral.name} handler')
+        self.peripheral = peripheral
+        self.handler = handler
+        self.policy = HandlerPolicy.of(peripheral.handler_policy)
+        self.depth = 1 if self.policy.mode == 'latest' else peripheral.mailbox_depth
+        self.waiting = deque()         # (reading, arrival time) for serial and latest
+        self.running = set()           # Tasks running the handler
+        self.worker = None
+        self.current = None            # Task of the handler call the worker is awaiting
+        self.stopped = False
+        self.runs = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+        self._wakeup = LoopEvent()
+        self._idle = LoopEvent()
+        self._idle.set()
+
+    async def submit(self, reading):
+        """Hand over a reading from the hub's message loop (returns without waiting for the handler)"""
+        arrived = time.monotonic()
+        if self.policy.mode == 'concurrent':
+            await self.peripheral.update_value(reading)
+            if len(self.running) >= self.policy.limit:
+                self.skipped += 1
+                return
+            self._idle.clear()
+            task = spawn(self._call(arrived))
+            self.running.add(task)
+            task.add_done_callback(self._finished)
+            return
+        if self.depth is not None and len(self.waiting) >= self.depth:
+            self.waiting.popleft()
+            self.skipped += 1
+        self.waiting.append((reading, arrived))
+        if self.policy.cancel and self.current is not None:
+            self.current.cancel()
+        self._idle.clear()
+        self._wakeup.set()
+        if self.worker is None:
+            self.worker = spawn(self._work())
+
+    async def _work(self):
+        """Handle waiting readings one at a time, in order"""
+        try:
+            while True:
+                while not self.waiting:
+                    self._idle.set()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                reading, arrived = self.waiting.popleft()
+                try:
+                    await self.peripheral.update_value(reading)
+                except Exception as e:
+                    self.errors += 1
+                    self.message_error(f'Could not update {self.peripheral.name} with {bytes(reading)}: {e!r}')
+                    continue
+                if self.policy.cancel:
+                    self.current = spawn(self._call(arrived))
+                    try:
+                        await self.current
+                    except CancelledError:
+                        if self.stopped:
+                            raise
+                        self.cancelled += 1
+                    self.current = None
+                else:
+                    await self._call(arrived)
+        except CancelledError:
+            pass
+
+    async def _call(self, arrived):
+        try:
+            await self.handler()
+        except CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self.message_error(f'Handler for {self.peripheral.name} failed: {e!r}')
+            return
+        self.runs += 1
+        self.latencies.append(time.monotonic() - arrived)
+
+    def _finished(self, task):
+        self.running.discard(task)
+        if not self.running:
+            self._idle.set()
+
+    async def join(self):
+        """Wait until every reading handed over so far has been handled (or skipped)"""
+        await self._idle.wait()
+
+    def stop(self):
+        """Cancel the worker and every running handler"""
+        self.stopped = True
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        for task in list(self.running):
+            task.cancel()
+        self.waiting.clear()
+        self._idle.set()
+
+    def stats(self):
+        """Return the invocation counts and latency percentiles (in seconds, see
+           :func:`bricknil.process.latency_stats`) as a dict
+        """
+        return dict(policy=self.policy.mode, runs=self.runs, skipped=self.skipped,
+                    cancelled=self.cancelled, errors=self.errors, **latency_stats(self.latencies))
@@ -16,14 +16,28 @@
 
 """
 import uuid
-from asyncio import sleep, Queue, CancelledError, create_task as spawn
-from .process import Process
+from collections import deque
+from asyncio import gather, wait_for, CancelledError, TimeoutError, create_task as spawn
+from .process import Process, LoopEvent
 from .sensor.peripheral import Peripheral  # for type check
 from .ble_queue import BLEventQ
+from .outbound import OutboundQueue
+from .mailbox import PeripheralMailbox, PeripheralEvent
+from .handlers import HandlerRunner
 
 class UnknownPeripheralMessage(Exception): pass
 class DifferentPeripheralOnPortError(Exception): pass
 
+class PeripheralsNotAttachedError(Exception):
+    """Some peripherals didn't attach to the hub within its `attach_timeout`
+
+       Attributes:
+          missing (list [str]) : Names of the peripherals that never attached
+    """
+    def __init__(self, hub, missing):
+        super().__init__(f'{hub}: peripherals never attached: {", ".join(missing)}')
+        self.missing = missing
+
 # noinspection SpellCheckingInspection
 class Hub(Process):
     """Base class for all Lego hubs
@@ -32,36 +46,75 @@ class Hub(Process):
             name (str) : Human-readable name for this hub (for logging)
             query_port_info (bool) : Set to True if you want to query all the port information on a Hub (very communication intensive)
             ble_id (str) : BluetoothLE network(MAC) adddress to connect to (None if you want to connect to the first matching hub)
+            flow_control (bool) : Pace port output commands using the hub's command feedback, so ports are kept
+                busy without overrunning the hub's command buffer (see :class:`bricknil.outbound.OutboundQueue`)
+            auto_reconnect (bool) : Reconnect automatically if the link to the hub drops.  Peripherals
+                re-activate their updates and restore their last commanded outputs once the hub re-attaches them
+            adapter (str) : Name of the BLE adapter to connect through (None to use the least loaded
+                one, see :meth:`bricknil.ble_queue.BLEventQ.add_adapter`)
+            port_info_cache (`bricknil.port_info_cache.PortInfoCache`) : With `query_port_info`, reuse the port
+                information of devices seen before instead of querying them
+            attach_timeout (float) : Seconds :meth:`connect` waits for the required peripherals to attach before
+                raising :class:`PeripheralsNotAttachedError` (None to wait forever)
 
        Attributes:
 
             hubs (list [`Hub`]) : Class attr to keep track of all Hub (and subclasses) instances
             ble_handler (`BLEventQ`) : Hub's Bluetooth LE handling object
-            peripheral_queue (`asyncio.Queue`) : Incoming messages from :class:`bricknil.ble_queue.BLEventQ`
+            peripheral_queue (`bricknil.mailbox.PeripheralMailbox`) : Incoming messages from :class:`bricknil.ble_queue.BLEventQ`,
+                keeping only the newest readings of each peripheral (see :attr:`bricknil.sensor.peripheral.Peripheral.mailbox_depth`)
             peripheral_task: (`asyncio.Task`) : Task processing incoming messages from `peripheral_queue`
             uart_uuid (`uuid.UUID`) : UUID broadcast by LEGO UARTs
             char_uuid (`uuid.UUID`) : Lego uses only one service characteristic for communicating with the UART services
             tx : Service characteristic for tx/rx messages that's set by :func:`bricknil.ble_queue.BLEventQ.connect`
+                (None while there's no link)
+            link_ready (`bricknil.process.LoopEvent`) : Set while :attr:`tx` is, so commands can wait for the link
+            outbound (`bricknil.outbound.OutboundQueue`) : Commands waiting to be written to the hub
+            ingress (`bricknil.ingress.NotificationIngress`) : Notifications from the hub waiting to be parsed
+                (set once connected)
             peripherals (dict) : Peripheral name => `bricknil.Peripheral`
             port_to_peripheral (dict): Port number(int) -> `bricknil.Peripheral`
+            port_dispatch (dict): Port number(int) -> (`bricknil.Peripheral`, the `bricknil.handlers.HandlerRunner` of its
+                `<name>_change` handler method or None)
+            handlers (dict): Peripheral name -> `bricknil.handlers.HandlerRunner` running its `<name>_change` method
             port_info (dict):  Keeps track of all the meta-data for each port.  Usually not populated unless `query_port_info` is true
+            ble_adapter (`bricknil.adapter.Adapter`) : Adapter the hub is connected through
+            disconnects (int) : Number of times the link dropped unexpectedly
+            reconnect_latencies (`collections.deque` [float]) : Seconds from link loss to reconnect, for the most recent reconnects
 
     """
     hubs = []
 
+    PORT_INFO_EVENTS = { PeripheralEvent.PORT_DETECTED, PeripheralEvent.PORT_INFO_RECEIVED,
+                         PeripheralEvent.PORT_COMBINATION_INFO_RECEIVED, PeripheralEvent.PORT_MODE_INFO_RECEIVED }
+
     # noinspection SpellCheckingInspection,SpellCheckingInspection,SpellCheckingInspection,SpellCheckingInspection
-    def __init__(self, name, query_port_info=False, ble_id=None):
+    def __init__(self, name, query_port_info=False, ble_id=None, flow_control=False, auto_reconnect=False,
+                 adapter=None, port_info_cache=None, attach_timeout=None):
         super().__init__(name)
         self.ble_id = ble_id
+        self.ble_device_name = None
+        self.adapter = adapter
+        self.ble_adapter = None
+        self.auto_reconnect = auto_reconnect
+        self.disconnects = 0
+        self.reconnect_latencies = deque(maxlen=100)
         self.ble_handler = BLEventQ.instance
         self.query_port_info = query_port_info
+        self.port_info_cache = port_info_cache
+        self.attach_timeout = attach_timeout
         self.uart_uuid = uuid.UUID('00001623-1212-efde-1623-785feabcd123')
         self.char_uuid = uuid.UUID('00001624-1212-efde-1623-785feabcd123')
+        self.link_ready = LoopEvent()
         self.tx = None
+        self.outbound = OutboundQueue(name, self._write_message, flow_control)
+        self.ingress = None
         self.peripherals = {}  # attach_sensor method will add sensors to this
         self.port_to_peripheral = {}   # Quick mapping from a port number to a peripheral object
                                         # Only gets populated once the peripheral attaches itself physically
-        self.peripheral_queue = Queue()  # Incoming messages from peripherals
+        self.port_dispatch = {}  # Port -> (peripheral, change handler runner), resolved once on attach
+        self.handlers = {}
+        self.peripheral_queue = PeripheralMailbox(name)  # Incoming messages from peripherals
         self.peripheral_task = None # Task processing incoming messages, spawn in `connect()`
 
         # Keep track of port info as we get messages from the hub ('update_port' messages)
@@ -72,22 +125,29 @@ class Hub(Process):
 
     async def connect(self):
         """
-        Connects to physical hub.
+        Connects to physical hub, and returns once every required peripheral has attached.
+
+        Raises:
+           PeripheralsNotAttachedError : If some haven't attached within `attach_timeout` seconds
         """
         await self.ble_handler.connect(self)
+        self.outbound.start()
         self.peripheral_task = spawn(self.peripheral_message_loop())
 
-        # Need to wait here until all the ports are set
-        # Use a faster timeout the first time (for speeding up testing)
-        first_delay = True
-        for name, peripheral in self.peripherals.items():
-            while peripheral.port is None:
-                self.message_info(f"Waiting for peripheral {name} to attach to a port")
-                if first_delay:
-                    first_delay = False
-                    await sleep(0.1)
-                else:
-                    await sleep(1)
+        # Need to wait here until all the ports are set (each peripheral's
+        # `attached` event is set when the hub binds it to its port)
+        waiting = {name: peripheral for name, peripheral in self.peripherals.items()
+                   if peripheral.required and not peripheral.attached.is_set()}
+        if not waiting:
+            return
+        self.message_info(f"Waiting for peripherals {', '.join(waiting)} to attach to a port")
+        try:
+            await wait_for(gather(*[peripheral.attached.wait() for peripheral in waiting.values()]),
+                           self.attach_timeout)
+        except TimeoutError:
+            missing = [name for name, peripheral in waiting.items() if not peripheral.attached.is_set()]
+            self.message_error(f"Peripherals {', '.join(missing)} did not attach within {self.attach_timeout}s")
+            raise PeripheralsNotAttachedError(self, missing)
 
 
     async def disconnect(self):
@@ -97,52 +157,93 @@ class Hub(Process):
         """
         if self.peripheral_task != None:
             self.peripheral_task.cancel()
+        for runner in self.handlers.values():
+            runner.stop()
+        self.outbound.stop()
         await self.ble_handler.disconnect(self)
+        if self.port_info_cache is not None:
+            self.port_info_cache.save()
 
 
 
-    async def send_message(self, msg_name, msg_bytes, peripheral=None):
+    @property
+    def tx(self):
+        return self._tx
+
+    @tx.setter
+    def tx(self, tx):
+        self._tx = tx
+        if tx:
+            self.link_ready.set()
+        else:
+            self.link_ready.clear()
+
+    async def send_message(self, msg_name, msg_bytes, peripheral=None, completion=False, response=True):
         """Send a message (command) to the hub.
 
+           The message goes through the :attr:`outbound` queue, where a newer setpoint
+           for the same port and mode supersedes one that hasn't been written yet.
+
+           Args:
+              completion (bool) : Return a future that resolves when the hub reports this
+                  port output command completed
+              response (bool) : Use an acknowledged write.  Set to False for setpoints
+                  that are streamed, so each one doesn't cost a link-layer round trip
+
+           Returns:
+              `asyncio.Future` if `completion` is True, otherwise None
         """
         while not self.tx:  # Need to make sure we have a handle to the uart
-            await sleep(1)
-        await self.ble_handler.send_message(self.tx, msg_bytes)
+            await self.link_ready.wait()
+        return await self.outbound.send(msg_bytes, completion, response)
+
+    async def _write_message(self, msg_bytes, response=True):
+        """Called by the :attr:`outbound` writer task to write one message to the hub"""
+        while not self.tx:  # Hold queued commands while reconnecting
+            await self.link_ready.wait()
+        await self.ble_handler.send_message(self.tx, msg_bytes, response)
+
+    def link_lost(self):
+        """Called by :class:`bricknil.ble_queue.BLEventQ` when the link to the hub drops unexpectedly"""
+        self.outbound.link_lost()
 
-    async def recv_message(self, msg, data):
-        """Receive and process message (notification) from the hub.
+    def port_output_feedback(self, port, feedback):
+        """Called by the message parser with the flags of a Port Output Command Feedback message"""
+        self.outbound.feedback(port, feedback)
+
+    async def recv_message(self, event):
+        """Receive and process a :class:`bricknil.mailbox.PeripheralEvent` from the hub.
 
         """
-        if msg == 'value_change':
-            port, msg_bytes = data
-            peripheral = self.port_to_peripheral[port]
-            await peripheral.update_value(msg_bytes)
-            self.message_debug(f'peripheral msg: {peripheral} {msg}')
-            handler_name = f'{peripheral.name}_change'
-            if hasattr(self, handler_name):
-                handler = getattr(self, handler_name)
-                await handler()
-        elif msg == 'attach':
-            port, device_name = data
+        op = event.op
+        if op == PeripheralEvent.VALUE_CHANGE:
+            peripheral, runner = self.port_dispatch[event.port]
+            if runner is None:
+                await peripheral.update_value(event.data)
+            else:
+                # The runner updates the peripheral and calls the handler on its own task
+                await runner.submit(event.data)
+        elif op == PeripheralEvent.ATTACH:
+            port, device_name = event.port, event.data
             peripheral = await self.connect_peripheral_to_port(device_name, port)
             if peripheral:
-                self.message_debug(f'peripheral msg: {peripheral} {msg}')
+                self.message_debug(f'peripheral msg: {peripheral} {event}')
                 peripheral.message_handler = self.send_message
                 await peripheral.activate_updates()
-        elif msg == 'update_port':
-            port, info = data
-            self.port_info[port] = info
-        elif msg.startswith('port'):
-            port = data
+                # After a reconnect, put outputs back the way the user left them
+                await peripheral.restore_state()
+        elif op == PeripheralEvent.UPDATE_PORT:
+            self.port_info[event.port] = event.data
+        elif op in self.PORT_INFO_EVENTS:
             if self.query_port_info:
-                await self._get_port_info(port, msg)
+                await self._get_port_info(event.port, op)
         else:
             raise UnknownPeripheralMessage
 
     async def peripheral_message_loop(self):
         """The main loop that receives messages from the :class:`bricknil.messages.Message` parser.
 
-           Waits for messages on a Queue and dispatches to the appropriate peripheral handler.
+           Waits for events on :attr:`peripheral_queue` and dispatches to the appropriate peripheral handler.
         """
         try:
             self.message_debug(f'starting peripheral message loop')
@@ -151,9 +252,8 @@ class Hub(Process):
             # - If so, we need to manually call peripheral.activate_updates()
             # - and then register the proper handler inside the message parser
             while True:
-                msg = await self.peripheral_queue.get()
-                msg, data = msg
-                await self.recv_message(msg, data)
+                event = await self.peripheral_queue.get()
+                await self.recv_message(event)
         except CancelledError:
             self.message(f'Terminating peripheral')
 
@@ -172,7 +272,7 @@ class Hub(Process):
         for peripheral_name, peripheral in self.peripherals.items():
             if peripheral.port == port:
                 if device_name == peripheral.sensor_name:
-                    self.port_to_peripheral[port] = peripheral
+                    self._bind_port(port, peripheral)
                     return peripheral
                 else:
                     raise DifferentPeripheralOnPortError
@@ -183,12 +283,33 @@ class Hub(Process):
             if peripheral.sensor_name == device_name and peripheral.port == None:
                 peripheral.message(f"ASSIGNING PORT {port} on {peripheral.name}")
                 peripheral.port = port
-                self.port_to_peripheral[port] = peripheral
+                self._bind_port(port, peripheral)
                 return peripheral
 
         # User hasn't specified a matching peripheral, so just ignore this attachment
         return None
 
+    def _bind_port(self, port, peripheral):
+        """Route value changes on `port` to `peripheral` and the hub's `<name>_change` method (if defined)"""
+        self.port_to_peripheral[port] = peripheral
+        runner = self.handlers.get(peripheral.name)
+        if runner is None:
+            handler = getattr(self, f'{peripheral.name}_change', None)
+            if handler is not None:
+                runner = self.handlers[peripheral.name] = HandlerRunner(peripheral, handler)
+        self.port_dispatch[port] = (peripheral, runner)
+        self.peripheral_queue.set_depth(port, peripheral.mailbox_depth)
+        peripheral.attached.set()
+
+
+    async def join_handlers(self):
+        """Wait until the handlers have dealt with every reading received so far"""
+        for runner in self.handlers.values():
+            await runner.join()
+
+    def handler_stats(self):
+        """Return peripheral name -> handler statistics (see :meth:`bricknil.handlers.HandlerRunner.stats`)"""
+        return {name: runner.stats() for name, runner in self.handlers.items()}
 
     def attach_sensor(self, sensor: Peripheral):
         """Add instance variable for this decorated sensor
@@ -201,26 +322,36 @@ class Hub(Process):
         # Put this sensor as an attribute
         setattr(self, sensor.name, sensor)
 
-    async def _get_port_info(self, port, msg):
+    async def _get_port_info(self, port, op):
         """Utility function to query information on available ports and modes from a hub.
 
+           Args:
+              op (int) : `PeripheralEvent` opcode of the port information event
         """
-        if msg == 'port_detected':
+        if op == PeripheralEvent.PORT_DETECTED:
+            if port == 255:
+                # Not a real port, just the fake attach of the hub button
+                return
+            if self.port_info_cache is not None and self.port_info_cache.lookup(self.port_info[port]):
+                self.message_debug(f'Using cached port info for {port}')
+                return
             # Request mode info
             b = [0x00, 0x21, port, 0x01]
             await self.send_message(f'req mode info on {port}', b)
-        elif msg == 'port_combination_info_received':
+        elif op == PeripheralEvent.PORT_COMBINATION_INFO_RECEIVED:
             pass
-        elif msg == 'port_mode_info_received':
+        elif op == PeripheralEvent.PORT_MODE_INFO_RECEIVED:
             pass
-        elif msg == 'port_info_received':
+        elif op == PeripheralEvent.PORT_INFO_RECEIVED:
             # At this point we know all the available modes for this port
             # let's get the name and value format
+            if self.port_info_cache is not None:
+                self.port_info_cache.store(self.port_info[port])
             modes = self.port_info[port]['modes']
+            requests = []
             if self.port_info[port].get('combinable', False):
                 # Get combination info on port
-                b = [0x00, 0x21, port, 0x02]
-                await self.send_message(f'req mode combination info on {port}', b)
+                requests.append([0x00, 0x21, port, 0x02])
             for mode in modes.keys():
                 info_types = { 'NAME': 0, 'VALUE FORMAT':0x80, 'RAW Range':0x01,
                         'PCT Range': 0x02, 'SI Range':0x03, 'Symbol':0x04,
@@ -228,31 +359,33 @@ class Hub(Process):
                         }
                 # Send a message to requeust each type of info
                 for k,v in info_types.items():
-                    b = [0x00, 0x22, port, mode, v]
-                    await self.send_message(f'req info({k}) on mode {mode} {port}', b)
+                    requests.append([0x00, 0x22, port, mode, v])
+            # Queue them all at once, and let the writer stream them out
+            commands = [self.outbound.put(b) for b in requests]
+            await gather(*[command.future for command in commands])
 
 
 class PoweredUpHub(Hub):
     """PoweredUp Hub class
     """
-    def __init__(self, name, query_port_info=False, ble_id=None):
-        super().__init__(name, query_port_info, ble_id)
+    def __init__(self, name, query_port_info=False, ble_id=None, **kwargs):
+        super().__init__(name, query_port_info, ble_id, **kwargs)
         self.ble_name = 'HUB NO.4'
         self.manufacturer_id = 65
 
 class PoweredUpRemote(Hub):
     """PoweredUp Remote class
     """
-    def __init__(self, name, query_port_info=False, ble_id=None):
-        super().__init__(name, query_port_info, ble_id)
+    def __init__(self, name, query_port_info=False, ble_id=None, **kwargs):
+        super().__init__(name, query_port_info, ble_id, **kwargs)
         self.ble_name = 'Handset'
         self.manufacturer_id = 66
 
 class BoostHub(Hub):
     """Boost Move Hub
     """
-    def __init__(self, name, query_port_info=False, ble_id=None):
-        super().__init__(name, query_port_info, ble_id)
+    def __init__(self, name, query_port_info=False, ble_id=None, **kwargs):
+        super().__init__(name, query_port_info, ble_id, **kwargs)
         self.ble_name = 'LEGO Move Hub'
         self.manufacturer_id = 64
 
@@ -262,8 +395,8 @@ class DuploTrainHub(Hub):
 
        This is hub is found in Lego sets 10874 and 10875
     """
-    def __init__(self, name, query_port_info=False, ble_id=None):
-        super().__init__(name, query_port_info, ble_id)
+    def __init__(self, name, query_port_info=False, ble_id=None, **kwargs):
+        super().__init__(name, query_port_info, ble_id, **kwargs)
         self.ble_name = 'Train Base'
         self.manufacturer_id = 32
 
@@ -271,7 +404,7 @@ class DuploTrainHub(Hub):
 class CPlusHub(Hub):
     """Technic Control+ Hub
     """
-    def __init__(self, name, query_port_info=False, ble_id=None):
-        super().__init__(name, query_port_info, ble_id)
+    def __init__(self, name, query_port_info=False, ble_id=None, **kwargs):
+        super().__init__(name, query_port_info, ble_id, **kwargs)
         self.ble_name = "Control+ Hub"
         self.manufacturer_id = 128
@@ -0,0 +1,86 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hand notifications from the BLE backend over to the event loop
+
+Some BLE backends call the notification callback from their own thread.
+The callback here only timestamps the raw bytes and appends them to a
+deque; the first notification of a batch schedules one drain on the event
+loop (with `call_soon_threadsafe` when called off-loop), and that drain
+parses everything that arrived in the meantime.
+"""
+import time, threading
+from collections import deque
+from asyncio import get_event_loop
+
+from .process import Process
+
+class NotificationIngress(Process):
+    """Batches raw notifications into the event loop
+
+       Args:
+          name (str) : Name of the hub (for logging)
+          handler (func) : Called on the event loop thread with (data, timestamp) for each notification,
+              where timestamp is the `time.monotonic()` at which it arrived
+
+       Attributes:
+          notifications (int) : Number of notifications received
+          batches (int) : Number of drains run on the event loop
+          largest_batch (int) : Most notifications handled by one drain
+          max_delay (float) : Longest time (seconds) a notification waited before being handled
+    """
+    def __init__(self, name, handler):
+        super().__init__(f'{name} ingress')
+        self.handler = handler
+        self.loop = get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.pending = deque()
+        self.scheduled = False
+        self.notifications = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.max_delay = 0
+
+    def received(self, sender, data):
+        """Notification callback for the transport (safe to call from any thread)"""
+        self.pending.append((bytes(data), time.monotonic()))
+        if not self.scheduled:
+            # A drain that already started clears the flag before it empties
+            # the deque, so it will see this notification; at worst, two drains
+            # get scheduled and the second one finds nothing to do
+            self.scheduled = True
+            if threading.get_ident() == self.loop_thread:
+                self.loop.call_soon(self._drain)
+            else:
+                self.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        self.scheduled = False
+        pending = self.pending
+        if not pending:
+            return
+        oldest = pending[0][1]
+        count = 0
+        while pending:
+            data, timestamp = pending.popleft()
+            count += 1
+            try:
+                self.handler(data, timestamp)
+            except Exception as e:
+                # Carry on with the rest of the batch
+                self.message_error(f'Failed to handle notification {data}: {e!r}')
+        self.notifications += count
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, count)
+        self.max_delay = max(self.max_delay, time.monotonic() - oldest)
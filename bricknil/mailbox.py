@@ -0,0 +1,152 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mailbox for the messages the parser hands to a hub
+
+The parser hands the hub :class:`PeripheralEvent` objects, tagged with an
+integer opcode.  Sensor readings (`VALUE_CHANGE` events) are conflated per port: a port
+keeps at most `depth` readings waiting, and a newer reading pushes out the
+oldest one.  A sensor that streams faster than the hub's handlers run then
+costs a bounded amount of memory and latency instead of an ever-growing
+backlog.  Every other event (attach, port info, etc) is kept, and so are
+the readings of ports whose depth is None (like buttons, where every press
+matters).
+
+Events come out in the order they arrived, except that a reading which
+pushed out an older one on its port takes the older one's place in line.
+"""
+from collections import deque
+from asyncio import QueueEmpty
+
+from .process import Process, LoopEvent
+
+class PeripheralEvent:
+    """A message from the parser to the hub
+
+       Args:
+          op (int) : What happened (one of the opcodes below)
+          port (int) : Port it happened on
+          data : `VALUE_CHANGE`: the reading's bytes, `ATTACH`: the device name, `UPDATE_PORT`: the port info dict,
+              otherwise None
+    """
+    __slots__ = ('op', 'port', 'data')
+
+    VALUE_CHANGE = 0
+    ATTACH = 1
+    UPDATE_PORT = 2
+    PORT_DETECTED = 3
+    PORT_INFO_RECEIVED = 4
+    PORT_COMBINATION_INFO_RECEIVED = 5
+    PORT_MODE_INFO_RECEIVED = 6
+
+    NAMES = ['value_change', 'attach', 'update_port', 'port_detected', 'port_info_received',
+             'port_combination_info_received', 'port_mode_info_received']
+
+    def __init__(self, op, port, data=None):
+        self.op = op
+        self.port = port
+        self.data = data
+
+    def __eq__(self, other):
+        return (isinstance(other, PeripheralEvent) and
+                (self.op, self.port, self.data) == (other.op, other.port, other.data))
+
+    def __repr__(self):
+        return f'PeripheralEvent({self.NAMES[self.op]}, {self.port}, {self.data!r})'
+
+
+class PeripheralMailbox(Process):
+    """Queue of :class:`PeripheralEvent` feeding a hub, with the `asyncio.Queue` methods the hub uses
+
+       Args:
+          name (str) : Name of the hub (for logging)
+          depth (int) : Readings kept waiting per port, for ports without their own depth (None to keep all)
+
+       Attributes:
+          depths (dict) : Port -> readings kept waiting on that port (None to keep all)
+          waiting (dict) : Port -> `collections.deque` of readings waiting to be delivered
+          dropped (int) : Number of readings pushed out by newer ones
+          drops (dict) : Port -> number of readings pushed out on that port
+          peak_depth (int) : Most events ever waiting at once
+    """
+
+    def __init__(self, name, depth=1):
+        super().__init__(f'{name} mailbox')
+        self.depth = depth
+        self.depths = {}
+        # Events in arrival order; a reading is represented by its port, and
+        # each port has exactly as many entries here as it has readings waiting
+        self.order = deque()
+        self.waiting = {}
+        self.dropped = 0
+        self.drops = {}
+        self.peak_depth = 0
+        self._wakeup = LoopEvent()
+
+    def set_depth(self, port, depth):
+        """Keep at most `depth` readings waiting on `port` (None to keep all)"""
+        self.depths[port] = depth
+
+    def port_depth(self, port):
+        """Return the number of readings waiting on `port`"""
+        waiting = self.waiting.get(port)
+        return len(waiting) if waiting else 0
+
+    def qsize(self):
+        return len(self.order)
+
+    def empty(self):
+        return len(self.order) == 0
+
+    def full(self):
+        return False
+
+    def put_nowait(self, event):
+        if event.op == PeripheralEvent.VALUE_CHANGE:
+            port = event.port
+            waiting = self.waiting.get(port)
+            if waiting is None:
+                waiting = self.waiting[port] = deque()
+            depth = self.depths.get(port, self.depth)
+            if depth is not None and len(waiting) >= depth:
+                # The newest reading takes the place of the oldest one
+                waiting.popleft()
+                waiting.append(event)
+                self.dropped += 1
+                self.drops[port] = self.drops.get(port, 0) + 1
+                return
+            waiting.append(event)
+            self.order.append(port)
+        else:
+            self.order.append(event)
+        if len(self.order) > self.peak_depth:
+            self.peak_depth = len(self.order)
+        self._wakeup.set()
+
+    async def put(self, event):
+        self.put_nowait(event)
+
+    def get_nowait(self):
+        if not self.order:
+            raise QueueEmpty
+        entry = self.order.popleft()
+        if entry.__class__ is PeripheralEvent:
+            return entry
+        return self.waiting[entry].popleft()
+
+    async def get(self):
+        while not self.order:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self.get_nowait()
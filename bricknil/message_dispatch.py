@@ -1,15 +1,16 @@
 """Parse incoming BLE Lego messages from hubs
 
 Each hub has one of these objects to control access to the underlying BLE library notification thread.
-Communication back into the hub is through a :class:`asyncio.Queue`
-object.
+Communication back into the hub is through :class:`bricknil.mailbox.PeripheralEvent`
+objects put on the hub's :class:`bricknil.mailbox.PeripheralMailbox`.
 
 Todo:
     * The message parsers need to handle detaching of peripherals
 """
-import struct, logging
-from .const import DEVICES
+import logging
 from .messages import Message, UnknownMessageError
+from .mailbox import PeripheralEvent
+from .framing import FrameAssembler
 
 logger = logging.getLogger(__name__)
 
@@ -30,31 +31,66 @@ class MessageDispatch:
             Attributes:
                 port_info (dict): A mirror copy of the :py:attr:`bricknil.hub.Hub.port_info` object.  This object is sent every time
                     an update on the port meta data is made.
+                frames (:class:`bricknil.framing.FrameAssembler`) : Splits and reassembles the messages of :meth:`feed`
         """
         self.hub = hub
         self.port_info = {}
+        self.frames = FrameAssembler()
 
-    def parse(self, msg:bytearray):
+    def feed(self, notification, describe=True):
+        """Parse every message in a notification
+
+           A notification can hold several messages, or part of one (the rest
+           comes in the next notifications); see :mod:`bricknil.framing`.
+
+           Returns:
+              list [str] : Description of each message parsed (None if `describe` is False)
+        """
+        messages = self.frames.feed(notification)
+        if not describe:
+            for msg in messages:
+                self.parse(msg, False)
+            return None
+        return [self.parse(msg) for msg in messages]
+
+    def parse(self, msg:bytearray, describe=True):
         """Parse the header of the message and dispatch message body processing
 
            `l` is only used to build up a log message to display during operation, telling
            the user what kind of message was received and how it was parsed. If the message
            cannot be parsed, then `l` contains the remaining unparsed raw message that was received from the
            hardware ble device.
-        """
-        msg_bytes = list(msg)
-        msg_bytes = msg_bytes[2:]  # Skip the first two bytes (msg length and hub id (always 0) )
 
-        msg_type = msg_bytes.pop(0)
-        l = []  # keep track of the parsed return message
+           The body parsers only index, slice and `unpack_from` at an offset into
+           `msg`, so it can be bytes, a bytearray or a `memoryview`.  :meth:`feed` passes
+           a `memoryview`, so the value updates handed to peripherals are views into the
+           notification, not copies.
+
+           `msg` must be exactly one message.  Use :meth:`feed` for notifications.
+
+           Args:
+              describe (bool) : Build the description.  Set to False when nobody will log it,
+                  since formatting the description costs more than parsing the message
+
+           Returns:
+              str : Description of the message (None if `describe` is False)
+        """
+        # Skip the msg length (one byte, or two if bit 7 of the first is set) and hub id (always 0)
+        offset = 3 if msg[0] & 0x80 else 2
+        msg_type = msg[offset]
+        l = [] if describe else None  # keep track of the parsed return message
         try:
-            if msg_type in Message.parsers:
-                Message.parsers[msg_type].parse(msg_bytes, l, self)
-            else:
+            parser = Message.parsers.get(msg_type)
+            if parser is None:
                 raise UnknownMessageError
+            parser.parse(msg, offset+1, l, self)
         except UnknownMessageError:
+            if not describe:
+                return None
             l.append(self._parse_msg_bytes(msg))
 
+        if not describe:
+            return None
         return ' '.join([str(x) for x in l])
 
     def _parse_msg_bytes(self, msg_bytes):
@@ -64,25 +100,35 @@ class MessageDispatch:
     def message_update_value_to_peripheral(self, port,  value):
         """Called whenever a peripheral on the hub reports a change in its sensed value
         """
-        self.hub.peripheral_queue.put_nowait( ('value_change', (port, value)) )
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, port, value))
+
+    def message_output_feedback_to_hub(self, port, feedback):
+        """Called whenever the hub reports the state of the commands sent to a port
+
+           This goes straight to the hub's outbound queue (instead of through the
+           peripheral queue) so that flow control doesn't wait behind sensor updates.
+        """
+        self.hub.port_output_feedback(port, feedback)
 
-    def message_port_info_to_peripheral(self, port, message):
+    def message_port_info_to_peripheral(self, port, op):
         """Called whenever a peripheral needs to update its meta-data
+
+           Args:
+              op (int) : `PeripheralEvent` opcode saying which information was received
         """
-        self.hub.peripheral_queue.put_nowait( ('update_port', (port, self.port_info[port])) )
-        self.hub.peripheral_queue.put_nowait( (message, port) )
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(PeripheralEvent.UPDATE_PORT, port, self.port_info[port]))
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(op, port))
 
     def message_attach_to_hub(self, device_name, port):
         """Called whenever a peripheral is attached to the hub
         """
         # Now, we should activate updates from this sensor
-        self.hub.peripheral_queue.put_nowait( ('attach', (port, device_name)) )
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(PeripheralEvent.ATTACH, port, device_name))
 
         # Send a message to update the information on this port
-        self.hub.peripheral_queue.put_nowait( ('update_port',  (port, self.port_info[port])) )
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(PeripheralEvent.UPDATE_PORT, port, self.port_info[port]))
 
         # Send a message saying this port is detected, in case the hub
         # wants to query for more properties.  (Since an attach message
         # doesn't do anything if the user hasn't @attach'ed a peripheral to it)
-        self.hub.peripheral_queue.put_nowait( ('port_detected', port))
-
+        self.hub.peripheral_queue.put_nowait(PeripheralEvent(PeripheralEvent.PORT_DETECTED, port))
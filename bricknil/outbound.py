@@ -0,0 +1,374 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Outbound command queue for each hub
+
+Commands are written to the hub by a single writer task, in the order they
+were queued.  Setpoint commands (Port Output WriteDirectModeData, used by
+`set_speed`, `set_color`, `set_brightness`, etc) are keyed by (port, mode): if
+a newer setpoint for the same key is queued before the older one was written,
+the older one is dropped since the hub would immediately overwrite it anyway.
+
+Port output commands that ask for command feedback are tracked per port until
+the hub's Port Output Command Feedback (0x82) message reports them completed
+or discarded.  With flow control enabled, the queue uses this as credit-based
+flow control: commands are sent with the "buffer if necessary" startup flag,
+at most `window` of them are in flight on a port (one executing, one in the
+hub's buffer), and a port that reports busy/full is paused until the next
+feedback.
+"""
+import time
+from collections import OrderedDict, deque
+from asyncio import CancelledError, TimeoutError, get_event_loop, wait_for, create_task as spawn
+
+from .process import Process, LoopEvent
+
+class CommandDiscardedError(Exception):
+    """The hub discarded a port output command before completing it"""
+    pass
+
+class OutboundCommand:
+    """A command waiting in the :class:`OutboundQueue`
+
+       Attributes:
+          msg_bytes (list) : Message (without the length header)
+          coalescable (bool) : True if a newer command can supersede this one
+          response (bool) : Write with an acknowledgment
+          port (int) : Port of a port output command (None for every other message)
+          tracked (bool) : True if the hub will send command feedback for this command
+          future (`asyncio.Future`) : True once written, False if superseded (cancelled if the
+              caller of :meth:`OutboundQueue.send` was cancelled)
+          completion (`asyncio.Future`) : Only created if requested.  True once the hub reports the command
+              completed, raises :class:`CommandDiscardedError` if the hub discards it
+          sent_at (float) : `time.monotonic()` when the command was written
+          key : Key of the command in :attr:`OutboundQueue.pending`
+    """
+    def __init__(self, msg_bytes, coalescable, completion=False, response=True):
+        self.msg_bytes = msg_bytes
+        self.coalescable = coalescable
+        self.response = response
+        self.port = msg_bytes[2] if len(msg_bytes) > 3 and msg_bytes[1] == 0x81 else None
+        self.tracked = self.port is not None and bool(msg_bytes[3] & 0x01)
+        loop = get_event_loop()
+        self.future = loop.create_future()
+        self.completion = loop.create_future() if completion else None
+        self.sent_at = None
+
+    def written(self, result, error=None):
+        """Resolve the future with `result` (or `error`), unless the sender gave up on it"""
+        if self.future.done():
+            return
+        if error is None:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(error)
+
+    def finish(self, completed, error=None):
+        """Resolve the completion future (if anyone asked for one)"""
+        if self.completion is None or self.completion.done():
+            return
+        if completed:
+            self.completion.set_result(True)
+        else:
+            self.completion.set_exception(error)
+
+class OutboundQueue(Process):
+    """Queue of commands to a hub, with supersession of stale setpoints
+
+       Args:
+          name (str) : Name of the hub (for logging)
+          write (coroutine function) : Called with the message bytes and the `response` flag to actually
+              write to the hub
+          flow_control (bool) : Pace port output commands using the hub's command feedback
+          window (int) : Commands allowed in flight on each port when `flow_control` is enabled
+          credit_timeout (float) : Seconds after which an in-flight command with no feedback
+              stops holding back its port
+
+       Attributes:
+          sent (int) : Number of commands written to the hub
+          coalesced (int) : Number of commands dropped because a newer one superseded them
+          completed (int) : Number of commands the hub reported completed
+          discarded (int) : Number of commands the hub reported discarded
+          expired (int) : Number of commands that never got feedback
+          in_flight (dict) : Port -> `collections.deque` of written commands waiting on feedback
+          busy_ports (dict) : Port -> `time.monotonic()` when it reported its buffer busy/full
+    """
+    # Port Output Command (0x81) sub-commands that only set a value on a port
+    COALESCED_SUBCOMMANDS = {0x51}  # WriteDirectModeData
+
+    # Without flow control, still track feedback (for completion futures) but
+    # only for this many commands per port
+    UNPACED_TRACKING_LIMIT = 16
+
+    def __init__(self, name, write, flow_control=False, window=2, credit_timeout=5):
+        super().__init__(f'{name} outbound')
+        self.write = write
+        self.pending = OrderedDict()
+        self.window = window if flow_control else None
+        self.credit_timeout = credit_timeout
+        self.in_flight = {}
+        self.busy_ports = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.discarded = 0
+        self.expired = 0
+        self.writer_task = None
+        self._next_seq = 0
+        self._wakeup = LoopEvent()
+        self._drained = LoopEvent()     # Set while nothing is queued or being written
+        self._drained.set()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def supersession_key(self, msg_bytes):
+        """Return the (port, sub-command, mode) key of a setpoint command, or None
+           if this command must always be sent
+
+           Port output message layout:  [0x00, 0x81, port, startup/completion, sub-command, mode, value...]
+        """
+        if len(msg_bytes) > 5 and msg_bytes[1] == 0x81 and msg_bytes[4] in self.COALESCED_SUBCOMMANDS:
+            return (msg_bytes[2], msg_bytes[4], msg_bytes[5])
+        return None
+
+    def put(self, msg_bytes, completion=False, response=True):
+        """Queue a command without waiting for it to be written
+
+           Args:
+              completion (bool) : Create a `completion` future on the returned command
+              response (bool) : Write with an acknowledgment
+
+           Returns:
+              `OutboundCommand` : The queued command
+        """
+        key = self.supersession_key(msg_bytes)
+        if key is None:
+            # Sequence numbers never collide with the tuple keys
+            key = self._next_seq
+            self._next_seq += 1
+        else:
+            stale = self.pending.pop(key, None)
+            if stale is not None:
+                self.coalesced += 1
+                stale.written(False)
+                stale.finish(False, CommandDiscardedError(f'Superseded before being sent: {stale.msg_bytes}'))
+        command = OutboundCommand(msg_bytes, isinstance(key, tuple), completion, response)
+        command.key = key
+        if command.tracked and self.window is not None:
+            # We never overrun the hub's buffer, so let it queue commands
+            # instead of executing each immediately (upper nibble 0 = buffer if necessary)
+            command.msg_bytes = list(msg_bytes)
+            command.msg_bytes[3] &= 0x0F
+        self.pending[key] = command
+        self._drained.clear()
+        self._wakeup.set()
+        return command
+
+    async def send(self, msg_bytes, completion=False, response=True):
+        """Queue a command
+
+           Setpoints return as soon as they're queued, since a later setpoint
+           can replace them.  All other commands wait until they've been written.
+
+           Returns:
+              `asyncio.Future` : The command's completion future if `completion` is True
+        """
+        command = self.put(msg_bytes, completion, response)
+        if not command.coalescable:
+            try:
+                await command.future
+            except CancelledError:
+                self._withdraw(command)
+                raise
+        return command.completion
+
+    def _withdraw(self, command):
+        """Drop a command whose sender was cancelled before it was written
+
+           A command that was already written stays in `in_flight`, so the
+           hub's feedback for it isn't credited to a later command.
+        """
+        if self.pending.get(command.key) is command:
+            del self.pending[command.key]
+            if not self.pending:
+                self._wakeup.set()
+        if command.completion is not None:
+            command.completion.cancel()
+
+    async def drain(self):
+        """Wait until the writer has written every queued command
+
+           Only returns once the writer is running (see :meth:`start`).
+        """
+        await self._drained.wait()
+
+    def start(self):
+        if self.writer_task is None:
+            self.writer_task = spawn(self._writer())
+
+    def stop(self):
+        """Stop the writer and cancel everything still queued"""
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        for command in self.pending.values():
+            command.future.cancel()
+            if command.completion is not None:
+                command.completion.cancel()
+        self.pending.clear()
+        self._drained.set()
+        for in_flight in self.in_flight.values():
+            for command in in_flight:
+                if command.completion is not None:
+                    command.completion.cancel()
+        self.in_flight.clear()
+        self.busy_ports.clear()
+
+    def link_lost(self):
+        """The hub dropped everything it was executing or buffering
+
+           Commands still queued here are kept, and sent once the link is back.
+        """
+        for port, in_flight in self.in_flight.items():
+            for command in in_flight:
+                command.finish(False, CommandDiscardedError(f'Link lost before port {port} completed {command.msg_bytes}'))
+        self.in_flight.clear()
+        self.busy_ports.clear()
+        self._wakeup.set()
+
+    def feedback(self, port, flags):
+        """Process a Port Output Command Feedback (0x82) message for `port`
+
+           Flags:
+              * 0x01 = Buffer empty, command in progress
+              * 0x02 = Buffer empty, command completed
+              * 0x04 = Current command(s) discarded
+              * 0x08 = Idle
+              * 0x10 = Busy/Full
+        """
+        in_flight = self.in_flight.get(port)
+        if in_flight:
+            if flags & 0x04:
+                # Everything but the command now in progress (if any) was discarded
+                keep = 1 if flags & 0x01 else 0
+                while len(in_flight) > keep:
+                    command = in_flight.popleft()
+                    self.discarded += 1
+                    self.message_info(f'Hub discarded command {command.msg_bytes}')
+                    command.finish(False, CommandDiscardedError(f'Port {port} discarded {command.msg_bytes}'))
+            if flags & 0x02 and in_flight:
+                self._complete(in_flight.popleft())
+            if flags & 0x08:
+                while in_flight:
+                    self._complete(in_flight.popleft())
+        if flags & 0x10:
+            self.busy_ports.setdefault(port, time.monotonic())
+        else:
+            self.busy_ports.pop(port, None)
+        self._wakeup.set()
+
+    def _complete(self, command):
+        self.completed += 1
+        command.finish(True)
+
+    def _expire(self, in_flight, now):
+        """Stop waiting on feedback for commands older than `credit_timeout`"""
+        while in_flight and now - in_flight[0].sent_at > self.credit_timeout:
+            command = in_flight.popleft()
+            self.expired += 1
+            command.finish(False, TimeoutError(f'No feedback for {command.msg_bytes}'))
+
+    def _port_ready(self, port, now):
+        if self.window is None:
+            return True
+        if port in self.busy_ports:
+            if now - self.busy_ports[port] <= self.credit_timeout:
+                return False
+            del self.busy_ports[port]
+        in_flight = self.in_flight.get(port)
+        if in_flight:
+            self._expire(in_flight, now)
+            return len(in_flight) < self.window
+        return True
+
+    def _next_command(self):
+        """Pop the oldest command that can be written now
+
+           A port output command is held back while its port has no credit,
+           and so is every later command for the same port (to keep them in order).
+        """
+        now = time.monotonic()
+        held_ports = set()
+        for key, command in self.pending.items():
+            port = command.port
+            if port is not None:
+                if port in held_ports:
+                    continue
+                if not self._port_ready(port, now):
+                    held_ports.add(port)
+                    continue
+            del self.pending[key]
+            return command
+        return None
+
+    def _track(self, command):
+        in_flight = self.in_flight.setdefault(command.port, deque())
+        command.sent_at = time.monotonic()
+        in_flight.append(command)
+        if self.window is None and len(in_flight) > self.UNPACED_TRACKING_LIMIT:
+            stale = in_flight.popleft()
+            self.expired += 1
+            stale.finish(False, TimeoutError(f'No feedback for {stale.msg_bytes}'))
+
+    async def _writer(self):
+        """Write queued commands to the hub as fast as the link allows"""
+        try:
+            while True:
+                command = self._next_command()
+                if command is None:
+                    self._wakeup.clear()
+                    if len(self.pending) == 0:
+                        self._drained.set()
+                        await self._wakeup.wait()
+                    else:
+                        # Everything is waiting on feedback; re-check for
+                        # commands with expired credits every so often
+                        try:
+                            await wait_for(self._wakeup.wait(), self.credit_timeout)
+                        except TimeoutError:
+                            pass
+                    continue
+                if command.tracked:
+                    self._track(command)
+                try:
+                    await self.write(command.msg_bytes, command.response)
+                except CancelledError:
+                    command.future.cancel()
+                    raise
+                except Exception as e:
+                    if command.tracked and command in self.in_flight[command.port]:
+                        self.in_flight[command.port].remove(command)
+                        command.finish(False, e)
+                    if command.coalescable:
+                        # Nobody is waiting on a setpoint, so just report it
+                        self.message_error(f'Failed to write {command.msg_bytes}: {e!r}')
+                        command.written(False)
+                    else:
+                        command.written(False, e)
+                else:
+                    self.sent += 1
+                    command.written(True)
+        except CancelledError:
+            pass
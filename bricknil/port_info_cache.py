@@ -0,0 +1,120 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of port and mode information
+
+With `query_port_info=True`, a hub asks every attached device for its modes
+and then sends seven requests per mode.  The answers only depend on the
+device, so they're cached by device id and hardware/software version (from
+the Attached I/O message), and a hub that finds a device in the cache skips
+the queries.  Pass one to the hub::
+
+    from bricknil.port_info_cache import PortInfoCache
+
+    hub = PoweredUpHub('hub', query_port_info=True, port_info_cache=PortInfoCache())
+
+The cache is written out when a hub using it disconnects.  Only devices
+that answered every query (each mode's name and value format, plus the
+mode combinations of a combinable port) are written out or reused, so a
+run that disconnects early queries the device again next time.
+"""
+import os, json, copy, logging
+
+logger = logging.getLogger(__name__)
+
+class PortInfoCache:
+    """Map of (device id, HW version, SW version) -> port information from previous runs
+
+       Args:
+          path (str) : JSON file to keep the cache in (default `~/.bricknil/port_info_cache.json`)
+
+       Attributes:
+          hits (int) : Lookups that returned cached information
+          misses (int) : Lookups with no entry
+    """
+    # Port info entries that identify the device rather than describe it
+    IDENTITY = ('id', 'name', 'hw_version', 'sw_version', 'virtual')
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bricknil', 'port_info_cache.json')
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        for info in entries.values():
+            # JSON turned the mode numbers into strings
+            if 'modes' in info:
+                info['modes'] = {int(mode): mode_info for mode, mode_info in info['modes'].items()}
+        return entries
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        entries = {key: self._description(info) for key, info in self.entries.items() if self.complete(info)}
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f'Could not write port info cache {self.path}: {e}')
+
+    def _key(self, port_info):
+        return f'{port_info["id"]}|{port_info.get("hw_version")}|{port_info.get("sw_version")}'
+
+    def _description(self, port_info):
+        return {k: v for k, v in port_info.items() if k not in self.IDENTITY}
+
+    @staticmethod
+    def complete(port_info):
+        """Return True if `port_info` has everything a device is queried for"""
+        modes = port_info.get('modes')
+        if not modes:
+            return False
+        if port_info.get('combinable') and 'mode_combinations' not in port_info:
+            return False
+        return all('name' in mode_info and 'datasets' in mode_info for mode_info in modes.values())
+
+    def lookup(self, port_info):
+        """Fill in `port_info` (a port's entry from :attr:`bricknil.hub.Hub.port_info`) from the cache
+
+           Returns:
+              bool : True on a hit
+        """
+        info = self.entries.get(self._key(port_info))
+        if not info or not self.complete(info):
+            self.misses += 1
+            return False
+        port_info.update(copy.deepcopy(self._description(info)))
+        self.hits += 1
+        return True
+
+    def store(self, port_info):
+        """Cache `port_info` while the hub fills it in
+
+           The entry keeps a reference to `port_info`, and is only written out
+           (or returned by :meth:`lookup`) once it is :meth:`complete`.
+        """
+        self.entries[self._key(port_info)] = port_info
@@ -14,9 +14,11 @@
 
 """Super-class of all the Tasks in the event-loop
 """
+import time
 from enum import Enum
 from itertools import chain
-from asyncio import iscoroutinefunction
+from collections import deque
+from asyncio import iscoroutinefunction, gather, wait_for, Event, CancelledError, TimeoutError
 import logging
 from blinker import signal
 from blinker.base import Signal
@@ -46,6 +48,102 @@ async def __emit(signal, sender, *args, **kwargs):
 
 Signal.emit = __emit
 
+class EmitPolicy:
+    """How :meth:`Process.emit` runs the coroutine receivers of a signal
+
+       Without a policy, receivers are awaited one after the other and an
+       exception in one of them propagates to the emitter.  With one, each
+       receiver's latency is recorded (see :meth:`Process.emit_stats`), and an
+       exception or timeout in one receiver is logged and counted instead of
+       keeping the others from running.
+
+       Args:
+          mode (str) : 'serial' (one after the other) or 'concurrent' (all at once)
+          timeout (float) : Seconds a coroutine receiver may take before it's cancelled (None for no limit)
+    """
+    MODES = ('serial', 'concurrent')
+
+    def __init__(self, mode='concurrent', timeout=None):
+        assert mode in self.MODES, f'Unknown emit policy {mode} (must be one of {self.MODES})'
+        assert timeout is None or timeout > 0, 'Receiver timeout must be positive'
+        self.mode = mode
+        self.timeout = timeout
+
+    @classmethod
+    def of(cls, policy):
+        """Return `policy` as an :class:`EmitPolicy` (it can be given as just the mode)"""
+        return policy if isinstance(policy, EmitPolicy) else cls(policy)
+
+    def __repr__(self):
+        return f'EmitPolicy({self.mode!r}, timeout={self.timeout})'
+
+
+class LoopEvent:
+    """An `asyncio.Event` that can be created outside the event loop
+
+       Before Python 3.10, an Event binds to the current event loop when it's
+       created, so one made in an object's `__init__` outside `asyncio.run()`
+       can't be waited on inside it.  This keeps the flag itself, and only
+       creates the Event (in the running loop) once something waits on it.
+    """
+    def __init__(self):
+        self._flag = False
+        self._event = None
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        self._flag = True
+        if self._event is not None:
+            self._event.set()
+
+    def clear(self):
+        self._flag = False
+        if self._event is not None:
+            self._event.clear()
+
+    async def wait(self):
+        if self._flag:
+            return True
+        if self._event is None:
+            self._event = Event()
+        return await self._event.wait()
+
+
+def latency_stats(latencies):
+    """Return the 50th, 90th and 99th percentile and the maximum of `latencies`
+
+       Returns:
+          dict : 'p50', 'p90', 'p99' and 'max' (each None if there are no latencies)
+    """
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies)-1, int(len(latencies)*p/100))] if latencies else None
+    return {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+            'max': latencies[-1] if latencies else None}
+
+
+class ReceiverStats:
+    """What one receiver of a signal emitted under an :class:`EmitPolicy` cost
+
+       Attributes:
+          calls (int) : Times the receiver was called
+          errors (int) : Calls that raised an exception
+          timeouts (int) : Calls cancelled for taking longer than the policy's timeout
+          latencies (`collections.deque` [float]) : Seconds each of the most recent successful calls took
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=1000)
+
+    def stats(self):
+        """Return the counts and latency percentiles (in seconds, see :func:`latency_stats`) as a dict"""
+        return dict(calls=self.calls, errors=self.errors, timeouts=self.timeouts, **latency_stats(self.latencies))
+
+
 class Process:
     """Subclass this for anything going into the Async Event Loop and can signal
        events such as hubs and peripherals.
@@ -57,6 +155,19 @@ class Process:
        (subscribe) and react. For example, one may connect to peripeheral "notify"
        (or "notify::<mode>") signal to get informed of new sensor reading.
 
+       Receivers connected with :meth:`connect` are kept per instance, already
+       split into plain functions and coroutine functions, so :meth:`emit` just
+       walks two lists.  (They're connected to the blinker signal as well, for
+       code that emits through blinker directly, but receivers connected
+       straight to the blinker signal aren't called by :meth:`emit`.)
+
+       By default, the coroutine receivers of a signal are awaited one after
+       the other, so their latencies add up.  :meth:`set_emit_policy` can run
+       them concurrently instead, with a timeout per receiver, and makes
+       :meth:`emit` log a failing receiver rather than stop at it::
+
+           motor.set_emit_policy(EmitPolicy('concurrent', timeout=0.05), 'notify::sense_pos')
+
        It also provides some utilty functions to log messages at various levels.
 
        Attributes:
@@ -78,6 +189,11 @@ class Process:
 
         self.logger = logging.getLogger(str(self))
 
+        self._receivers = {}        # Signal name -> ([plain functions], [coroutine functions])
+        self._signal_names = None   # frozenset of signals(), built on first use
+        self._emit_policies = {}    # Signal name (None for any signal) -> EmitPolicy
+        self._receiver_stats = {}   # Signal name -> {receiver: ReceiverStats}
+
     def __str__(self):
         return f'{self.name}.{self.id}'
 
@@ -92,22 +208,134 @@ class Process:
         inherited = super().signals() if hasattr(super(), 'signals') else []
         return chain(mine, inherited)
 
+    def supports(self, name):
+        """Return True if `name` is one of :meth:`signals`"""
+        if self._signal_names is None:
+            self._signal_names = frozenset(self.signals())
+        return name in self._signal_names
+
     def connect(self, name, callable):
         """
         Connect callable to signal with given name, i.e., arrange so that
         callable is called each time signal is emitted. Callable is held on
         strongly.
         """
-        assert name in self.signals(), "signal %s not supported by %s" % (name, self)
+        assert self.supports(name), "signal %s not supported by %s" % (name, self)
+        functions, coroutines = self._receivers.setdefault(name, ([], []))
+        receivers = coroutines if iscoroutinefunction(callable) else functions
+        if callable not in receivers:
+            receivers.append(callable)
         signal(name).connect(callable, sender=self, weak=False)
 
+    def disconnect(self, name, callable):
+        """Stop calling `callable` when signal `name` is emitted"""
+        for receivers in self._receivers.get(name, ()):
+            if callable in receivers:
+                receivers.remove(callable)
+        if not any(self._receivers.get(name, ())):
+            self._receivers.pop(name, None)
+        signal(name).disconnect(callable, sender=self)
+
+    def set_emit_policy(self, policy, *names):
+        """Emit signals `names` (or every signal, if none are given) following `policy`
+
+           Args:
+              policy (:class:`EmitPolicy` or str) : How to run the receivers (None to go back to the default)
+              names (str) : Signals it applies to
+        """
+        policy = None if policy is None else EmitPolicy.of(policy)
+        for name in names or (None,):
+            assert name is None or self.supports(name), "signal %s not supported by %s" % (name, self)
+            if policy is None:
+                self._emit_policies.pop(name, None)
+            else:
+                self._emit_policies[name] = policy
+
+    def emit_stats(self):
+        """Return {signal name: {receiver name: stats}} for the signals emitted under an :class:`EmitPolicy`
+
+           Each receiver's stats are those of :meth:`ReceiverStats.stats`.  Receivers
+           are named by their qualified name, numbered (``name#2``) if several share one.
+        """
+        result = {}
+        for name, receivers in self._receiver_stats.items():
+            named = result[name] = {}
+            for receiver, stats in receivers.items():
+                receiver_name = base = getattr(receiver, '__qualname__', repr(receiver))
+                count = 1
+                while receiver_name in named:
+                    count += 1
+                    receiver_name = f'{base}#{count}'
+                named[receiver_name] = stats.stats()
+        return result
+
     async def emit(self, name, *args, **kwargs):
         """
         Emit given signal, i.e., call all handlers connected to it, passing
         *args and **kwargs to the handler
+
+        Plain functions are called first, then the coroutines are awaited
+        one after the other, in the order they were connected (or as the
+        signal's :class:`EmitPolicy` says, if it has one).
         """
-        assert name in self.signals(), "signal %s not supported by %s" % (name, self)
-        await signal(name).emit(self, *args, **kwargs)
+        receivers = self._receivers.get(name)
+        if receivers is None:
+            assert self.supports(name), "signal %s not supported by %s" % (name, self)
+            return
+        if self._emit_policies:
+            policy = self._emit_policies.get(name, self._emit_policies.get(None))
+            if policy is not None:
+                await self._emit_guarded(name, policy, receivers, args, kwargs)
+                return
+        functions, coroutines = receivers
+        for receiver in functions:
+            receiver(self, *args, **kwargs)
+        for receiver in coroutines:
+            await receiver(self, *args, **kwargs)
+
+    async def _emit_guarded(self, name, policy, receivers, args, kwargs):
+        stats = self._receiver_stats.setdefault(name, {})
+        functions, coroutines = receivers
+        for receiver in chain(functions, coroutines):
+            if receiver not in stats:
+                stats[receiver] = ReceiverStats()
+        for receiver in functions:
+            receiver_stats = stats[receiver]
+            start = time.monotonic()
+            receiver_stats.calls += 1
+            try:
+                receiver(self, *args, **kwargs)
+            except Exception as e:
+                receiver_stats.errors += 1
+                self.message_error(f'Receiver {receiver!r} of {name} failed: {e!r}')
+                continue
+            receiver_stats.latencies.append(time.monotonic() - start)
+        calls = [self._call_receiver(name, receiver, stats[receiver], policy.timeout, args, kwargs)
+                 for receiver in coroutines]
+        if policy.mode == 'concurrent' and len(calls) > 1:
+            await gather(*calls)
+        else:
+            for call in calls:
+                await call
+
+    async def _call_receiver(self, name, receiver, stats, timeout, args, kwargs):
+        start = time.monotonic()
+        stats.calls += 1
+        try:
+            if timeout is None:
+                await receiver(self, *args, **kwargs)
+            else:
+                await wait_for(receiver(self, *args, **kwargs), timeout)
+        except TimeoutError:
+            stats.timeouts += 1
+            self.message_error(f'Receiver {receiver!r} of {name} took longer than {timeout}s')
+        except CancelledError:
+            raise
+        except Exception as e:
+            stats.errors += 1
+            self.message_error(f'Receiver {receiver!r} of {name} failed: {e!r}')
+        else:
+            stats.latencies.append(time.monotonic() - start)
 
     def message(self, m : str , level = logging.INFO):
         """Print message *m* if its level is lower than the instance level"""
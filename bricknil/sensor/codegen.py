@@ -0,0 +1,139 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Peripheral classes from captured port info
+
+Connect to a hub with `query_port_info=True` (and a
+:class:`bricknil.port_info_cache.PortInfoCache`), then turn what the devices
+reported into a module of peripheral classes::
+
+    python -m bricknil.sensor.codegen ~/.bricknil/port_info_cache.json -o my_devices.py
+
+The generated classes are written out like the hand-written ones in
+:mod:`bricknil.sensor.sensor`:  the capability enum, datasets (with
+signedness and, with `--si`, scaling to SI units) and allowed combinations
+are literals, so importing them doesn't go through
+:class:`bricknil.sensor.peripheral.PeripheralDefinition`.  Devices that
+`bricknil.const.DEVICES` doesn't know about are registered by the module.
+
+:func:`peripheral_class` builds the same class at runtime instead.
+
+The input is JSON, either a port info cache file or a dump of
+:attr:`bricknil.hub.Hub.port_info` (port -> info).
+"""
+import sys, json, argparse
+
+from ..const import DEVICES
+from .peripheral import Peripheral, PeripheralDefinition, compile_definition
+
+def class_name(device_name):
+    """'Technic Control+ Large Motor' -> 'TechnicControlLargeMotor'"""
+    words = ''.join(c if c.isalnum() else ' ' for c in device_name).split()
+    name = ''.join(w[0].upper() + w[1:] for w in words)
+    return name if name and not name[0].isdigit() else f'Device{name}'
+
+def load_port_info(path):
+    """Read the port info of every device in a port info cache file or `Hub.port_info` dump
+
+       Returns:
+          list [dict] : Port info of each device, with its 'id' and 'name' filled in
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    if 'modes' in entries:
+        entries = {'': entries}
+    devices = {}
+    for key, info in entries.items():
+        if 'modes' not in info:
+            continue
+        info = dict(info)
+        if 'id' not in info:
+            # Port info cache keys are "id|hw version|sw version"
+            info['id'] = int(key.split('|')[0])
+        info.setdefault('name', DEVICES.get(info['id'], f'Device {info["id"]}'))
+        info['modes'] = {int(mode): mode_info for mode, mode_info in info['modes'].items()}
+        devices.setdefault(info['id'], info)
+    return list(devices.values())
+
+def peripheral_source(properties, base='Peripheral', si_units=False):
+    """Return the source of a peripheral class for the device described by `properties`"""
+    modes, combo = compile_definition(properties, si_units)
+    names = {m.mode: m.name for m in modes}
+    lines = [f'class {class_name(properties["name"])}({base}):',
+             f'    """{properties["name"]} (generated from its port info)"""',
+             f'    _sensor_id = 0x{properties["id"]:04X}',
+             '    capability = Enum("capability",',
+             '                      [' + ',\n                       '.join(f"('{m.name}', {m.mode})" for m in modes) + ',',
+             '                       ])',
+             '',
+             '    datasets = { ' + ',\n                 '.join(
+                 f'capability.{m.name}: Peripheral.Dataset(nvalues={m.nvalues}, nbytes={m.nbytes}, '
+                 f'minval={m.minval!r}, maxval={m.maxval!r}, signed={m.signed}, scale={m.scale!r})' for m in modes) + ',',
+             '               }',
+             '',
+             '    allowed_combo = [ ' + ''.join(f'capability.{names[mode]},\n                      ' for mode in combo) + ']',
+             ]
+    return '\n'.join(lines) + '\n'
+
+def module_source(devices, base='Peripheral', si_units=False, source=''):
+    """Return the source of a module with a peripheral class for each device"""
+    lines = [f'"""Peripherals generated by bricknil.sensor.codegen{" from " + source if source else ""}',
+             '',
+             'Regenerate instead of editing this file.',
+             '"""',
+             'from enum import Enum',
+             '',
+             'from bricknil.const import DEVICES',
+             'from bricknil.sensor.peripheral import Peripheral',
+             ]
+    if base != 'Peripheral':
+        lines.append(f'from bricknil.sensor import {base}')
+    lines.append('')
+    for info in devices:
+        if info['id'] not in DEVICES:
+            lines.append(f'DEVICES.setdefault(0x{info["id"]:04X}, {info["name"]!r})')
+    for info in devices:
+        lines.extend(['', '', peripheral_source(info, base, si_units)])
+    return '\n'.join(lines)
+
+def peripheral_class(properties, base=Peripheral, si_units=False, name=None):
+    """Build a peripheral class at runtime from the port info of a device
+
+       Args:
+          properties (dict) : Port info of the device, with its 'id' and 'name'
+          base (class) : Class to derive from (e.g. :class:`bricknil.sensor.motor.TachoMotor` for a motor)
+          si_units (bool) : Scale readings to SI units
+          name (str) : Class name (default derived from the device name)
+    """
+    DEVICES.setdefault(properties['id'], properties['name'])
+    cls = type(name or class_name(properties['name']), (base,), {'__doc__': f'{properties["name"]} (built from its port info)'})
+    return PeripheralDefinition(properties, si_units)(cls)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate peripheral classes from captured port info')
+    parser.add_argument('port_info', help='Port info cache file or JSON dump of Hub.port_info')
+    parser.add_argument('-o', '--output', help='Module to write (default stdout)')
+    parser.add_argument('--base', default='Peripheral', help='Base class from bricknil.sensor (e.g. TachoMotor)')
+    parser.add_argument('--si', action='store_true', help='Scale readings to SI units')
+    args = parser.parse_args(argv)
+
+    source = module_source(load_port_info(args.port_info), args.base, args.si, args.port_info)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+
+if __name__ == '__main__':
+    main()
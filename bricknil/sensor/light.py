@@ -30,6 +30,10 @@ class LED(Peripheral):
     """
     _sensor_id = 0x0017
 
+    def __init__(self, name, port=None, capabilities=[]):
+        self.color = None  # Last color set
+        super().__init__(name, port, capabilities)
+
     async def set_color(self, color: Color):
         """ Converts a Color enumeration to a color value"""
 
@@ -38,8 +42,14 @@ class LED(Peripheral):
         col = color.value
         assert col < 11
         mode = 0
+        self.color = color
         await self.set_output(mode, col)
 
+    async def restore_state(self):
+        """Set the LED back to the last color set"""
+        if self.color is not None:
+            await self.set_color(self.color)
+
 
 class Light(Peripheral):
     """
@@ -55,6 +65,13 @@ class Light(Peripheral):
     """
     _sensor_id = 0x0008
 
+    # Brightness is usually streamed (fades, blinking), so don't wait on acknowledgments
+    response = False
+
+    def __init__(self, name, port=None, capabilities=[]):
+        self.brightness = None  # Last brightness set
+        super().__init__(name, port, capabilities)
+
     async def set_brightness(self, brightness: int):
         """Sets the brightness of the light.
 
@@ -63,6 +80,12 @@ class Light(Peripheral):
                 -100 or 100 are both maximum brightness.
         """
         mode = 0
+        self.brightness = brightness
         brightness, = pack('b', int(brightness))
         await self.set_output(mode, brightness)
 
+    async def restore_state(self):
+        """Set the light back to the last brightness set"""
+        if self.brightness is not None:
+            await self.set_brightness(self.brightness)
+
@@ -18,7 +18,7 @@ from asyncio import sleep, current_task, create_task as spawn  # Needed for moto
 from enum import Enum
 from struct import pack
 
-from .peripheral import Peripheral, PeripheralDefinition
+from .peripheral import Peripheral
 
 class Motor(Peripheral):
     """Utility class for common functions shared between Train Motors, Internal Motors, and External Motors
@@ -29,7 +29,7 @@ class Motor(Peripheral):
         self.ramp_in_progress_task = None
         super().__init__(name, port, capabilities)
 
-    async def set_speed(self, speed):
+    async def set_speed(self, speed, response=None):
         """ Validate and set the train speed
 
             If there is an in-progress ramp, and this command is not part of that ramp,
@@ -39,26 +39,32 @@ class Motor(Peripheral):
                 speed (int) : Range -100 to 100 where negative numbers are reverse.
                     Use 0 to put the motor into neutral.
                     255 will do a hard brake - according to "peripherial.py _convert_speed_to_val" ist should be "127" (?)
+                response (bool) : Use an acknowledged write (None for this motor's `response` setting)
         """
         await self._cancel_existing_differet_ramp()
         self.speed = speed
         self.message_info(f'Setting speed to {speed}')
-        await self.set_output(0, self._convert_speed_to_val(speed))
+        await self.set_output(0, self._convert_speed_to_val(speed), response=response)
+
+    async def restore_state(self):
+        """Spin the motor back up to the last commanded speed"""
+        if self.speed:
+            await self.set_output(0, self._convert_speed_to_val(self.speed))
 
     async def _cancel_existing_differet_ramp(self):
         """Cancel the existing speed ramp if it was from a different task
 
-            Remember that speed ramps must be a task with daemon=True, so there is no
+            Remember that speed ramps run in their own task, so there is no
             one awaiting its future.
         """
         # Check if there's a ramp task in progress
         if self.ramp_in_progress_task:
             # Check if it's this current task or not
-            current = await current_task()
+            current = current_task()
             if current != self.ramp_in_progress_task:
                 # We're trying to set the speed
                 # outside a previously in-progress ramp, so cancel the previous ramp
-                await self.ramp_in_progress_task.cancel()
+                self.ramp_in_progress_task.cancel()
                 self.ramp_in_progress_task = None
                 self.message_debug(f'Canceling previous speed ramp in progress')
 
@@ -66,6 +72,8 @@ class Motor(Peripheral):
     async def ramp_speed(self, target_speed, ramp_time_ms):
         """Ramp the speed by 10 units in the time given in milliseconds
 
+           The intermediate speeds are sent with unacknowledged writes, since
+           the next step replaces them anyway.  The final speed is acknowledged.
         """
         TIME_STEP_MS = 100
         await self._cancel_existing_differet_ramp()
@@ -88,13 +96,13 @@ class Motor(Peripheral):
                 current_step +=1
                 if current_step == number_of_steps:
                     next_speed = target_speed
-                await self.set_speed(next_speed)
+                await self.set_speed(next_speed, response=False)
                 await sleep(TIME_STEP_MS/1000)
             await self.set_speed(target_speed)
             self.ramp_in_progress_task = None
 
         self.message_debug(f'Starting ramp of speed: {start_speed} -> {target_speed} ({ramp_time_ms/1000}s)')
-        self.ramp_in_progress_task = await spawn(_ramp_speed, daemon = True)
+        self.ramp_in_progress_task = spawn(_ramp_speed())
 
 class TachoMotor(Motor):
 
@@ -139,7 +147,7 @@ class TachoMotor(Motor):
         await self.send_message(f'reset pos to {value}', b)
 
 
-    async def set_pos(self, pos, speed=50, max_power=50):
+    async def set_pos(self, pos, speed=50, max_power=50, completion=False):
         """Set the absolute position of the motor
 
            Everytime the hub is powered up, the zero-angle reference will be reset to the
@@ -155,10 +163,19 @@ class TachoMotor(Motor):
               await self.motor.set_pos(-90)  # Rotate conter-clockwise 90 degrees
               await self.motor.set_pos(720)  # Rotate two full circles clockwise
 
+              # Wait until the motor gets there before doing the next move
+              done = await self.motor.set_pos(90, completion=True)
+              await done
+
            Args:
               pos (int) : Absolute position in degrees.
               speed (int) : Absolute value from 0-100
               max_power (int):  Max percentage power that will be applied (0-100%)
+              completion (bool) : Return an awaitable that resolves when the move is completed
+                  (see :meth:`Peripheral.set_output`)
+
+           Returns:
+              `asyncio.Future` if `completion` is True, otherwise None
 
            Notes:
 
@@ -179,10 +196,10 @@ class TachoMotor(Motor):
         speed = self._convert_speed_to_val(speed)
 
         b = [0x00, 0x81, self.port, 0x11, 0x0d] + abs_pos + [speed, max_power, 126, 0]
-        await self.send_message(f'set pos {pos} with speed {speed}', b)
+        return await self.send_message(f'set pos {pos} with speed {speed}', b, completion=completion)
 
 
-    async def rotate(self, degrees, speed, max_power=50):
+    async def rotate(self, degrees, speed, max_power=50, completion=False):
         """Rotate the given number of degrees from current position, with direction given by sign of speed
 
            Examples::
@@ -191,10 +208,19 @@ class TachoMotor(Motor):
               await self.motor.set_pos(90, speed=-50)  # Rotate conter-clockwise 90 degrees
               await self.motor.set_pos(720, speed=50)  # Rotate two full circles clockwise
 
+              # Two back-to-back moves, without guessing how long the first one takes
+              await (await self.motor.rotate(90, speed=50, completion=True))
+              await (await self.motor.rotate(90, speed=-50, completion=True))
+
            Args:
               degrees (uint) : Relative number of degrees to rotate
               speed (int) : -100 to 100
               max_power (int):  Max percentage power that will be applied (0-100%)
+              completion (bool) : Return an awaitable that resolves when the rotation is completed
+                  (see :meth:`Peripheral.set_output`)
+
+           Returns:
+              `asyncio.Future` if `completion` is True, otherwise None
 
            Notes:
 
@@ -215,7 +241,7 @@ class TachoMotor(Motor):
         speed = self._convert_speed_to_val(speed)
 
         b = [0x00, 0x81, self.port, 0x11, 0x0b] + degrees + [speed, max_power, 126, 3]
-        await self.send_message(f'rotate {degrees} deg with speed {speed}', b)
+        return await self.send_message(f'rotate {degrees} deg with speed {speed}', b, completion=completion)
 
 
     async def ramp_speed2(self, target_speed, ramp_time_ms): # pragma: no cover
@@ -320,79 +346,7 @@ class ExternalMotor(TachoMotor):
 
     _sensor_id = 0x26
 
-@PeripheralDefinition(
-        {  'combinable': 4,
-           'id': 46,
-           'input': 2,
-           'mode_combinations': [[1, 2, 3]],
-           'modes': {   0: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 1,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input_mapping': [],
-                               'name': 'POWER',
-                               'output': True,
-                               'output_mapping': ['Absolute'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-100.0, 100.0),
-                               'si_range': (-100.0, 100.0),
-                               'symbol': 'PCT'},
-                        1: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 4,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Absolute'],
-                               'name': 'SPEED',
-                               'output': True,
-                               'output_mapping': ['Absolute'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-100.0, 100.0),
-                               'si_range': (-100.0, 100.0),
-                               'symbol': 'PCT'},
-                        2: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 4,
-                               'dataset_type': '32b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'POS',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-360.0, 360.0),
-                               'si_range': (-360.0, 360.0),
-                               'symbol': 'DEG'},
-                        3: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 3,
-                               'dataset_type': '16b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'APOS',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-360.0, 360.0),
-                               'si_range': (-360.0, 360.0),
-                               'symbol': 'DEG'},
-                        4: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 1,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'LOAD',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (0.0, 100.0),
-                               'raw_range': (0.0, 127.0),
-                               'si_range': (0.0, 127.0),
-                               'symbol': 'PCT'}},
-           'name': 'Technic Control+ Large Motor',
-           'output': 1,
-           'synchronizable': 8}
-)
+
 class CPlusLargeMotor(TachoMotor):
     """ Access the Technic Control Plus Large motors
 
@@ -412,6 +366,10 @@ class CPlusLargeMotor(TachoMotor):
             # Only report back when speed change exceeds 5 units, and position changes (degrees)
             @attach(CPlusLargeMotor, name='motor', capabilities=[('sense_speed', 5), 'sense_pos'])
 
+        Only `sense_speed`, `sense_pos` and `sense_apos` can be sensed together (the
+        motor reports modes 1-3 as its only mode combination); `sense_load` has to be
+        sensed on its own.
+
         And then within the run body::
 
             await self.motor.set_speed(50)   # Setting the speed
@@ -424,81 +382,29 @@ class CPlusLargeMotor(TachoMotor):
             * :class:`InternalMotor` for connecting to the Boost hub built-in motors
 
     """
-    pass
-
-@PeripheralDefinition(
-        {  'combinable': 4,
-           'id': 47,
-           'input': 2,
-           'mode_combinations': [[1, 2, 3]],
-           'modes': {   0: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 1,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input_mapping': [],
-                               'name': 'POWER',
-                               'output': True,
-                               'output_mapping': ['Absolute'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-100.0, 100.0),
-                               'si_range': (-100.0, 100.0),
-                               'symbol': 'PCT'},
-                        1: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 4,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Absolute'],
-                               'name': 'SPEED',
-                               'output': True,
-                               'output_mapping': ['Absolute'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-100.0, 100.0),
-                               'si_range': (-100.0, 100.0),
-                               'symbol': 'PCT'},
-                        2: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 4,
-                               'dataset_type': '32b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'POS',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-360.0, 360.0),
-                               'si_range': (-360.0, 360.0),
-                               'symbol': 'DEG'},
-                        3: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 3,
-                               'dataset_type': '16b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'APOS',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (-100.0, 100.0),
-                               'raw_range': (-360.0, 360.0),
-                               'si_range': (-360.0, 360.0),
-                               'symbol': 'DEG'},
-                        4: {   'dataset_decimals': 0,
-                               'dataset_total_figures': 1,
-                               'dataset_type': '8b',
-                               'datasets': 1,
-                               'input': True,
-                               'input_mapping': ['Relative'],
-                               'name': 'LOAD',
-                               'output': True,
-                               'output_mapping': ['Relative'],
-                               'pct_range': (0.0, 100.0),
-                               'raw_range': (0.0, 127.0),
-                               'si_range': (0.0, 127.0),
-                               'symbol': 'PCT'}},
-           'name': 'Technic Control+ XL Motor',
-           'output': 1,
-           'synchronizable': 8}
-)
+
+    _sensor_id = 0x002E
+    capability = Enum("capability",
+                      [('sense_power', 0),
+                       ('sense_speed', 1),
+                       ('sense_pos', 2),
+                       ('sense_apos', 3),
+                       ('sense_load', 4),
+                       ])
+
+    datasets = { capability.sense_power: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_speed: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_pos: Peripheral.Dataset(nvalues=1, nbytes=4, minval=-360.0, maxval=360.0, signed=True, scale=1),
+                 capability.sense_apos: Peripheral.Dataset(nvalues=1, nbytes=2, minval=-360.0, maxval=360.0, signed=True, scale=1),
+                 capability.sense_load: Peripheral.Dataset(nvalues=1, nbytes=1, minval=0.0, maxval=127.0, signed=False, scale=1),
+               }
+
+    allowed_combo = [ capability.sense_speed,
+                      capability.sense_pos,
+                      capability.sense_apos,
+                      ]
+
+
 class CPlusXLMotor(TachoMotor):
     """ Access the Technic Control Plus XL motors
 
@@ -518,6 +424,10 @@ class CPlusXLMotor(TachoMotor):
             # Only report back when speed change exceeds 5 units, and position changes (degrees)
             @attach(CPlusXLMotor, name='motor', capabilities=[('sense_speed', 5), 'sense_pos'])
 
+        Only `sense_speed`, `sense_pos` and `sense_apos` can be sensed together (the
+        motor reports modes 1-3 as its only mode combination); `sense_load` has to be
+        sensed on its own.
+
         And then within the run body::
 
             await self.motor.set_speed(50)   # Setting the speed
@@ -530,83 +440,53 @@ class CPlusXLMotor(TachoMotor):
             * :class:`InternalMotor` for connecting to the Boost hub built-in motors
 
     """
-    pass
-
-
-@PeripheralDefinition(
-{'combinable': 4,
-     'id': 76,
-     'input': 2,
-     'mode_combinations': [[1, 2, 3]],
-     'modes': {0: {'dataset_decimals': 0,
-                   'dataset_total_figures': 4,
-                   'dataset_type': '8b',
-                   'datasets': 1,
-                   'input_mapping': [],
-                   'name': 'POWER',
-                   'output': True,
-                   'output_mapping': ['Absolute',
-                                      'Supports Functional Mapping 2.0}'],
-                   'pct_range': (-100.0, 100.0),
-                   'raw_range': (-100.0, 100.0),
-                   'si_range': (-100.0, 100.0),
-                   'symbol': 'PCT'},
-               1: {'dataset_decimals': 0,
-                   'dataset_total_figures': 4,
-                   'dataset_type': '8b',
-                   'datasets': 1,
-                   'input': True,
-                   'input_mapping': ['Absolute', 'NA'],
-                   'name': 'SPEED',
-                   'output': True,
-                   'output_mapping': ['Absolute',
-                                      'NA',
-                                      'Supports Functional Mapping 2.0}'],
-                   'pct_range': (-100.0, 100.0),
-                   'raw_range': (-100.0, 100.0),
-                   'si_range': (-100.0, 100.0),
-                   'symbol': 'PCT'},
-               2: {'dataset_decimals': 0,
-                   'dataset_total_figures': 11,
-                   'dataset_type': '32b',
-                   'datasets': 1,
-                   'input': True,
-                   'input_mapping': ['Relative', 'NA'],
-                   'name': 'POS',
-                   'output': True,
-                   'output_mapping': ['Relative',
-                                      'NA',
-                                      'Supports Functional Mapping 2.0}'],
-                   'pct_range': (-100.0, 100.0),
-                   'raw_range': (-360.0, 360.0),
-                   'si_range': (-360.0, 360.0),
-                   'symbol': 'DEG'},
-               3: {'dataset_decimals': 0,
-                   'dataset_total_figures': 3,
-                   'dataset_type': '16b',
-                   'datasets': 1,
-                   'input': True,
-                   'input_mapping': ['NA', 'Absolute', 'NA'],
-                   'name': 'APOS',
-                   'output': True,
-                   'output_mapping': ['NA',
-                                      'Absolute',
-                                      'NA',
-                                      'Supports Functional Mapping 2.0}'],
-                   'pct_range': (-200.0, 200.0),
-                   'raw_range': (-180.0, 179.0),
-                   'si_range': (-180.0, 179.0),
-                   'symbol': 'DEG'}},
-     'name': 'Technic Control+ Large Angular Position Motor',
-     'output': 1,
-     'synchronizable': 8}
-)
+
+    _sensor_id = 0x002F
+    capability = Enum("capability",
+                      [('sense_power', 0),
+                       ('sense_speed', 1),
+                       ('sense_pos', 2),
+                       ('sense_apos', 3),
+                       ('sense_load', 4),
+                       ])
+
+    datasets = { capability.sense_power: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_speed: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_pos: Peripheral.Dataset(nvalues=1, nbytes=4, minval=-360.0, maxval=360.0, signed=True, scale=1),
+                 capability.sense_apos: Peripheral.Dataset(nvalues=1, nbytes=2, minval=-360.0, maxval=360.0, signed=True, scale=1),
+                 capability.sense_load: Peripheral.Dataset(nvalues=1, nbytes=1, minval=0.0, maxval=127.0, signed=False, scale=1),
+               }
+
+    allowed_combo = [ capability.sense_speed,
+                      capability.sense_pos,
+                      capability.sense_apos,
+                      ]
+
+
 class CPlusLargeAngularPositionMotor(TachoMotor):
     """ Access the Technic Control Plus Large Angular Position motors
 
         Not tested yet !!!
     """
-    pass
+
+    _sensor_id = 0x004C
+    capability = Enum("capability",
+                      [('sense_power', 0),
+                       ('sense_speed', 1),
+                       ('sense_pos', 2),
+                       ('sense_apos', 3),
+                       ])
+
+    datasets = { capability.sense_power: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_speed: Peripheral.Dataset(nvalues=1, nbytes=1, minval=-100.0, maxval=100.0, signed=True, scale=1),
+                 capability.sense_pos: Peripheral.Dataset(nvalues=1, nbytes=4, minval=-360.0, maxval=360.0, signed=True, scale=1),
+                 capability.sense_apos: Peripheral.Dataset(nvalues=1, nbytes=2, minval=-180.0, maxval=179.0, signed=True, scale=1),
+               }
+
+    allowed_combo = [ capability.sense_speed,
+                      capability.sense_pos,
+                      capability.sense_apos,
+                      ]
 
 
 class TrainMotor(Motor):
@@ -15,58 +15,183 @@
 """Base class for all sensors and motors
 
 """
-import struct
+import struct, logging
 from enum import Enum
 from itertools import chain
 from collections import namedtuple
 
-from ..process import Process
-from asyncio import sleep, current_task, create_task as spawn
+from ..process import Process, LoopEvent
 from ..const import DEVICES
 
+ModeDefinition = namedtuple('ModeDefinition', ['mode', 'name', 'nvalues', 'nbytes', 'minval', 'maxval', 'signed', 'scale'])
+"""One sensing mode of a peripheral, compiled from its port info (see :func:`compile_definition`)"""
+
+DATASET_BYTES = {'8b': 1, '16b': 2, '32b': 4}
+
+logger = logging.getLogger(__name__)
+
+def capability_name(mode_name):
+    """Return the `capability` member name ('sense_speed') for a mode name reported by the hub ('SPEED')"""
+    return 'sense_' + ''.join(c if c.isalnum() else '_' for c in mode_name.lower())
+
+def compile_definition(properties, si_units=False):
+    """Boil a port info dict (as collected in :attr:`bricknil.hub.Hub.port_info`) down to what a peripheral class needs
+
+       * Values are signed if the raw range has negative values
+       * With `si_units`, values are scaled from the raw range to the SI range
+       * Only modes that appear in one of the `mode_combinations` can be combined
+         (all of them if the hub didn't report its combinations)
+
+       Modes without a name or value format (the hub didn't answer those queries) are left out.
+
+       Args:
+          properties (dict) : Port info of one device
+          si_units (bool) : Scale values to SI units
+
+       Returns:
+          (list [`ModeDefinition`], list [int]) : Modes, and the mode numbers that are allowed in combinations
+    """
+    modes = []
+    for mode, info in sorted(properties['modes'].items()):
+        if 'name' not in info or 'dataset_type' not in info:
+            continue
+        if info['dataset_type'] not in DATASET_BYTES:
+            raise Exception(f'Unssuported dataset bitwidth: {info["dataset_type"]}')
+        raw_min, raw_max = info.get('raw_range', (0, 0))
+        scale = 1
+        if si_units and 'si_range' in info and raw_max != raw_min:
+            si_min, si_max = info['si_range']
+            if (si_min, si_max) != (raw_min, raw_max):
+                scale = (si_max - si_min) / (raw_max - raw_min)
+        modes.append(ModeDefinition(mode, capability_name(info['name']), info['datasets'],
+                                    DATASET_BYTES[info['dataset_type']], raw_min, raw_max, raw_min < 0, scale))
+
+    if not properties.get('combinable'):
+        combo = []
+    elif properties.get('mode_combinations'):
+        combinable = set(chain.from_iterable(properties['mode_combinations']))
+        combo = [m.mode for m in modes if m.mode in combinable]
+    else:
+        combo = [m.mode for m in modes]
+    return modes, combo
+
 class PeripheralDefinition(object):
     """Class decorator to automagically define peripheral based on definition
        dictionary. See users
+
+       Args:
+          properties (dict) : Port info of the device (see :func:`compile_definition`)
+          si_units (bool) : Scale readings to SI units instead of reporting raw values
     """
-    def __init__(self, properties):
+    def __init__(self, properties, si_units=False):
         self._props = properties
+        self.si_units = si_units
 
     def __call__(self, cls):
         # Define _sensor_id
         cls._sensor_id = self._props['id']
 
-        # Define capabilities
-        def make_name(dataset_def):
-            return 'sense_' + dataset_def['name'].lower()
+        modes, combo = compile_definition(self._props, self.si_units)
 
-        cls.capability = Enum('capability', [(make_name(p), i) for i, p in self._props['modes'].items()])
+        # Define capabilities
+        cls.capability = Enum('capability', [(m.name, m.mode) for m in modes])
 
         # Define datasets
-        def make_dataset(dataset_def):
-            def make_nbytes(string):
-                if string == '8b':
-                    return 1
-                elif string == '16b':
-                    return 2
-                elif string == '32b':
-                    return 4
-                else:
-                    raise Exception(f'Unssuported dataset bitwidth: {string}')
-
-            return Peripheral.Dataset(nvalues=dataset_def['datasets'],
-                                      nbytes=make_nbytes(dataset_def['dataset_type']),
-                                      minval=dataset_def['raw_range'][0],
-                                      maxval=dataset_def['raw_range'][1])
-        cls.datasets = { cls.capability(i) : make_dataset(p) for i, p in self._props['modes'].items()}
+        cls.datasets = { cls.capability(m.mode) : Peripheral.Dataset(*m[2:]) for m in modes}
 
         # Define allowed_combo
-        if self._props['combinable'] == 0:
-            cls.allowed_combo = []
-        else:
-            cls.allowed_combo = [cap for cap in cls.capability.__members__.values()]
+        cls.allowed_combo = [cls.capability(mode) for mode in combo]
 
         return cls
 
+class ValueDecoder:
+    """Decodes port value messages for a fixed set of enabled capabilities
+
+       The layout of every message that can arrive is worked out once, so an
+       update is a single `struct` unpack:  one layout for a single capability,
+       or one per bitmask pattern in combined mode (a combined mode message only
+       carries the readings of the capabilities whose bit is set).
+
+       Args:
+          datasets (dict) : Capability -> `Peripheral.Dataset` (or (nvalues, nbytes) tuple)
+          capabilities (list [`capability`]) : Enabled capabilities, in the order they were configured
+
+       Attributes:
+          combined (bool) : Messages start with a 16-bit mask of the capabilities they include
+          layouts (dict) : Bitmask -> (`struct.Struct`, list of (capability, first index, nvalues, scale))
+    """
+    FORMATS = { (1, True): 'b', (2, True): 'h', (4, True): 'i',
+                (1, False): 'B', (2, False): 'H', (4, False): 'I' }
+
+    def __init__(self, datasets, capabilities):
+        self.combined = len(capabilities) > 1
+        fields = []
+        for capability in capabilities:
+            dataset = datasets[capability]
+            nvalues, nbytes = dataset[0:2]
+            signed = getattr(dataset, 'signed', True)
+            scale = getattr(dataset, 'scale', 1)
+            if (nbytes, signed) not in self.FORMATS:
+                raise ValueError(f'Unsupported dataset width {nbytes} for {capability}')
+            fields.append((capability, nvalues, self.FORMATS[(nbytes, signed)] * nvalues, scale))
+
+        if self.combined:
+            patterns = range(1, 1<<len(capabilities))
+        else:
+            patterns = [1]
+        self.layouts = {}
+        for bitmask in patterns:
+            fmt = '<'
+            slots = []
+            for index, (capability, nvalues, value_fmt, scale) in enumerate(fields):
+                if bitmask & (1<<index):
+                    slots.append((capability, len(fmt)-1, nvalues, scale))
+                    fmt += value_fmt
+            self.layouts[bitmask] = (struct.Struct(fmt), slots)
+
+    def decode(self, msg, value):
+        """Unpack the readings in `msg` into `value`
+
+           Single readings replace the dict entry, while multi-value readings
+           (like RGB) are updated in place in the existing list.
+
+           Args:
+              msg (bytes) : Port value payload (bytes, bytearray or memoryview)
+              value (dict) : Capability -> reading
+
+           A combined mode message whose bitmask doesn't match the configured
+           capabilities (e.g. a stale combination left on the hub after a
+           reconnect) is logged and ignored.
+
+           Returns:
+              list [`capability`] : Capabilities whose readings were updated
+        """
+        if self.combined:
+            # First two bytes define a bitmask of (configured) capabilities
+            # whose readings are in this message. Leading byte should be 0 since
+            # we never have more than 7 datasets even with all the combo modes
+            # activated. Second byte is the actual bitmask.
+            entry = self.layouts.get(msg[1]) if msg[0] == 0 else None
+            if entry is None:
+                logger.error(f'Ignoring reading with unexpected capability bitmask {bytes(msg[0:2]).hex()}')
+                return []
+            layout, slots = entry
+            readings = layout.unpack_from(msg, 2)
+        else:
+            layout, slots = self.layouts[1]
+            readings = layout.unpack_from(msg, 0)
+        updated = []
+        for capability, start, nvalues, scale in slots:
+            if nvalues == 1:
+                value[capability] = readings[start] if scale == 1 else readings[start]*scale
+            elif scale == 1:
+                value[capability][:] = readings[start:start+nvalues]
+            else:
+                value[capability][:] = [v*scale for v in readings[start:start+nvalues]]
+            updated.append(capability)
+        return updated
+
+
 class Peripheral(Process):
     """Abstract base class for any Lego Boost/PoweredUp/WeDo peripherals
 
@@ -132,21 +257,46 @@ class Peripheral(Process):
             port (int) : Physical port on the hub this Peripheral attaches to
             sensor_name (str) : Name coming out of `const.DEVICES`
             value (dict) : Sensor readings get dumped into this dict
+            decoder (`ValueDecoder`) : Decodes value updates for the enabled capabilities (built by :meth:`activate_updates`)
             message_handler (func) : Outgoing message queue to `BLEventQ` that's set by the Hub when an attach message is seen
+            handler_ready (`bricknil.process.LoopEvent`) : Set once :attr:`message_handler` is, so commands can wait for it
             capabilites (list [ `capability` ]) : Support capabilities
             thresholds (list [ int ]) : Integer list of thresholds for updates for each of the sensing capabilities
+            response (bool) : Use acknowledged writes for :meth:`set_output` commands (set this to False to
+                send setpoints as fast as the link allows, without waiting on a link-layer acknowledgment)
+            mailbox_depth (int) : Readings from this peripheral kept waiting for the hub, newest first, when they
+                arrive faster than they're handled (None to keep every reading)
+            handler_policy (str or `bricknil.handlers.HandlerPolicy`) : How the hub runs this peripheral's
+                `<name>_change` handler when readings arrive faster than it finishes ('serial', 'latest' or 'concurrent').
+                The default, 'serial', handles readings in order, but keeps at most `mailbox_depth` waiting
+            required (bool) : :meth:`bricknil.hub.Hub.connect` waits for this peripheral to attach (set this to
+                False for a peripheral that may not be plugged in)
+            attached (`bricknil.process.LoopEvent`) : Set once the hub binds this peripheral to its port
 
     """
     _DEFAULT_THRESHOLD = 1
 
+    response = True
+
+    mailbox_depth = 1
+
+    handler_policy = 'serial'
+
+    required = True
+
     # Description of a dataset
     #
     # * nvalues: number of values in dataset
     # * nbytes:  size of *each* value in the dataset in *bytes* (1, 2 or 4)
     # * minval:  minimal value
     # * maxval:  maximal value
+    # * signed:  values are twos-complement (default True)
+    # * scale:   multiply each raw value by this (default 1)
     #
-    Dataset = namedtuple('Dataset', ['nvalues', 'nbytes', 'minval', 'maxval'])
+    # Plain (nvalues, nbytes) tuples are accepted as well, and get the defaults
+    #
+    Dataset = namedtuple('Dataset', ['nvalues', 'nbytes', 'minval', 'maxval', 'signed', 'scale'])
+    Dataset.__new__.__defaults__ = (True, 1)
 
     _signals_ = [ 'notify' ]
 
@@ -155,10 +305,25 @@ class Peripheral(Process):
         self.port = port
         self.sensor_name = DEVICES[self._sensor_id]
         self.value = None
+        self.decoder = None
+        self.handler_ready = LoopEvent()
         self.message_handler = None
         self.web_queue_output = None
+        self.attached = LoopEvent()
         self.capabilities, self.thresholds = self._get_validated_capabilities(capabilities)
 
+    @property
+    def message_handler(self):
+        return self._message_handler
+
+    @message_handler.setter
+    def message_handler(self, handler):
+        self._message_handler = handler
+        if handler:
+            self.handler_ready.set()
+        else:
+            self.handler_ready.clear()
+
     def __getattr__(self, name):
         if name in self.capability.__members__.keys():
             return self[name]
@@ -202,42 +367,21 @@ class Peripheral(Process):
                 validated_caps.append(enum_cap)
         return validated_caps, thresholds
 
-    def _extract_value(self, msg_bytes:bytearray, offset, byte_count):
-        """
-            Extract and return a single signed integer value from `msg_bytes`
-            starting at `offset`. The integer can be either 8, 16 or 32bit,
-            depending on `byte_count`, all little endians.
-        """
-        if byte_count == 1:   # just an int8
-            val = struct.unpack_from('<b', msg_bytes, offset)[0]
-        elif byte_count == 2: # int16 little-endian
-            val = struct.unpack_from('<h', msg_bytes, offset)[0]
-        elif byte_count == 4: # int32 little-endian
-            val = struct.unpack_from('<i', msg_bytes, offset)[0]
-        else:
-            self.message_error(f'Cannot convert array of {msg_bytes} length {len(msg_bytes)} to python datatype')
-            val = None
-        return val
+    async def send_message(self, msg, msg_bytes, completion=False, response=True):
+        """ Send outgoing message to BLEventQ
 
-    def _extract_reading(self, capability, msg: bytearray, offset = 0):
-        """
-            Parse single sensor reading from given message and update self.value.
-            Return the number of bytes of this value
+            Args:
+                completion (bool) : Return a future that resolves when the hub reports the
+                    command completed (see :meth:`set_output`)
+                response (bool) : Use an acknowledged write
         """
-        nvalues, nbytes = self.datasets[capability][0:2]
-        for i in range(nvalues):
-            v = self._extract_value(msg, offset + i * nbytes, nbytes)
-            if nvalues==1:
-                self.value[capability] = v
-            else:
-                self.value[capability][i] = v
-        return nvalues * nbytes
-
-    async def send_message(self, msg, msg_bytes):
-        """ Send outgoing message to BLEventQ """
         while not self.message_handler:
-            await sleep(1)
-        await self.message_handler(msg, msg_bytes, peripheral=self)
+            await self.handler_ready.wait()
+        if msg_bytes[2] is None:
+            # Built before the peripheral attached; every peripheral message
+            # has the port right after the message type
+            msg_bytes[2] = self.port
+        return await self.message_handler(msg, msg_bytes, peripheral=self, completion=completion, response=response)
 
     def _convert_speed_to_val(self, speed):
         """Map speed of -100 to 100 to a byte range
@@ -257,7 +401,7 @@ class Peripheral(Process):
         return speed
 
 
-    async def set_output(self, mode, value):
+    async def set_output(self, mode, value, completion=False, response=None):
         """Don't change this unless you're changing the way you do a Port Output command
 
            Outputs the following sequence to the sensor
@@ -268,9 +412,30 @@ class Peripheral(Process):
             * 0x51 = WriteDirectModeData
             * mode
             * value(s)
+
+           Args:
+              completion (bool) : If True, return an awaitable that resolves once the hub reports
+                  the command completed, or raises :class:`bricknil.outbound.CommandDiscardedError`
+                  if the hub discarded it (e.g. because a newer command on this port replaced it)
+              response (bool) : Use an acknowledged write (None for this peripheral's :attr:`response` setting)
+
+           Returns:
+              `asyncio.Future` if `completion` is True, otherwise None
         """
+        if response is None:
+            response = self.response
         b = [0x00, 0x81, self.port, 0x11, 0x51, mode, value ]
-        await self.send_message(f'set output port:{self.port} mode: {mode} = {value}', b)
+        return await self.send_message(f'set output port:{self.port} mode: {mode} = {value}', b,
+                                       completion=completion, response=response)
+
+    async def restore_state(self):
+        """Re-send the last commanded output state after the hub re-attaches this peripheral
+
+           Called by the hub every time this peripheral is attached (after
+           :meth:`activate_updates`), which matters after an automatic reconnect.
+           Output peripherals override this; sensors have nothing to restore.
+        """
+        pass
 
     # Use these for sensor readings
     async def update_value(self, msg_bytes):
@@ -287,32 +452,17 @@ class Peripheral(Process):
                 * Parse multiple sensor messages (could be any combination of the enabled modes)
                 * Set each dict entry to `self.value` to either a list of multiple values or a single value
 
+            The readings are unpacked by `self.decoder` (see :class:`ValueDecoder`).
         """
-        updated = []
-        msg = bytearray(msg_bytes)
         if len(self.capabilities)==0:
-            self.value = msg
-        if len(self.capabilities)==1:
-            capability = self.capabilities[0]
-            self._extract_reading(capability, msg, 0)
-            updated.append(capability)
-        if len(self.capabilities) > 1:
-            # First two bytes define a bitmask of (configured) capabilities
-            # whose readings are in this message. Leading byte should be 0 since
-            # we never have more than 7 datasets even with all the combo modes
-            # activated. Second byte is the actual bitmask.
-            assert msg[0] == 0
-            assert msg[1] != 0
-            def present(index):
-                return msg[1] & (1<<index)
-            offset = 2
-            for index, capability in enumerate(self.capabilities):
-                if present(index):
-                    offset += self._extract_reading(capability, msg, offset)
-                    updated.append(capability)
+            self.value = bytearray(msg_bytes)
+            return
+        if self.decoder is None:
+            self.decoder = ValueDecoder(self.datasets, self.capabilities)
+        updated = self.decoder.decode(msg_bytes, self.value)
         # Now, emit 'notify::*' for each updated capability and then generic
-        # 'notify'
-        if len(updated) > 0:
+        # 'notify' (unless nothing is connected to this peripheral at all)
+        if len(updated) > 0 and self._receivers:
             for capability in updated:
                 await self.emit('notify::' + capability.name, capability, self.value[capability])
             await self.emit("notify")
@@ -340,6 +490,7 @@ class Peripheral(Process):
         self.value = {}
         for cap in self.capabilities:
             self.value[cap] = [None]*self.datasets[cap][0]
+        self.decoder = ValueDecoder(self.datasets, self.capabilities)
 
         if len(self.capabilities)==1:  # Just a normal single sensor
             mode = self.capabilities[0].value
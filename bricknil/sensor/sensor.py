@@ -20,7 +20,7 @@ from enum import Enum, IntEnum
 from struct import pack
 
 from ..const import Color
-from .peripheral import Peripheral, PeripheralDefinition
+from .peripheral import Peripheral
 
 class VisionSensor(Peripheral):
     """ Access the Boost Vision/Distance Sensor
@@ -257,21 +257,13 @@ class ExternalTiltSensor(Peripheral):
 
 
     async def update_value(self, msg_bytes):
-        """If angle, convert the bytes being returned to twos complement ints
-           If orientation, then convert to the `orientation` enumeration.
+        """If orientation, then convert to the `orientation` enumeration.
 
+           (Angles are already decoded as signed values)
         """
         await super().update_value(msg_bytes)
         # No combinations possible, so only one capability with len(self.capabilities[])==1
-        if self.capabilities[0] == self.capability.sense_angle:
-            sa = self.capability.sense_angle
-            sx, sy = self.value[sa]
-            if sx & 128:  # negative sign bit
-                sx = -(256-sx)
-            if sy & 128:
-                sy = -(256-sy)
-            self.value[sa] = [sx, sy]
-        elif self.capabilities[0] == self.capability.sense_orientation:
+        if self.capabilities[0] == self.capability.sense_orientation:
             so = self.capability.sense_orientation
             self.value[so] = self.orientation(self.value[so])
 
@@ -312,6 +304,9 @@ class RemoteButtons(Peripheral):
     datasets = { capability.sense_press: (3,1) }
     allowed_combo = []
 
+    mailbox_depth = None
+    """Every press and release matters, so never drop a reading"""
+
     def __init__(self, name, port=None, capabilities=[]):
         """Maps the port names `L`, `R`"""
         if port:
@@ -362,6 +357,9 @@ class Button(Peripheral):
                }
     allowed_combo = [capability.sense_press]
 
+    mailbox_depth = None
+    """Every press and release matters, so never drop a reading"""
+
     def __init__(self, name, port=None, capabilities=[]):
         """Call super-class with port set to 255 """
         super().__init__(name, 255, capabilities)
@@ -484,146 +482,62 @@ class CurrentSensor(Peripheral):
     allowed_combo = [ ]
 
 
-@PeripheralDefinition(
-   {'combinable': 0,
-      'id': 60,
-      'input': 2,
-      'modes': {0: {'dataset_decimals': 1,
-                    'dataset_total_figures': 5,
-                    'dataset_type': '16b',
-                    'datasets': 1,
-                    'input': True,
-                    'input_mapping': ['Absolute',
-                                      'Supports Functional Mapping 2.0}'],
-                    'name': 'TEMP',
-                    'output_mapping': [],
-                    'pct_range': (-100.0, 100.0),
-                    'raw_range': (-900.0, 900.0),
-                    'si_range': (-90.0, 90.0),
-                    'symbol': 'DEG'}},
-      'name': 'Powered Up Hub IMU Temperature',
-      'output': 0,
-      'synchronizable': 0}
-)
 class PoweredUpHubIMUTemperature(Peripheral):
-    pass
-
-
-@PeripheralDefinition(
-    {'combinable': 0,
-            'id': 59,
-            'input': 2,
-            'modes': {   0: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 3,
-                                'dataset_type': '16b',
-                                'datasets': 3,
-                                'input': True,
-                                'input_mapping': [   'Absolute',
-                                                     'Supports Functional '
-                                                     'Mapping 2.0}'],
-                                'name': 'POS',
-                                'output_mapping': [],
-                                'pct_range': (-100.0, 100.0),
-                                'raw_range': (-180.0, 180.0),
-                                'si_range': (-180.0, 180.0),
-                                'symbol': 'DEG'},
-                         1: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 3,
-                                'dataset_type': '32b',
-                                'datasets': 1,
-                                'input': True,
-                                'input_mapping': ['Relative'],
-                                'name': 'IMP',
-                                'output_mapping': [],
-                                'pct_range': (0.0, 100.0),
-                                'raw_range': (0.0, 100.0),
-                                'si_range': (0.0, 100.0),
-                                'symbol': 'CNT'},
-                         2: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 3,
-                                'dataset_type': '8b',
-                                'datasets': 2,
-                                'input_mapping': [],
-                                'name': 'CFG',
-                                'output': True,
-                                'output_mapping': ['Absolute'],
-                                'pct_range': (0.0, 100.0),
-                                'raw_range': (0.0, 255.0),
-                                'si_range': (0.0, 255.0),
-                                'symbol': ''}},
-            'name': 'Powered Up Hub IMU Position',
-            'output': 1,
-            'synchronizable': 0}
-)
+    """Powered Up Hub IMU Temperature (generated from its port info)"""
+    _sensor_id = 0x003C
+    capability = Enum("capability",
+                      [('sense_temp', 0),
+                       ])
+
+    datasets = { capability.sense_temp: Peripheral.Dataset(nvalues=1, nbytes=2, minval=-900.0, maxval=900.0, signed=True, scale=1),
+               }
+
+    allowed_combo = [ ]
+
+
 class PoweredUpHubIMUPosition(Peripheral):
-    pass
-
-
-@PeripheralDefinition(
-         {  'combinable': 0,
-            'id': 58,
-            'input': 2,
-            'modes': {   0: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 3,
-                                'dataset_type': '16b',
-                                'datasets': 3,
-                                'input': True,
-                                'input_mapping': [   'Absolute',
-                                                     'Supports Functional '
-                                                     'Mapping 2.0}'],
-                                'name': 'ROT',
-                                'output_mapping': [],
-                                'pct_range': (-100.0, 100.0),
-                                'raw_range': (   -28571.419921875,
-                                                 28571.419921875),
-                                'si_range': (-2000.0, 2000.0),
-                                'symbol': 'DPS'}},
-            'name': 'Powered Up Hub IMU Gyro',
-            'output': 0,
-            'synchronizable': 0}
-)
+    """Powered Up Hub IMU Position (generated from its port info)"""
+    _sensor_id = 0x003B
+    capability = Enum("capability",
+                      [('sense_pos', 0),
+                       ('sense_imp', 1),
+                       ('sense_cfg', 2),
+                       ])
+
+    datasets = { capability.sense_pos: Peripheral.Dataset(nvalues=3, nbytes=2, minval=-180.0, maxval=180.0, signed=True, scale=1),
+                 capability.sense_imp: Peripheral.Dataset(nvalues=1, nbytes=4, minval=0.0, maxval=100.0, signed=False, scale=1),
+                 capability.sense_cfg: Peripheral.Dataset(nvalues=2, nbytes=1, minval=0.0, maxval=255.0, signed=False, scale=1),
+               }
+
+    allowed_combo = [ ]
+
+
 class PoweredUpHubIMUGyro(Peripheral):
-    pass
-
-
-@PeripheralDefinition(
-        {   'combinable': 0,
-            'id': 57,
-            'input': 2,
-            'modes': {   0: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 3,
-                                'dataset_type': '16b',
-                                'datasets': 3,
-                                'input': True,
-                                'input_mapping': [   'Absolute',
-                                                     'Supports Functional '
-                                                     'Mapping 2.0}'],
-                                'name': 'GRV',
-                                'output_mapping': [],
-                                'pct_range': (-100.0, 100.0),
-                                'raw_range': (-32768.0, 32768.0),
-                                'si_range': (-8000.0, 8000.0),
-                                'symbol': 'mG'},
-                         1: {   'dataset_decimals': 0,
-                                'dataset_total_figures': 0,
-                                'dataset_type': '8b',
-                                'datasets': 1,
-                                'input': True,
-                                'input_mapping': [   'Absolute',
-                                                     'Supports Functional '
-                                                     'Mapping 2.0}'],
-                                'name': 'CAL',
-                                'output_mapping': [],
-                                'pct_range': (-100.0, 100.0),
-                                'raw_range': (1.0, 1.0),
-                                'si_range': (1.0, 1.0),
-                                'symbol': ''}},
-            'name': 'Powered Up Hub IMU Accelerometer',
-            'output': 0,
-            'synchronizable': 0}
-)
+    """Powered Up Hub IMU Gyro (generated from its port info)"""
+    _sensor_id = 0x003A
+    capability = Enum("capability",
+                      [('sense_rot', 0),
+                       ])
+
+    datasets = { capability.sense_rot: Peripheral.Dataset(nvalues=3, nbytes=2, minval=-28571.419921875, maxval=28571.419921875, signed=True, scale=1),
+               }
+
+    allowed_combo = [ ]
+
+
 class PoweredUpHubIMUAccelerometer(Peripheral):
-    pass
+    """Powered Up Hub IMU Accelerometer (generated from its port info)"""
+    _sensor_id = 0x0039
+    capability = Enum("capability",
+                      [('sense_grv', 0),
+                       ('sense_cal', 1),
+                       ])
+
+    datasets = { capability.sense_grv: Peripheral.Dataset(nvalues=3, nbytes=2, minval=-32768.0, maxval=32768.0, signed=True, scale=1),
+                 capability.sense_cal: Peripheral.Dataset(nvalues=1, nbytes=1, minval=1.0, maxval=1.0, signed=False, scale=1),
+               }
+
+    allowed_combo = [ ]
 
 
 class DuploSpeedSensor(Peripheral):
@@ -669,16 +583,3 @@ class DuploSpeedSensor(Peripheral):
                       capability.sense_count,
                     ]
 
-    async def update_value(self, msg_bytes):
-        """Hack to negate reverse speeds.  This should really be specified elsewehre
-        """
-        await super().update_value(msg_bytes)
-        ss = self.capability.sense_speed
-        sc = self.capability.sense_count
-        if ss in self.value:
-            if self.value[ss] & (1<<15):  # negative sign bit
-                self.value[ss] = -((1<<16) - self.value[ss])
-        if sc in self.value:
-            if self.value[sc] & (1<<31):  # negative sign bit
-                self.value[sc] = -((1<<32) - self.value[sc])
-
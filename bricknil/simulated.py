@@ -0,0 +1,504 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulated hubs for testing and benchmarking without any radios
+
+The simulated hubs speak the same LEGO wireless protocol as the real ones:
+
+* Attached I/O messages for each port once notifications are enabled
+* Port value streams (single and combined mode) at a configurable rate
+  after a Port Input Format Setup
+* Port Output Command Feedback for port output commands, including the
+  hub's one-deep command buffer
+* Hub properties, and port/mode information requests
+
+Example::
+
+    from bricknil.ble_queue import BLEventQ
+    from bricknil.simulated import SimulatedTransport, SimulatedHub
+
+    transport = SimulatedTransport()
+    for i in range(100):
+        transport.add_hub(SimulatedHub(ports={0: 0x27, 1: 0x27, 50: 0x17}, rate=20))
+    BLEventQ.instance.transport = transport
+
+"""
+import struct
+from asyncio import sleep, get_event_loop, create_task as spawn, CancelledError
+
+from .transport import Transport, TransportClient, AdvertisedDevice
+from .framing import frame
+from .sensor.peripheral import Peripheral
+from . import sensor  # Make sure every peripheral class is defined
+
+UART_UUID = '00001623-1212-efde-1623-785feabcd123'
+
+
+def _peripheral_classes():
+    """Return sensor_id -> first peripheral class defined for that id"""
+    classes = {}
+    pending = list(Peripheral.__subclasses__())
+    while pending:
+        cls = pending.pop(0)
+        if hasattr(cls, '_sensor_id'):
+            classes.setdefault(cls._sensor_id, cls)
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+class SimulatedDevice:
+    """A peripheral plugged into a :class:`SimulatedHub`
+
+       Args:
+          device_id (int) : Device type (see :data:`bricknil.const.DEVICES`)
+          modes (dict) : Mode -> (number of values, bytes per value).  Defaults to the
+              datasets of the bricknil peripheral class for `device_id`
+          move_time (float) : Seconds that timed port output commands
+              (StartSpeedForDegrees, GotoAbsolutePosition, etc) take to complete
+          values (func) : Called with (mode, tick) to get the list of values to report.
+              Defaults to a counter
+    """
+    TIMED_SUBCOMMANDS = {0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e}
+
+    def __init__(self, device_id, modes=None, move_time=0.1, values=None):
+        self.device_id = device_id
+        cls = _peripheral_classes().get(device_id)
+        if modes is None:
+            datasets = getattr(cls, 'datasets', {}) if cls else {}
+            modes = {cap.value: tuple(d[0:2]) for cap, d in datasets.items()}
+        self.modes = modes
+        self.mode_names = {}
+        if cls is not None and hasattr(cls, 'capability'):
+            self.mode_names = {cap.value: cap.name.replace('sense_', '').upper() for cap in cls.capability}
+        self.combinable = len(getattr(cls, 'allowed_combo', [])) > 1
+        self.move_time = move_time
+        self.values = values or (lambda mode, tick: [tick % 100]*self.modes[mode][0])
+
+    def encode(self, mode, tick):
+        nvalues, nbytes = self.modes[mode]
+        fmt = {1: 'b', 2: 'h', 4: 'i'}[nbytes]
+        return list(struct.pack(f'<{nvalues}{fmt}', *self.values(mode, tick)))
+
+
+class _PortState:
+    """What a simulated port is streaming and executing"""
+    def __init__(self, device):
+        self.device = device
+        self.mode = None           # Single mode being reported
+        self.combo = []            # Modes being reported in combined mode
+        self.combo_pending = []
+        self.locked = False
+        self.executing = None      # `asyncio.TimerHandle` of the command in progress
+        self.feedback = False      # Executing command asked for feedback
+        self.buffered = None       # (duration, feedback) of the buffered command
+
+
+class SimulatedHub:
+    """A virtual hub that answers like a real one
+
+       Args:
+          ble_name (str) : Advertised name
+          manufacturer_id (int) : Advertised hub type
+          address (str) : BLE address (one is made up if not given)
+          ports (dict) : Port -> device id or :class:`SimulatedDevice`
+          rate (float) : Port value updates per second for every port with updates enabled
+          mtu (int) : Split notifications longer than this many bytes over several (None to never split)
+          packed (bool) : Send the port values of all streaming ports in one notification
+
+       Attributes:
+          connected (bool) : True while a client is connected
+          reachable (bool) : Set to False to make connection attempts fail
+          received (list [bytes]) : Every message written to the hub
+          notifications (int) : Number of notifications sent
+    """
+    _next_address = 0
+
+    def __init__(self, ble_name='HUB NO.4', manufacturer_id=65, address=None, ports=None, rate=10,
+                 mtu=None, packed=False):
+        if address is None:
+            address = ':'.join(f'{b:02X}' for b in (0x90, 0x84, 0x2B) + tuple((SimulatedHub._next_address).to_bytes(3, 'big')))
+            SimulatedHub._next_address += 1
+        self.ble_name = ble_name
+        self.manufacturer_id = manufacturer_id
+        self.address = address
+        self.rate = rate
+        self.mtu = mtu
+        self.packed = packed
+        self.ports = {}
+        for port, device in (ports or {}).items():
+            if not isinstance(device, SimulatedDevice):
+                device = SimulatedDevice(device)
+            self.ports[port] = _PortState(device)
+        self.connected = False
+        self.reachable = True
+        self.received = []
+        self.notifications = 0
+        self.button = 0
+        self.client = None
+        self.stream_task = None
+        self.tick = 0
+
+    def advertisement(self):
+        return AdvertisedDevice(self.ble_name, self.address, self.manufacturer_id, [UART_UUID])
+
+    def properties(self):
+        """Hub property -> payload of its update message"""
+        mac = [int(b, 16) for b in self.address.split(':')]
+        return { 0x01: list(self.ble_name.encode()),
+                 0x02: [self.button],
+                 0x03: [0x00, 0x00, 0x00, 0x10],
+                 0x04: [0x00, 0x00, 0x00, 0x01],
+                 0x05: [0xC8],   # -56 dBm
+                 0x06: [100],
+                 0x07: [0x00],
+                 0x08: list(b'LEGO System A/S'),
+                 0x09: list(b'2_02_01'),
+                 0x0A: [0x00, 0x03],
+                 0x0B: [self.manufacturer_id],
+                 0x0C: [0x00],
+                 0x0D: mac,
+                 0x0E: mac,
+                 0x0F: [0x00],
+               }
+
+    # Link events
+    def on_connect(self, client):
+        self.connected = True
+        self.client = client
+
+    def on_notify(self):
+        """Notifications are enabled, so tell the host what's plugged in"""
+        for port, state in self.ports.items():
+            device_id = state.device.device_id
+            self.notify([0x04, port, 0x01, device_id & 0xFF, device_id >> 8, 0,0,0,0x10, 0,0,0,0x10])
+        if self.stream_task is None:
+            self.stream_task = spawn(self._stream())
+
+    def on_disconnect(self):
+        self.connected = False
+        self.client = None
+        if self.stream_task is not None:
+            self.stream_task.cancel()
+            self.stream_task = None
+        for state in self.ports.values():
+            if state.executing is not None:
+                state.executing.cancel()
+            state.__init__(state.device)
+
+    def drop_link(self):
+        """Simulate the hub going out of range (or its batteries dying)"""
+        client = self.client
+        self.on_disconnect()
+        if client is not None:
+            client.link_dropped()
+
+    def press_button(self, pressed=True):
+        self.button = 1 if pressed else 0
+        self.notify([0x01, 0x02, 0x06, self.button])
+
+    # Messages to the host
+    def notify(self, body):
+        self._send(frame([0x00] + body))
+
+    def _send(self, data):
+        if self.client is None:
+            return
+        step = self.mtu or len(data)
+        for start in range(0, len(data), step):
+            self.notifications += 1
+            self.client.notify(data[start:start+step])
+
+    def output_feedback(self, port, flags):
+        self.notify([0x82, port, flags])
+
+    # Messages from the host
+    def receive(self, data):
+        self.received.append(bytes(data))
+        offset = 3 if data[0] & 0x80 else 2   # Two length bytes for messages over 127 bytes
+        msg_type, body = data[offset], list(data[offset+1:])
+        handlers = { 0x01: self._hub_property,
+                     0x21: self._port_information_request,
+                     0x22: self._port_mode_information_request,
+                     0x41: self._port_input_format_setup,
+                     0x42: self._port_input_format_setup_combined,
+                     0x81: self._port_output,
+                   }
+        if msg_type in handlers:
+            handlers[msg_type](body)
+        else:
+            self.notify([0x05, msg_type, 0x05])  # Generic error: command not recognized
+
+    def _hub_property(self, body):
+        prop, op = body[0], body[1]
+        props = self.properties()
+        if prop in props and op in (0x02, 0x05):  # Enable updates, Request update
+            self.notify([0x01, prop, 0x06] + props[prop])
+
+    def _port_information_request(self, body):
+        port, info_type = body[0], body[1]
+        state = self.ports.get(port)
+        if state is None:
+            self.notify([0x05, 0x21, 0x06])  # Generic error: invalid use
+            return
+        device = state.device
+        modes = device.modes
+        input_modes = sum(1 << m for m in modes)
+        if info_type == 0x01:   # Mode info
+            capabilities = 0x01 | (0x02 if modes else 0) | (0x04 if device.combinable else 0)
+            self.notify([0x43, port, 0x01, capabilities, max(len(modes), 1),
+                         input_modes & 0xFF, input_modes >> 8, 0x01, 0x00])
+        elif info_type == 0x02: # Possible mode combinations
+            self.notify([0x43, port, 0x02, input_modes & 0xFF, input_modes >> 8])
+
+    def _port_mode_information_request(self, body):
+        port, mode, info_type = body[0], body[1], body[2]
+        state = self.ports.get(port)
+        if state is None or (mode not in state.device.modes and mode != 0):
+            self.notify([0x05, 0x22, 0x06])
+            return
+        device = state.device
+        # Mode 0 is also the (output) mode every device reports in its mode info
+        nvalues, nbytes = device.modes.get(mode, (1, 1))
+        if info_type == 0x00:
+            payload = list(device.mode_names.get(mode, f'MODE{mode}').encode())
+        elif info_type in (0x01, 0x02, 0x03):
+            payload = list(struct.pack('<ff', -100.0, 100.0))
+        elif info_type == 0x04:
+            payload = list(b'RAW')
+        elif info_type == 0x05:
+            payload = [0x10, 0x00]
+        elif info_type == 0x80:
+            payload = [nvalues, {1: 0, 2: 1, 4: 2}[nbytes], 4, 0]
+        else:
+            return
+        self.notify([0x44, port, mode, info_type] + payload)
+
+    def _port_input_format_setup(self, body):
+        port, mode = body[0], body[1]
+        state = self.ports.get(port)
+        if state is None or mode not in state.device.modes:
+            self.notify([0x05, 0x41, 0x06])
+            return
+        notify = body[6]
+        if state.locked:
+            state.combo_pending.append(mode)
+        else:
+            state.mode = mode if notify else None
+            state.combo = []
+        self.notify([0x47, port] + body[1:7])
+
+    def _port_input_format_setup_combined(self, body):
+        port, sub = body[0], body[1]
+        state = self.ports.get(port)
+        if state is None:
+            return
+        if sub == 0x02:    # Lock
+            state.locked = True
+            state.combo_pending = []
+        elif sub == 0x01:  # Set mode and dataset combination
+            modes = []
+            for entry in body[3:]:
+                if entry >> 4 not in modes:
+                    modes.append(entry >> 4)
+            state.combo_pending = modes
+        elif sub in (0x03, 0x04):  # Unlock (and start with/without multi-update)
+            state.locked = False
+            state.combo = state.combo_pending
+            state.mode = None
+        self.notify([0x48, port, 0x00 if state.locked else 0x01, 0x00, 0x00])
+
+    def _port_output(self, body):
+        port, startup, subcommand = body[0], body[1], body[2]
+        state = self.ports.get(port)
+        if state is None:
+            self.notify([0x05, 0x81, 0x06])
+            return
+        feedback = bool(startup & 0x01)
+        duration = state.device.move_time if subcommand in SimulatedDevice.TIMED_SUBCOMMANDS else 0
+        if state.executing is not None and not startup & 0x10:
+            # Buffer if necessary
+            if state.buffered is not None:
+                self.output_feedback(port, 0x10 | 0x01)  # Busy/full
+            else:
+                state.buffered = (duration, feedback)
+            return
+        discarded = 0
+        if state.executing is not None:
+            # Execute immediately: drop whatever is running and buffered
+            state.executing.cancel()
+            state.executing = None
+            state.buffered = None
+            discarded = 0x04
+        self._execute(port, state, duration, feedback, discarded)
+
+    def _execute(self, port, state, duration, feedback, flags=0):
+        if duration == 0:
+            if feedback or flags:
+                self.output_feedback(port, flags | 0x02 | 0x08)
+            return
+        state.feedback = feedback
+        state.executing = get_event_loop().call_later(duration, self._executed, port, state)
+        if feedback or flags:
+            self.output_feedback(port, flags | 0x01)
+
+    def _executed(self, port, state):
+        state.executing = None
+        if state.buffered is not None:
+            duration, feedback = state.buffered
+            state.buffered = None
+            self._execute(port, state, duration, feedback, 0x02 if state.feedback else 0)
+        elif state.feedback:
+            self.output_feedback(port, 0x02 | 0x08)
+
+    async def _stream(self):
+        """Send port values for every port with updates enabled, `rate` times a second"""
+        try:
+            while True:
+                await sleep(1/self.rate)
+                self.tick += 1
+                values = []
+                for port, state in self.ports.items():
+                    device = state.device
+                    if state.mode is not None:
+                        values.append([0x45, port] + device.encode(state.mode, self.tick))
+                    elif state.combo:
+                        mask = (1 << len(state.combo)) - 1
+                        body = [0x46, port, mask >> 8, mask & 0xFF]
+                        for mode in state.combo:
+                            body += device.encode(mode, self.tick)
+                        values.append(body)
+                if self.packed and values:
+                    self._send(b''.join(frame([0x00] + body) for body in values))
+                else:
+                    for body in values:
+                        self.notify(body)
+        except CancelledError:
+            pass
+
+
+class SimulatedTransport(Transport):
+    """Transport that connects to :class:`SimulatedHub` objects
+
+       Args:
+          hubs (list [`SimulatedHub`]) : Hubs that can be discovered
+          scan_time (float) : Seconds each discovery scan takes
+          connect_time (float) : Seconds each connection takes
+          latency (float) : One-way link latency in seconds.  Acknowledged writes take a round trip
+              to return, writes without response return immediately and reach the hub `latency` later
+          max_connections (int) : Connection limit of the simulated controller (None for no limit).
+              Create one transport per simulated adapter, sharing the same hubs
+
+       Attributes:
+          scans (int) : Number of discovery scans run
+          connects (int) : Number of connection attempts
+          clients (set [`SimulatedClient`]) : Currently connected clients
+    """
+    def __init__(self, hubs=(), scan_time=0, connect_time=0, latency=0, max_connections=None):
+        self.hubs = {}
+        for hub in hubs:
+            self.add_hub(hub)
+        self.scan_time = scan_time
+        self.connect_time = connect_time
+        self.latency = latency
+        self.max_connections = max_connections
+        self.scans = 0
+        self.connects = 0
+        self.clients = set()
+
+    def add_hub(self, hub):
+        self.hubs[hub.address] = hub
+        return hub
+
+    async def discover(self, timeout):
+        self.scans += 1
+        await sleep(self.scan_time)
+        # Connected hubs stop advertising
+        return [hub.advertisement() for hub in self.hubs.values() if hub.reachable and not hub.connected]
+
+    def client(self, address):
+        return SimulatedClient(self, address)
+
+
+class SimulatedClient(TransportClient):
+
+    def __init__(self, transport, address):
+        self.transport = transport
+        self.address = address
+        self.hub = None
+        self.callback = None
+        self.disconnected_callback = None
+
+    @property
+    def name(self):
+        return self.hub.ble_name if self.hub else None
+
+    async def connect(self):
+        self.transport.connects += 1
+        await sleep(self.transport.connect_time)
+        hub = self.transport.hubs.get(self.address)
+        if hub is None or not hub.reachable or hub.connected:
+            raise ConnectionError(f'Could not connect to {self.address}')
+        limit = self.transport.max_connections
+        if limit is not None and len(self.transport.clients) >= limit:
+            raise ConnectionError(f'Connection limit ({limit}) reached')
+        self.hub = hub
+        self.transport.clients.add(self)
+        hub.on_connect(self)
+
+    async def disconnect(self):
+        self.transport.clients.discard(self)
+        if self.hub is not None:
+            self.hub.on_disconnect()
+            self.hub = None
+
+    async def write(self, char_uuid, data, response=True):
+        if self.hub is None:
+            raise ConnectionError(f'Not connected to {self.address}')
+        latency = self.transport.latency
+        if not response:
+            if latency:
+                get_event_loop().call_later(latency, self._deliver, bytes(data))
+            else:
+                self.hub.receive(data)
+            return
+        if latency:
+            await sleep(latency)
+        self._deliver(data)
+        if latency:
+            await sleep(latency)  # Acknowledgment on its way back
+
+    def _deliver(self, data):
+        if self.hub is None:
+            raise ConnectionError(f'Not connected to {self.address}')
+        self.hub.receive(data)
+
+    async def start_notify(self, char_uuid, callback):
+        self.callback = callback
+        self.hub.on_notify()
+
+    def set_disconnected_callback(self, callback):
+        self.disconnected_callback = callback
+
+    def notify(self, data):
+        if self.callback is not None:
+            self.callback(self.transport, data)
+
+    def link_dropped(self):
+        self.transport.clients.discard(self)
+        self.hub = None
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def describe(self):
+        return f'simulated {self.address}'
@@ -0,0 +1,163 @@
+# Copyright 2019 Virantha N. Ekanayake
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""BLE transports used by :class:`bricknil.ble_queue.BLEventQ`
+
+A transport finds advertising hubs and creates clients that connect to them.
+:class:`BleakTransport` is the default and talks to real hubs through
+`bleak`.  :class:`bricknil.simulated.SimulatedTransport` runs virtual hubs
+in-process instead.  To use a different transport, set it before calling
+:func:`bricknil.start`::
+
+    BLEventQ.instance.transport = SimulatedTransport(...)
+
+"""
+import bleak
+
+class AdvertisedDevice:
+    """A device seen during a discovery scan
+
+       Attributes:
+          name (str) : Advertised name
+          address (str) : BLE network (MAC) address, or UUID on Mac
+          manufacturer_id (int) : LEGO hub type from the manufacturer data (None if not advertised)
+          uuids (list [str]) : Advertised service UUIDs
+          adapter (:class:`bricknil.adapter.Adapter`) : Adapter whose scan saw the device (set by
+              :class:`bricknil.ble_queue.BLEventQ`)
+    """
+    def __init__(self, name, address, manufacturer_id, uuids):
+        self.name = name
+        self.address = address
+        self.manufacturer_id = manufacturer_id
+        self.uuids = uuids
+        self.adapter = None
+
+    def __repr__(self):
+        return f'AdvertisedDevice("{self.name}", {self.address}, {self.manufacturer_id})'
+
+
+class Transport:
+    """Interface to a BLE stack
+
+       Attributes:
+          max_connections (int) : Connection limit of the controller, if known (None for no limit)
+    """
+    max_connections = None
+
+    async def discover(self, timeout):
+        """Scan for `timeout` seconds
+
+           Returns:
+              devices (list [`AdvertisedDevice`]) : Devices seen during the scan
+        """
+        raise NotImplementedError
+
+    def client(self, address):
+        """Return a (not yet connected) :class:`TransportClient` for the device at `address`"""
+        raise NotImplementedError
+
+
+class TransportClient:
+    """Interface to a connection to one device
+
+       Attributes:
+          name (str) : Device name reported by the BLE stack once connected (None if unknown)
+    """
+    name = None
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def disconnect(self):
+        raise NotImplementedError
+
+    async def write(self, char_uuid, data, response=True):
+        """Write `data` (bytearray) to the characteristic
+
+           With `response` False, use a write-without-response, which returns as soon
+           as the BLE stack has queued the data instead of waiting on the device's acknowledgment.
+        """
+        raise NotImplementedError
+
+    async def start_notify(self, char_uuid, callback):
+        """Call `callback(sender, data)` for every notification on the characteristic"""
+        raise NotImplementedError
+
+    def set_disconnected_callback(self, callback):
+        """Call `callback(client)` if the link drops"""
+        raise NotImplementedError
+
+    def describe(self):
+        """Return a description of the connected device's services, for logging"""
+        return ''
+
+
+class BleakTransport(Transport):
+    """Transport for real hubs, using `bleak`
+
+       Args:
+          adapter (str) : Bluetooth controller to use, e.g. 'hci1' (None for the default one)
+    """
+    def __init__(self, adapter=None):
+        self.adapter = adapter
+
+    def _kwargs(self):
+        return {'device': self.adapter} if self.adapter else {}
+
+    async def discover(self, timeout):
+        devices = await bleak.discover(timeout=timeout, **self._kwargs())
+        advertised = []
+        for device in devices:
+            manufacturer_data = device.metadata.get('manufacturer_data', {})
+            manufacturer_id = None
+            if len(manufacturer_data) == 1:
+                data = next(iter(manufacturer_data.values())) # Get the one and only key
+                manufacturer_id = data[1]
+            advertised.append(AdvertisedDevice(device.name, device.address, manufacturer_id,
+                                               device.metadata.get('uuids', [])))
+        return advertised
+
+    def client(self, address):
+        return BleakTransportClient(address, **self._kwargs())
+
+
+class BleakTransportClient(TransportClient):
+
+    def __init__(self, address, **kwargs):
+        self.device = bleak.BleakClient(address_or_ble_device=address, **kwargs)
+
+    @property
+    def name(self):
+        # Hack to fix device name on Windows
+        requester = getattr(self.device, '_requester', None)
+        return getattr(requester, 'Name', None)
+
+    async def connect(self):
+        await self.device.connect()
+
+    async def disconnect(self):
+        await self.device.disconnect()
+
+    async def write(self, char_uuid, data, response=True):
+        await self.device.write_gatt_char(char_uuid, data, response=response)
+
+    async def start_notify(self, char_uuid, callback):
+        await self.device.start_notify(char_uuid, callback)
+
+    def set_disconnected_callback(self, callback):
+        if hasattr(self.device, 'set_disconnected_callback'):
+            self.device.set_disconnected_callback(lambda device: callback(self))
+
+    def describe(self):
+        return str(self.device.services.characteristics)
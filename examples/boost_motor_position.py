@@ -40,15 +40,16 @@ class Robot(BoostHub):
             await self.motor.set_pos(90, speed=20)
             await sleep(2)
 
-            # Rotate a random amount of degrees from 1 to 180
+            # Rotate a random amount of degrees from 1 to 180, and wait
+            # for the hub to report the rotation completed
             await self.led.set_color(Color.purple)
-            await self.motor.rotate(randint(1,180), speed=10)
-            await sleep(3)
+            done = await self.motor.rotate(randint(1,180), speed=10, completion=True)
+            await done
 
             # Then reset to 12 o'clock position
             await self.led.set_color(Color.green)
-            await self.motor.set_pos(0)
-            await sleep(2)
+            done = await self.motor.set_pos(0, completion=True)
+            await done
 
 
 
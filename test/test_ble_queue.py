@@ -0,0 +1,121 @@
+import sys
+from asyncio import run, gather
+
+from mock import MagicMock
+
+sys.modules.setdefault('bleak', MagicMock())
+from bricknil.ble_queue import BLEventQ
+from bricknil.discovery_cache import DiscoveryCache
+from bricknil.simulated import SimulatedTransport, SimulatedHub
+from bricknil.hub import Hub, PoweredUpHub
+
+
+class TestDiscovery:
+
+    def setup_method(self):
+        self.q = BLEventQ.instance
+        self.saved_adapters = self.q.adapters
+        self.q.claimed_addresses = {}
+        self.q.pending_discovery = []
+        self.uart_uuid = '00001623-1212-efde-1623-785feabcd123'
+
+    def teardown_method(self):
+        self.q.adapters = self.saved_adapters
+
+    def _hub(self, address, manufacturer_id=65, name='HUB NO.4'):
+        return SimulatedHub(name, manufacturer_id, address)
+
+    def test_one_scan_serves_all_hubs(self):
+        transport = SimulatedTransport([self._hub('AA'), self._hub('BB'), self._hub('CC', 64, 'LEGO Move Hub')])
+        self.q.transport = transport
+
+        async def child():
+            return await gather(self.q._ble_connect(self.uart_uuid, 'HUB NO.4', 65),
+                                self.q._ble_connect(self.uart_uuid, 'HUB NO.4', 65),
+                                self.q._ble_connect(self.uart_uuid, 'LEGO Move Hub', 64))
+        found = run(child())
+
+        assert transport.scans == 1
+        assert sorted(d.address for d in found[:2]) == ['AA', 'BB']
+        assert found[2].address == 'CC'
+
+    def test_specific_hub_id_gets_first_pick(self):
+        self.q.transport = SimulatedTransport([self._hub('AA')])
+
+        async def child():
+            any_hub = self.q._ble_connect(self.uart_uuid, 'HUB NO.4', 65, timeout=1)
+            this_hub = self.q._ble_connect(self.uart_uuid, 'HUB NO.4', 65, ble_id='AA')
+            return await gather(any_hub, this_hub, return_exceptions=True)
+        any_result, specific = run(child())
+
+        assert isinstance(any_result, RuntimeError)
+        assert specific.address == 'AA'
+
+
+class TestAdapterPool:
+
+    def setup_method(self):
+        self.q = BLEventQ.instance
+        self.saved_adapters = self.q.adapters
+        self.q.claimed_addresses = {}
+        self.q.pending_discovery = []
+        Hub.hubs = []
+
+    def teardown_method(self):
+        self.q.adapters = self.saved_adapters
+
+    def _connect(self, hubs):
+        async def child():
+            results = await gather(*[hub.connect() for hub in hubs], return_exceptions=True)
+            loads = [a.load for a in self.q.adapters]
+            for hub in hubs:
+                await hub.disconnect()
+            return results, loads
+        return run(child())
+
+    def test_hubs_spread_over_adapters(self):
+        sims = [SimulatedHub() for i in range(7)]
+        self.q.add_adapter('hci0', SimulatedTransport(sims, max_connections=5))
+        self.q.add_adapter('hci1', SimulatedTransport(sims, max_connections=2))
+        self.q.add_adapter('hci2', SimulatedTransport(sims, max_connections=5))
+        hubs = [PoweredUpHub(f'hub{i}') for i in range(6)] + [PoweredUpHub('pinned', adapter='hci1')]
+
+        results, loads = self._connect(hubs)
+        assert results == [None]*7
+        # Least-loaded placement, with the pinned hub on its (small) adapter
+        assert sum(loads) == 7 and max(loads) - min(loads) <= 1
+        assert hubs[-1].ble_adapter.name == 'hci1'
+        assert [a.load for a in self.q.adapters] == [0, 0, 0]
+
+    def test_full_pool_fails_fast(self):
+        sims = [SimulatedHub() for i in range(3)]
+        self.q.add_adapter('hci0', SimulatedTransport(sims, max_connections=1))
+        self.q.add_adapter('hci1', SimulatedTransport(sims, max_connections=1))
+        hubs = [PoweredUpHub(f'hub{i}') for i in range(3)]
+
+        results, loads = self._connect(hubs)
+        assert loads == [1, 1]
+        assert sum(isinstance(r, RuntimeError) for r in results) == 1
+
+
+class TestDiscoveryCache:
+
+    def test_store_lookup_invalidate(self, tmp_path):
+        path = str(tmp_path / 'cache.json')
+        cache = DiscoveryCache(path)
+        assert cache.lookup('HUB NO.4', 65) is None
+        cache.store('HUB NO.4', 65, None, 'AA', 'HUB NO.4')
+        cache.store('HUB NO.4', 65, None, 'BB', 'HUB NO.4')
+
+        # Persisted across instances, most recent first, skipping claimed addresses
+        cache = DiscoveryCache(path)
+        assert cache.lookup('HUB NO.4', 65) == ('BB', 'HUB NO.4')
+        assert cache.lookup('HUB NO.4', 65, exclude={'BB'}) == ('AA', 'HUB NO.4')
+        cache.invalidate('HUB NO.4', 65, None, 'BB')
+        assert cache.lookup('HUB NO.4', 65, exclude={'AA'}) is None
+        assert (cache.hits, cache.misses, cache.stale) == (2, 1, 1)
+
+    def test_expired_entries_are_misses(self, tmp_path):
+        cache = DiscoveryCache(str(tmp_path / 'cache.json'), max_age=-1)
+        cache.store('HUB NO.4', 65, 'AA', 'AA', 'HUB NO.4')
+        assert cache.lookup('HUB NO.4', 65, 'AA') is None
@@ -0,0 +1,50 @@
+import json, struct
+
+from bricknil.const import DEVICES
+from bricknil.sensor.peripheral import ValueDecoder
+from bricknil.sensor.codegen import module_source, peripheral_class, load_port_info
+
+PORT_INFO = {'id': 0x99, 'name': 'Test Gauge+', 'combinable': 4, 'mode_combinations': [[0, 1]],
+             'modes': {0: {'name': 'TEMP', 'datasets': 1, 'dataset_type': '16b',
+                           'raw_range': (-900.0, 900.0), 'si_range': (-90.0, 90.0)},
+                       1: {'name': 'CFG', 'datasets': 2, 'dataset_type': '8b',
+                           'raw_range': (0.0, 255.0), 'si_range': (0.0, 255.0)},
+                       2: {'name': 'LOAD', 'datasets': 1, 'dataset_type': '8b',
+                           'raw_range': (0.0, 127.0), 'si_range': (0.0, 127.0)},
+                       3: {'output': True}}}
+
+
+class TestCodegen:
+
+    def teardown_method(self):
+        DEVICES.pop(0x99, None)
+
+    def test_generated_module_matches_runtime_class(self):
+        namespace = {}
+        exec(module_source([PORT_INFO], si_units=True), namespace)
+        generated = namespace['TestGauge']
+        built = peripheral_class(PORT_INFO, si_units=True)
+        assert DEVICES[0x99] == 'Test Gauge+'
+        for cls in (generated, built):
+            assert cls._sensor_id == 0x99
+            assert [(c.name, c.value) for c in cls.capability] == [('sense_temp', 0), ('sense_cfg', 1), ('sense_load', 2)]
+            assert [c.name for c in cls.allowed_combo] == ['sense_temp', 'sense_cfg']
+        assert list(generated.datasets.values()) == list(built.datasets.values())
+        temp = built.datasets[built.capability.sense_temp]
+        assert (temp.signed, temp.scale) == (True, 0.1)
+        assert built.datasets[built.capability.sense_cfg].signed == False
+
+    def test_decode_with_generated_layout(self):
+        cls = peripheral_class(PORT_INFO, si_units=True)
+        caps = [cls.capability.sense_temp, cls.capability.sense_cfg]
+        value = {caps[0]: [None], caps[1]: [None, None]}
+        ValueDecoder(cls.datasets, caps).decode(bytes([0, 3]) + struct.pack('<hBB', -215, 200, 7), value)
+        assert value == {caps[0]: -21.5, caps[1]: [200, 7]}
+
+    def test_load_port_info_cache(self, tmp_path):
+        cached = {k: v for k, v in PORT_INFO.items() if k not in ('id', 'name')}
+        path = tmp_path / 'cache.json'
+        path.write_text(json.dumps({'38|268632577|536870912': cached, '153|0|0': cached}))
+        devices = load_port_info(str(path))
+        assert [(d['id'], d['name']) for d in devices] == [(38, 'External Motor with Tacho'), (153, 'Device 153')]
+        assert devices[0]['modes'][0]['name'] == 'TEMP'
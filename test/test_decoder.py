@@ -0,0 +1,68 @@
+import struct
+from asyncio import run
+
+from hypothesis import given
+from hypothesis import strategies as st
+
+from bricknil.sensor import InternalTiltSensor, VisionSensor, DuploSpeedSensor
+from bricknil.sensor.peripheral import Peripheral, ValueDecoder
+
+
+class TestValueDecoder:
+
+    @given(bitmask=st.integers(1, 31), seed=st.integers(0, 255))
+    def test_combined_layouts(self, bitmask, seed):
+        caps = list(InternalTiltSensor.capability)
+        decoder = ValueDecoder(InternalTiltSensor.datasets, caps)
+        value = {cap: [None]*InternalTiltSensor.datasets[cap][0] for cap in caps}
+        # Readings are packed in capability order, only for the bits that are set
+        msg = bytes([0, bitmask])
+        expected = {}
+        for index, cap in enumerate(caps):
+            if bitmask & (1<<index):
+                nvalues, nbytes = InternalTiltSensor.datasets[cap]
+                fmt = {1: 'b', 2: 'h', 4: 'i'}[nbytes]
+                readings = [(seed + i) % 100 - 50 for i in range(nvalues)]
+                msg += struct.pack('<' + fmt*nvalues, *readings)
+                expected[cap] = readings[0] if nvalues == 1 else readings
+        updated = decoder.decode(memoryview(msg), value)
+        assert updated == list(expected)
+        for cap, reading in expected.items():
+            assert value[cap] == reading
+
+    def test_unexpected_bitmask_is_ignored(self):
+        caps = list(VisionSensor.capability)[:2]
+        decoder = ValueDecoder(VisionSensor.datasets, caps)
+        value = {}
+        # No capability set, one that isn't configured, and a non-zero leading byte
+        for msg in (bytes([0, 0]), bytes([0, 0x04, 1]), bytes([1, 0x01, 1])):
+            assert decoder.decode(msg, value) == []
+        assert value == {}
+
+    def test_multi_value_reading_updated_in_place(self):
+        rgb = VisionSensor.capability.sense_rgb
+        decoder = ValueDecoder(VisionSensor.datasets, [rgb])
+        value = {rgb: [None, None, None]}
+        store = value[rgb]
+        decoder.decode(struct.pack('<hhh', 10, -20, 30), value)
+        assert value[rgb] is store and store == [10, -20, 30]
+
+    def test_unsigned_and_scaled(self):
+        cap = DuploSpeedSensor.capability.sense_speed
+        datasets = {cap: Peripheral.Dataset(nvalues=1, nbytes=2, minval=0, maxval=0xffff, signed=False, scale=0.5)}
+        value = {}
+        ValueDecoder(datasets, [cap]).decode(bytes([0xff, 0xff]), value)
+        assert value[cap] == 0xffff * 0.5
+
+    def test_reverse_speed_is_negative(self):
+        sensor = DuploSpeedSensor('speed', capabilities=['sense_speed', 'sense_count'])
+        sensor.port = 1
+        async def child():
+            sensor.message_handler = self._swallow
+            await sensor.activate_updates()
+            await sensor.update_value(struct.pack('<BBhi', 0, 3, -120, -7))
+        run(child())
+        assert sensor.sense_speed == -120 and sensor.sense_count == -7
+
+    async def _swallow(self, *args, **kwargs):
+        pass
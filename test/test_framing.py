@@ -0,0 +1,75 @@
+from hypothesis import given
+from hypothesis import strategies as st
+
+from bricknil.framing import frame, read_length, FrameAssembler
+from bricknil.message_dispatch import MessageDispatch
+from bricknil.mailbox import PeripheralEvent
+
+
+class Mailbox:
+    def __init__(self):
+        self.events = []
+    def put_nowait(self, event):
+        self.events.append(event)
+
+class HubStub:
+    def __init__(self):
+        self.peripheral_queue = Mailbox()
+    def port_output_feedback(self, port, feedback):
+        pass
+
+
+def value_message(port, size):
+    return frame([0x00, 0x45, port] + [port]*size)
+
+
+class TestFraming:
+
+    def test_length_header(self):
+        short = frame([0x00, 0x45, 0x01, 0x02])
+        assert short == bytearray([5, 0x00, 0x45, 0x01, 0x02])
+        assert read_length(short) == (5, 1)
+        long = frame([0x00, 0x44] + [0x20]*200)
+        assert len(long) == 204 and long[:2] == bytearray([0x80 | (204 & 0x7F), 204 >> 7])
+        assert read_length(long) == (204, 2)
+        # Only the first length byte has arrived
+        assert read_length(long[:1]) is None
+
+    def test_concatenated_messages_are_views(self):
+        data = bytes(value_message(1, 1) + value_message(2, 4) + value_message(3, 150))
+        assembler = FrameAssembler()
+        messages = assembler.feed(data)
+        assert [bytes(m) for m in messages] == [value_message(1, 1), value_message(2, 4), value_message(3, 150)]
+        assert all(isinstance(m, memoryview) and m.obj is data for m in messages)
+        assert assembler.partial is None
+        single = bytes(value_message(1, 1))
+        message, = assembler.feed(single)
+        assert isinstance(message, memoryview) and message.obj is single
+
+    @given(size=st.integers(0, 300), cut=st.lists(st.integers(1, 400), max_size=4))
+    def test_split_anywhere(self, size, cut):
+        data = bytes(value_message(1, 2) + value_message(2, size) + value_message(3, 2))
+        cuts = sorted(set(c for c in cut if c < len(data)))
+        assembler = FrameAssembler()
+        messages = []
+        for start, end in zip([0] + cuts, cuts + [len(data)]):
+            messages.extend(bytes(m) for m in assembler.feed(data[start:end]))
+        assert messages == [value_message(1, 2), value_message(2, size), value_message(3, 2)]
+        assert assembler.partial is None and assembler.malformed == 0
+
+    def test_impossible_length_is_dropped(self):
+        assembler = FrameAssembler()
+        assert [bytes(m) for m in assembler.feed(bytes(value_message(1, 1)) + bytes([1, 0, 0]))] == [value_message(1, 1)]
+        assert assembler.malformed == 1
+        # The next notification starts afresh
+        assert [bytes(m) for m in assembler.feed(bytes(value_message(2, 1)))] == [value_message(2, 1)]
+
+    def test_dispatch_long_and_packed_messages(self):
+        hub = HubStub()
+        dispatch = MessageDispatch(hub)
+        data = bytes(value_message(1, 1) + value_message(2, 140))
+        descriptions = dispatch.feed(data[:100])
+        descriptions += dispatch.feed(data[100:])
+        assert len(descriptions) == 2
+        assert hub.peripheral_queue.events == [PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 1, bytes([1])),
+                                               PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 2, bytes([2]*140))]
@@ -0,0 +1,107 @@
+from asyncio import run, sleep
+
+from bricknil.hub import PoweredUpHub
+from bricknil.sensor import ExternalMotor
+from bricknil.handlers import HandlerPolicy
+from bricknil.mailbox import PeripheralEvent
+
+
+async def swallow(*args, **kwargs):
+    pass
+
+
+class HandlerHub(PoweredUpHub):
+
+    def __init__(self, name, policy, depth=1, handler_time=0.02):
+        super().__init__(name)
+        self.handler_time = handler_time
+        self.slow_seen = []
+        self.fast_seen = []
+        self.running = 0
+        self.most_running = 0
+        self.most_waiting = 0
+        slow = ExternalMotor('slow', capabilities=['sense_speed'])
+        slow.handler_policy = policy
+        slow.mailbox_depth = depth
+        self.attach_sensor(slow)
+        self.attach_sensor(ExternalMotor('fast', capabilities=['sense_speed']))
+
+    async def slow_change(self):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        self.most_waiting = max(self.most_waiting, len(self.handlers['slow'].waiting))
+        try:
+            value = self.slow.value[self.slow.capability.sense_speed]
+            await sleep(self.handler_time)
+            if value == 13:
+                raise ValueError('unlucky reading')
+            self.slow_seen.append(value)
+        finally:
+            self.running -= 1
+
+    async def fast_change(self):
+        self.fast_seen.append(self.fast.value[self.fast.capability.sense_speed])
+
+    async def bind(self):
+        for port, peripheral in enumerate((self.slow, self.fast)):
+            peripheral.port = port
+            peripheral.message_handler = swallow
+            self._bind_port(port, peripheral)
+            await peripheral.activate_updates()
+
+    async def stream(self, n):
+        for i in range(n):
+            await self.recv_message(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 0, bytes([i])))
+            await self.recv_message(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, 1, bytes([i])))
+            await sleep(0.001)
+
+
+def stream(policy, n=20, depth=1):
+    hub = HandlerHub('hub', policy, depth)
+    async def child():
+        await hub.bind()
+        await hub.stream(n)
+        # A slow handler doesn't hold up the other peripheral
+        assert hub.fast_seen == list(range(n))
+        await hub.join_handlers()
+        for runner in hub.handlers.values():
+            runner.stop()
+    run(child())
+    return hub, hub.handler_stats()['slow']
+
+
+class TestHandlerPolicies:
+
+    def test_serial(self):
+        hub, stats = stream('serial', n=12, depth=None)
+        # Every reading handled, in order, each handler seeing its own reading
+        assert hub.slow_seen == list(range(12))
+        assert hub.most_running == 1
+        assert stats['runs'] == 12 and stats['skipped'] == 0
+        assert stats['p50'] is not None
+
+    def test_serial_keeps_at_most_mailbox_depth(self):
+        hub, stats = stream('serial', depth=3)
+        # Readings beyond the depth skip the oldest waiting, the newest is always handled
+        assert hub.most_waiting <= 3
+        assert hub.slow_seen == sorted(hub.slow_seen) and hub.slow_seen[-1] == 19
+        assert stats['skipped'] > 0 and stats['runs'] + stats['skipped'] == 20
+
+    def test_failing_handler(self):
+        hub, stats = stream('serial', depth=None)
+        # Every reading handled, and the one that raised doesn't stop the rest
+        assert hub.slow_seen == [i for i in range(20) if i != 13]
+        assert stats['errors'] == 1 and stats['runs'] == 19 and stats['skipped'] == 0
+
+    def test_latest_cancels_stale_handlers(self):
+        hub, stats = stream(HandlerPolicy('latest', cancel=True))
+        # Only a handler nobody interrupted gets to finish: the last one
+        assert hub.slow_seen == [19]
+        assert stats['cancelled'] > 0 and stats['runs'] == 1
+
+    def test_concurrent_limit_and_errors(self):
+        hub, stats = stream(HandlerPolicy('concurrent', limit=3))
+        assert hub.most_running == 3
+        assert stats['skipped'] > 0
+        assert stats['runs'] + stats['skipped'] + stats['errors'] == 20
+        assert hub.slow_seen == sorted(hub.slow_seen)
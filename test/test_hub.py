@@ -16,6 +16,7 @@ from hypothesis import strategies as st
 
 from bricknil.message_dispatch import MessageDispatch
 from bricknil.messages import UnknownMessageError, HubPropertiesMessage
+from bricknil.mailbox import PeripheralEvent
 from bricknil.sensor import *
 from bricknil.const import DEVICES
 from bricknil import attach, start
@@ -167,7 +168,7 @@ class TestSensors:
                     for b in range(byte_count):
                         msg.append(data.draw(st.integers(0,255)))
             msg = bytearray(msg)
-            await hub.peripheral_queue.put( ('value_change', (port, msg)))
+            await hub.peripheral_queue.put(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, port, msg))
         elif len(sensor.capabilities) > 1:
             modes = 1
             msg.append(modes)
@@ -178,7 +179,7 @@ class TestSensors:
                         for b in range(byte_count):
                             msg.append(data.draw(st.integers(0,255)))
             msg = bytearray(msg)
-            await hub.peripheral_queue.put( ('value_change', (port, msg)))
+            await hub.peripheral_queue.put(PeripheralEvent(PeripheralEvent.VALUE_CHANGE, port, msg))
         
         await hub_stop_evt.set()
         await system.join()
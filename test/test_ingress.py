@@ -0,0 +1,36 @@
+import threading
+from asyncio import run, sleep
+
+from bricknil.ingress import NotificationIngress
+
+
+class TestNotificationIngress:
+
+    def test_off_loop_notifications_are_batched_onto_loop(self):
+        handled = []
+        def handler(data, timestamp):
+            if data == b'\xff':
+                raise ValueError('bad packet')
+            handled.append((data, threading.get_ident()))
+
+        async def child():
+            ingress = NotificationIngress('test', handler)
+            def backend():
+                for i in range(1000):
+                    ingress.received(None, bytearray([i % 255]))
+                ingress.received(None, bytearray([0xff]))
+                ingress.received(None, bytearray([1]))
+            thread = threading.Thread(target=backend)
+            thread.start()
+            while thread.is_alive() or ingress.pending:
+                await sleep(0.001)
+            await sleep(0)
+            return ingress
+        loop_thread = threading.get_ident()
+        ingress = run(child())
+
+        # Everything handled in order on the loop thread, despite the bad packet
+        assert [d for d, t in handled] == [bytes([i % 255]) for i in range(1000)] + [b'\x01']
+        assert all(t == loop_thread for d, t in handled)
+        assert ingress.notifications == 1002
+        assert ingress.batches < ingress.notifications
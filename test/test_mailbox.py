@@ -0,0 +1,52 @@
+import pytest
+from asyncio import run, QueueEmpty, wait_for, get_event_loop
+
+from bricknil.mailbox import PeripheralMailbox, PeripheralEvent
+
+VALUE, ATTACH, UPDATE = PeripheralEvent.VALUE_CHANGE, PeripheralEvent.ATTACH, PeripheralEvent.UPDATE_PORT
+
+
+class TestPeripheralMailbox:
+
+    def setup_method(self):
+        self.mb = PeripheralMailbox('test')
+
+    def _drain(self):
+        items = []
+        while not self.mb.empty():
+            items.append(self.mb.get_nowait())
+        return items
+
+    def test_readings_conflated_control_kept(self):
+        self.mb.put_nowait(PeripheralEvent(ATTACH, 1, 'motor'))
+        for v in range(5):
+            self.mb.put_nowait(PeripheralEvent(VALUE, 1, v))
+            self.mb.put_nowait(PeripheralEvent(VALUE, 2, v*10))
+        self.mb.put_nowait(PeripheralEvent(UPDATE, 1, {}))
+        assert self.mb.qsize() == 4
+        assert self._drain() == [PeripheralEvent(ATTACH, 1, 'motor'),
+                                 PeripheralEvent(VALUE, 1, 4),
+                                 PeripheralEvent(VALUE, 2, 40),
+                                 PeripheralEvent(UPDATE, 1, {})]
+        assert (self.mb.dropped, self.mb.drops) == (8, {1: 4, 2: 4})
+        with pytest.raises(QueueEmpty):
+            self.mb.get_nowait()
+
+    def test_depth_per_port(self):
+        self.mb.set_depth(1, 3)
+        self.mb.set_depth(255, None)
+        for v in range(6):
+            self.mb.put_nowait(PeripheralEvent(VALUE, 1, v))
+            self.mb.put_nowait(PeripheralEvent(VALUE, 255, v))
+        assert (self.mb.port_depth(1), self.mb.port_depth(255)) == (3, 6)
+        items = self._drain()
+        assert [e.data for e in items if e.port == 1] == [3, 4, 5]
+        assert [e.data for e in items if e.port == 255] == list(range(6))
+        assert self.mb.drops == {1: 3}
+        assert self.mb.peak_depth == 9
+
+    def test_get_waits_for_message(self):
+        async def child():
+            get_event_loop().call_soon(lambda: self.mb.put_nowait(PeripheralEvent(VALUE, 1, 7)))
+            return await wait_for(self.mb.get(), 1)
+        assert run(child()) == PeripheralEvent(VALUE, 1, 7)
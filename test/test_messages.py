@@ -12,11 +12,12 @@ from hypothesis import strategies as st
 
 from bricknil.message_dispatch import MessageDispatch
 from bricknil.messages import UnknownMessageError, HubPropertiesMessage
+from bricknil.mailbox import PeripheralEvent
 from bricknil.const import DEVICES
 
 class TestMessages:
 
-    def setup(self):
+    def setup_method(self):
         # Create the main dispatch
         self.hub = MagicMock()
         self.m = MessageDispatch(self.hub)
@@ -26,6 +27,13 @@ class TestMessages:
         assert l<127
         return bytearray([l, 0]+list(msg))
 
+    def _assert_sent(self, op, port, data=None, last=False):
+        event = PeripheralEvent(op, port, data)
+        if last:
+            self.hub.peripheral_queue.put_nowait.assert_called_with(event)
+        else:
+            self.hub.peripheral_queue.put_nowait.assert_any_call(event)
+
     @given(st.data())
     def test_port_value_message(self, data):
         port = data.draw(st.integers(0,255))
@@ -35,7 +43,14 @@ class TestMessages:
         msg_type = 0x45
         msg = bytearray([msg_type, port]+values)
         l = self.m.parse(self._with_header(msg))
-        self.hub.peripheral_queue.put.assert_called_with(('value_change', (port,values)))
+        assert l == f'Port {port} changed value to {values}'
+        self._assert_sent(PeripheralEvent.VALUE_CHANGE, port, bytes(values), last=True)
+        # Without a description, and from a notification: the value is a view into it
+        notification = bytes(self._with_header(msg))
+        assert self.m.feed(notification, describe=False) is None
+        self._assert_sent(PeripheralEvent.VALUE_CHANGE, port, bytes(values), last=True)
+        value = self.hub.peripheral_queue.put_nowait.call_args[0][0].data
+        assert isinstance(value, memoryview) and value.obj is notification
 
     @given(port=st.integers(0,255),
            mode_ptr=st.integers(0, 0xffff),
@@ -47,7 +62,7 @@ class TestMessages:
         msg = bytearray([msg_type, int(port)])+mptr+bytearray(mode_data)
         l = self.m.parse(self._with_header(msg))
         assert l==f'Port {port} changed combo value to {list(msg[2:])}'
-        self.hub.peripheral_queue.put.assert_called_with(('value_change', (port,list(msg[2:]))))
+        self._assert_sent(PeripheralEvent.VALUE_CHANGE, port, bytes(msg[2:]), last=True)
 
     @given(prop=st.integers(0,255),
            op = st.integers(0,255),
@@ -73,7 +88,7 @@ class TestMessages:
                 l = self.m.parse(msg)
                 remaining = self.m._parse_msg_bytes(list(msg[5:]))
                 if prop==0x02 and op==0x06:
-                    self.hub.peripheral_queue.put.assert_called_with(('value_change', (255,list(msg[5:]))))
+                    self._assert_sent(PeripheralEvent.VALUE_CHANGE, 255, bytes(msg[5:]), last=True)
                 else:
                     assert l == f'Hub property:  {HubPropertiesMessage.prop_names[prop]} {HubPropertiesMessage.operation_names[op]} {remaining}'
 
@@ -95,8 +110,12 @@ class TestMessages:
             fw_version = data.draw(st.lists(st.integers(0,255), min_size=8, max_size=8))
             msg = msg + bytearray([dev_id, 0])+ bytearray(fw_version)
             l = self.m.parse(self._with_header(msg))
-            self.hub.peripheral_queue.put.assert_any_call(('update_port', (port, self.m.port_info[port])))
-            self.hub.peripheral_queue.put.assert_any_call(('port_detected', port))
+            hw_version, sw_version = struct.unpack('<II', bytes(fw_version))
+            assert self.m.port_info[port]['hw_version'] == hw_version
+            assert self.m.port_info[port]['sw_version'] == sw_version
+            self._assert_sent(PeripheralEvent.ATTACH, port, DEVICES[dev_id])
+            self._assert_sent(PeripheralEvent.UPDATE_PORT, port, self.m.port_info[port])
+            self._assert_sent(PeripheralEvent.PORT_DETECTED, port, last=True)
             # ALso need to make sure the port info is added to dispatch
             assert self.m.port_info[port]['name'] == DEVICES[dev_id]
         elif event == 2: # virtual attach
@@ -105,8 +124,9 @@ class TestMessages:
             v_port_b = data.draw(st.integers(0,255))
             msg = msg + bytearray([dev_id, 0, v_port_a, v_port_b])
             l = self.m.parse(self._with_header(msg))
-            self.hub.peripheral_queue.put.assert_any_call(('update_port', (port, self.m.port_info[port])))
-            self.hub.peripheral_queue.put.assert_any_call(('port_detected', port))
+            self._assert_sent(PeripheralEvent.ATTACH, port, DEVICES[dev_id])
+            self._assert_sent(PeripheralEvent.UPDATE_PORT, port, self.m.port_info[port])
+            self._assert_sent(PeripheralEvent.PORT_DETECTED, port, last=True)
             assert l == f'Attached VirtualIO Port:{port} {self.m.port_info[port]["name"]} Port A: {v_port_a}, Port B: {v_port_b}'
             assert self.m.port_info[port]['virtual'] == (v_port_a, v_port_b)
             assert self.m.port_info[port]['name'] == DEVICES[dev_id]
@@ -125,8 +145,8 @@ class TestMessages:
             msg = bytearray([msg_type, port, mode, capabilities, nmodes]+input_modes+output_modes)
             l = self.m.parse(self._with_header(msg))
 
-            self.hub.peripheral_queue.put.assert_any_call(('update_port', (port, self.m.port_info[port])))
-            self.hub.peripheral_queue.put.assert_any_call(('port_info_received', port))
+            self._assert_sent(PeripheralEvent.UPDATE_PORT, port, self.m.port_info[port])
+            self._assert_sent(PeripheralEvent.PORT_INFO_RECEIVED, port, last=True)
 
             # Make sure the proper capabilities have been set
             bitmask = ['output', 'input', 'combinable', 'synchronizable'] # capabilities
@@ -151,11 +171,16 @@ class TestMessages:
             msg = bytearray([msg_type, port, mode]+combos+[0,0])
             l = self.m.parse(self._with_header(msg))
 
-            self.hub.peripheral_queue.put.assert_any_call(('update_port', (port, self.m.port_info[port])))
-            self.hub.peripheral_queue.put.assert_any_call(('port_combination_info_received', port))
+            self._assert_sent(PeripheralEvent.UPDATE_PORT, port, self.m.port_info[port])
+            self._assert_sent(PeripheralEvent.PORT_COMBINATION_INFO_RECEIVED, port, last=True)
 
-            # Assert number of combos
-            #assert len(combos)/2 == len(self.m.port_info[port]['mode_combinations'])
+            # Combinations up to the first empty one
+            expected = []
+            for word in struct.unpack(f'<{ncombos}H', bytes(combos)):
+                if word == 0:
+                    break
+                expected.append([i for i in range(16) if word & (1<<i)])
+            assert self.m.port_info[port]['mode_combinations'] == expected
 
     @given(feedback=st.integers(0,32),
            port=st.integers(0,255)
@@ -164,6 +189,10 @@ class TestMessages:
         msg_type = 0x82
         msg = bytearray([msg_type, port, feedback])
         self.m.parse(self._with_header(msg))
+        self.hub.port_output_feedback.assert_called_with(port, feedback)
+        self.hub.port_output_feedback.reset_mock()
+        assert self.m.parse(self._with_header(msg), describe=False) is None
+        self.hub.port_output_feedback.assert_called_with(port, feedback)
         
     @given(mode_type=st.sampled_from([0,1,2,3,4,5, 0x80]),#([0,1,2,3,4,5,0x80]),
            mode=st.integers(0,255),
@@ -198,16 +227,10 @@ class TestMessages:
 
         msg = bytearray([msg_type, port, mode, mode_type]) + payload
         self.m.parse(self._with_header(msg))
-            
-
-
-
-
-
-
-
-            
-
-
-
-    
\ No newline at end of file
+        self._assert_sent(PeripheralEvent.UPDATE_PORT, port, self.m.port_info[port])
+        self._assert_sent(PeripheralEvent.PORT_MODE_INFO_RECEIVED, port, last=True)
+        mode_info = self.m.port_info[port]['modes'][mode]
+        if mode_type == 0:
+            assert mode_info['name'] == payload.replace(b'\x00', b'').decode('latin-1')
+        elif mode_type == 0x80:
+            assert (mode_info['datasets'], mode_info['dataset_type']) == (ndatasets, ['8b', '16b', '32b', 'float'][dataset_type])
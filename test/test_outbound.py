@@ -0,0 +1,143 @@
+import pytest
+from asyncio import run, sleep, wait_for, create_task as spawn
+
+from hypothesis import given
+from hypothesis import strategies as st
+
+from bricknil.outbound import OutboundQueue, CommandDiscardedError
+
+
+class TestOutboundQueue:
+
+    def setup_method(self):
+        self.written = []
+        self.responses = []
+        self.q = OutboundQueue('test', self._write)
+
+    async def _write(self, msg_bytes, response=True):
+        self.written.append(msg_bytes)
+        self.responses.append(response)
+        await sleep(0)
+
+    def _set_output(self, port, mode, value):
+        return [0x00, 0x81, port, 0x11, 0x51, mode, value]
+
+    @given(speeds=st.lists(st.integers(0, 100), min_size=1, max_size=20))
+    def test_setpoints_are_coalesced(self, speeds):
+        self.setup_method()
+        async def child():
+            for speed in speeds:
+                self.q.put(self._set_output(1, 0, speed))
+            self.q.start()
+            await self.q.send([0x00, 0x41, 1, 0, 1, 0, 0, 0, 1])
+            self.q.stop()
+        run(child())
+        # Only the newest setpoint goes out, followed by the (never coalesced) config command
+        assert self.written == [self._set_output(1, 0, speeds[-1]), [0x00, 0x41, 1, 0, 1, 0, 0, 0, 1]]
+        assert self.q.coalesced == len(speeds) - 1
+        assert self.q.sent == 2
+
+    def test_different_ports_and_commands_keep_order(self):
+        msgs = [self._set_output(1, 0, 10),
+                [0x00, 0x81, 1, 0x11, 0x0d, 0, 0, 0, 0, 50, 50, 126, 0],
+                [0x00, 0x81, 1, 0x11, 0x0d, 0, 0, 0, 0, 50, 50, 126, 0],
+                self._set_output(2, 0, 20)]
+        async def child():
+            for msg in msgs:
+                self.q.put(msg)
+            self.q.start()
+            await self.q.drain()
+            assert len(self.written) == len(msgs)
+            self.q.stop()
+        run(child())
+        assert self.written == msgs
+        assert self.q.coalesced == 0
+
+    def test_delivery_mode_per_command(self):
+        async def child():
+            self.q.start()
+            await self.q.send([0x00, 0x41, 1, 0, 1, 0, 0, 0, 1])
+            self.q.put(self._set_output(1, 0, 10), response=False)
+            # Newest setpoint's delivery mode wins
+            self.q.put(self._set_output(2, 0, 10), response=False)
+            self.q.put(self._set_output(2, 0, 20))
+            while len(self.q) > 0:
+                await sleep(0)
+            await sleep(0)
+            self.q.stop()
+        run(child())
+        assert self.responses == [True, False, True]
+
+    def test_cancelled_send_does_not_stop_the_writer(self):
+        def config(port):
+            return [0x00, 0x41, port, 0, 1, 0, 0, 0, 1]
+        async def slow_write(msg_bytes, response=True):
+            self.written.append(msg_bytes)
+            await sleep(0.01)
+        async def child():
+            # Cancelled while queued
+            queued = spawn(self.q.send(config(1)))
+            await sleep(0)
+            queued.cancel()
+            await sleep(0)
+            assert len(self.q) == 0
+            # Cancelled while being written
+            self.q.write = slow_write
+            self.q.start()
+            writing = spawn(self.q.send(config(2)))
+            await sleep(0.005)
+            writing.cancel()
+            assert await wait_for(self.q.send(config(3)), 1) is None
+            assert not self.q.writer_task.done()
+            self.q.stop()
+        run(child())
+        assert self.written == [config(2), config(3)]
+
+
+class TestFlowControl:
+
+    def setup_method(self):
+        self.written = []
+        self.q = OutboundQueue('test', self._write, flow_control=True, window=2)
+
+    async def _write(self, msg_bytes, response=True):
+        self.written.append(msg_bytes)
+        await sleep(0)
+
+    def _rotate(self, port, degrees):
+        return [0x00, 0x81, port, 0x11, 0x0b, degrees, 0, 0, 0, 50, 50, 126, 0]
+
+    async def _settle(self):
+        for i in range(5):
+            await sleep(0)
+
+    def test_credits_pause_and_resume_port(self):
+        async def child():
+            commands = [self.q.put(self._rotate(1, d), completion=True) for d in range(4)]
+            other = self.q.put(self._rotate(2, 9))
+            self.q.start()
+            await self._settle()
+            # Two in flight on port 1, port 2 not held back
+            assert [m[5] for m in self.written] == [0, 1, 9]
+            # Commands are buffered instead of executed immediately
+            assert all(m[3] == 0x01 for m in self.written)
+
+            self.q.feedback(1, 0x01 | 0x02)   # First one completed, second one in progress
+            await self._settle()
+            assert [m[5] for m in self.written] == [0, 1, 9, 2]
+            assert commands[0].completion.result() == True
+
+            self.q.feedback(1, 0x10)          # Busy/full: pause port even with credit left
+            self.q.feedback(1, 0x10 | 0x04 | 0x01)  # Discard all but the newest in progress
+            await self._settle()
+            assert len(self.written) == 4
+            with pytest.raises(CommandDiscardedError):
+                commands[1].completion.result()
+
+            self.q.feedback(1, 0x02 | 0x08)   # Idle again
+            await self._settle()
+            assert [m[5] for m in self.written] == [0, 1, 9, 2, 3]
+            assert commands[2].completion.result() == True
+            assert (self.q.completed, self.q.discarded) == (2, 1)
+            self.q.stop()
+        run(child())
@@ -0,0 +1,133 @@
+import time
+from asyncio import run, sleep, wait_for, get_event_loop
+
+import pytest
+
+from bricknil.process import Process, EmitPolicy, LoopEvent
+
+
+class Sender(Process):
+    _signals_ = ['ping']
+
+
+class TestReceiverTable:
+
+    def test_functions_then_coroutines(self):
+        sender = Sender('sender')
+        calls = []
+        async def late(source, value):
+            calls.append(('late', value))
+        def early(source, value):
+            calls.append(('early', value))
+        sender.connect('ping', late)
+        sender.connect('ping', early)
+        sender.connect('ping', early)   # Connecting twice calls it once
+        run(sender.emit('ping', 1))
+        assert calls == [('early', 1), ('late', 1)]
+
+    def test_disconnect(self):
+        sender = Sender('sender')
+        calls = []
+        def receiver(source, value):
+            calls.append(value)
+        sender.connect('ping', receiver)
+        run(sender.emit('ping', 1))
+        sender.disconnect('ping', receiver)
+        run(sender.emit('ping', 2))
+        assert calls == [1]
+        assert 'ping' not in sender._receivers
+
+    def test_per_instance(self):
+        a, b = Sender('a'), Sender('b')
+        calls = []
+        a.connect('ping', lambda source, value: calls.append(source))
+        run(b.emit('ping', 1))
+        run(a.emit('ping', 1))
+        assert calls == [a]
+
+    def test_unsupported_signal(self):
+        sender = Sender('sender')
+        with pytest.raises(AssertionError):
+            run(sender.emit('pong'))
+        with pytest.raises(AssertionError):
+            sender.connect('pong', print)
+
+
+class TestEmitPolicy:
+
+    def emit_to_slow_receivers(self, policy):
+        sender = Sender('sender')
+        sender.set_emit_policy(policy, 'ping')
+        seen = []
+        for i in range(10):
+            async def receiver(source, value, i=i):
+                await sleep(0.02)
+                seen.append(i)
+            sender.connect('ping', receiver)
+        start = time.monotonic()
+        run(sender.emit('ping', 1))
+        return time.monotonic() - start, seen, sender
+
+    def test_concurrent(self):
+        elapsed, seen, sender = self.emit_to_slow_receivers('concurrent')
+        assert sorted(seen) == list(range(10))
+        assert elapsed < 0.1
+        stats = sender.emit_stats()['ping']
+        assert len(stats) == 10
+        assert all(s['calls'] == 1 and s['p50'] >= 0.015 for s in stats.values())
+
+    def test_serial(self):
+        elapsed, seen, sender = self.emit_to_slow_receivers('serial')
+        assert seen == list(range(10))
+        assert elapsed >= 0.2
+
+    def test_timeouts_and_errors_are_isolated(self):
+        sender = Sender('sender')
+        sender.set_emit_policy(EmitPolicy('concurrent', timeout=0.05))
+        seen = []
+        async def hangs(source, value):
+            await sleep(10)
+        async def fails(source, value):
+            raise ValueError('broken subscriber')
+        def fails_too(source, value):
+            raise ValueError('broken subscriber')
+        async def works(source, value):
+            seen.append(value)
+        for receiver in (hangs, fails, fails_too, works):
+            sender.connect('ping', receiver)
+        start = time.monotonic()
+        run(sender.emit('ping', 1))
+        assert time.monotonic() - start < 1
+        assert seen == [1]
+        stats = {name.split('.')[-1]: s for name, s in sender.emit_stats()['ping'].items()}
+        assert stats['hangs']['timeouts'] == 1 and stats['hangs']['p50'] is None
+        assert stats['fails']['errors'] == 1 and stats['fails_too']['errors'] == 1
+        assert stats['works']['calls'] == 1 and stats['works']['errors'] == 0
+
+    def test_default_propagates_errors(self):
+        sender = Sender('sender')
+        async def fails(source, value):
+            raise ValueError('broken subscriber')
+        sender.connect('ping', fails)
+        with pytest.raises(ValueError):
+            run(sender.emit('ping', 1))
+        sender.set_emit_policy('serial', 'ping')
+        run(sender.emit('ping', 1))
+        sender.set_emit_policy(None, 'ping')
+        with pytest.raises(ValueError):
+            run(sender.emit('ping', 1))
+        assert sender.emit_stats()['ping']
+
+
+class TestLoopEvent:
+
+    def test_created_outside_the_loop(self):
+        event = LoopEvent()
+        event.set()
+        assert run(event.wait()) is True
+        event.clear()
+        async def child():
+            loop = get_event_loop()
+            loop.call_soon(event.set)
+            return await wait_for(event.wait(), 1)
+        assert run(child()) is True and event.is_set()
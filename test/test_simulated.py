@@ -0,0 +1,173 @@
+import time
+import pytest
+from asyncio import run, sleep, create_task as spawn
+
+from bricknil.ble_queue import BLEventQ
+from bricknil.simulated import SimulatedTransport, SimulatedHub
+from bricknil.hub import Hub, PoweredUpHub, PeripheralsNotAttachedError
+from bricknil.sensor import ExternalMotor, LED, Light
+from bricknil.const import Color
+from bricknil.port_info_cache import PortInfoCache
+
+
+class TestSimulatedHub:
+
+    def setup_method(self):
+        self.transport = SimulatedTransport()
+        self.saved_transport = BLEventQ.instance.transport
+        BLEventQ.instance.transport = self.transport
+        Hub.hubs = []
+
+    def teardown_method(self):
+        BLEventQ.instance.transport = self.saved_transport
+
+    def _hub(self, **kwargs):
+        hub = PoweredUpHub('hub', **kwargs)
+        hub.attach_sensor(ExternalMotor('motor', capabilities=['sense_speed', 'sense_pos']))
+        hub.attach_sensor(LED('led'))
+        return hub
+
+    def test_values_and_feedback(self):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}, rate=100))
+        hub = self._hub()
+        async def child():
+            await hub.connect()
+            await sleep(0.1)
+            # Combined mode updates from the motor
+            assert None not in hub.motor.value.values()
+            done = await hub.motor.rotate(90, 50, completion=True)
+            assert await done
+            await hub.disconnect()
+        run(child())
+        assert hub.motor.port == 0 and hub.led.port == 50
+        assert sim.connected == False
+
+    def test_attach_events(self):
+        self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}))
+        hub = self._hub(attach_timeout=0.5)
+        hub.attach_sensor(Light('light'))
+        hub.attach_sensor(Light('spare'))
+        hub.spare.required = False
+        async def child():
+            try:
+                await hub.connect()
+            finally:
+                await hub.disconnect()
+        with pytest.raises(PeripheralsNotAttachedError) as error:
+            run(child())
+        assert error.value.missing == ['light']
+        assert hub.motor.attached.is_set() and not hub.light.attached.is_set()
+
+        # Ready as soon as the last one attaches
+        Hub.hubs = []
+        hub = self._hub()
+        async def connect():
+            start = time.monotonic()
+            await hub.connect()
+            elapsed = time.monotonic() - start
+            await hub.disconnect()
+            return elapsed
+        assert run(connect()) < 0.1
+        assert hub.motor.port == 0 and hub.led.port == 50
+
+    def test_command_before_attach(self):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}))
+        hub = self._hub()
+        async def child():
+            start = time.monotonic()
+            command = spawn(hub.motor.set_speed(30))
+            await hub.connect()
+            await command
+            elapsed = time.monotonic() - start
+            await hub.disconnect()
+            return elapsed
+        # Sent as soon as the motor attached (with its port filled in), without polling
+        assert run(child()) < 0.5
+        assert bytes([0x08, 0x00, 0x81, 0, 0x11, 0x51, 0, 30]) in sim.received
+
+    def test_split_and_packed_notifications(self):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 1: 0x26, 50: 0x17}, rate=100, mtu=7, packed=True))
+        hub = self._hub()
+        hub.attach_sensor(ExternalMotor('motor2', capabilities=['sense_pos']))
+        async def child():
+            await hub.connect()
+            await sleep(0.1)
+            await hub.disconnect()
+        run(child())
+        assert None not in hub.motor.value.values() and None not in hub.motor2.value.values()
+        assert sim.notifications > sim.tick
+
+    def test_reconnect_restores_outputs(self):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}))
+        hub = self._hub(auto_reconnect=True)
+        async def child():
+            await hub.connect()
+            await hub.motor.set_speed(40)
+            await hub.led.set_color(Color.red)
+            await sleep(0.05)
+            sim.received.clear()
+            sim.drop_link()
+            while len(hub.reconnect_latencies) == 0:
+                await sleep(0.1)
+            await sleep(0.05)
+            await hub.disconnect()
+        run(child())
+        assert hub.disconnects == 1
+        assert bytes([0x08, 0x00, 0x81, 0, 0x11, 0x51, 0, 40]) in sim.received
+        assert bytes([0x08, 0x00, 0x81, 50, 0x11, 0x51, 0, Color.red.value]) in sim.received
+
+    def test_disconnect_all_stops_reconnecting(self):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}))
+        hub = self._hub(auto_reconnect=True)
+        ble_q = BLEventQ.instance
+        async def child():
+            await hub.connect()
+            sim.reachable = False
+            sim.drop_link()
+            await sleep(0.05)
+            reconnect = ble_q.reconnect_tasks[hub]
+            await ble_q.disconnect_all()
+            assert reconnect.done() and hub not in ble_q.reconnect_tasks
+            # Nothing left to bring the hub back
+            sim.reachable = True
+            connects = self.transport.connects
+            await sleep(0.6)
+            assert self.transport.connects == connects
+        run(child())
+        assert hub.tx is None and hub.ble_id not in ble_q.claimed_addresses
+
+    def test_port_info_cache(self, tmp_path):
+        sim = self.transport.add_hub(SimulatedHub(ports={0: 0x26, 50: 0x17}))
+        path = str(tmp_path / 'port_info.json')
+        def query():
+            Hub.hubs = []
+            hub = self._hub(query_port_info=True, port_info_cache=PortInfoCache(path))
+            async def child():
+                await hub.connect()
+                await sleep(0.2)
+                await hub.disconnect()
+            sim.received.clear()
+            run(child())
+            return hub, [m for m in sim.received if m[2] in (0x21, 0x22)]
+        hub, requests = query()
+        assert len(requests) > 2 and hub.port_info_cache.misses == 2
+        queried = hub.port_info
+        hub, requests = query()
+        assert requests == [] and hub.port_info_cache.hits == 2
+        assert hub.port_info[0]['modes'][1]['name'] == queried[0]['modes'][1]['name'] == 'SPEED'
+
+    def test_port_info_cache_skips_incomplete(self, tmp_path):
+        path = str(tmp_path / 'port_info.json')
+        cache = PortInfoCache(path)
+        port_info = {'id': 0x26, 'hw_version': 1, 'sw_version': 2, 'combinable': 1,
+                     'modes': {0: {'name': 'POWER', 'datasets': 1}, 1: {'name': 'SPEED'}}}
+        cache.store(port_info)
+        # A disconnect before every answer came in
+        cache.save()
+        assert not PortInfoCache(path).lookup({'id': 0x26, 'hw_version': 1, 'sw_version': 2})
+        assert not cache.lookup({'id': 0x26, 'hw_version': 1, 'sw_version': 2})
+        port_info['modes'][1]['datasets'] = 1
+        assert not PortInfoCache.complete(port_info)
+        port_info['mode_combinations'] = [[0, 1]]
+        cache.save()
+        assert PortInfoCache(path).lookup({'id': 0x26, 'hw_version': 1, 'sw_version': 2})